@@ -10,8 +10,10 @@ from urllib.parse import urlencode
 import zipfile
 
 from datamart_core.common import log_future
-from datamart_geo import GeoData
 from datamart_materialize import get_writer
+from datamart_profiler.admin_names import load_admin_names
+from datamart_profiler.geo_data import GeoData
+from datamart_profiler.geocode_cache import SqliteGeocodeCache
 
 from .graceful_shutdown import GracefulApplication
 
@@ -153,12 +155,21 @@ class Application(GracefulApplication):
         self.lazo_client = lazo
         if os.environ.get('NOMINATIM_URL'):
             self.nominatim = os.environ['NOMINATIM_URL']
+            self.geocode_cache = SqliteGeocodeCache('/cache/geocode.sqlite3')
         else:
             self.nominatim = None
+            self.geocode_cache = None
             logger.warning(
                 "$NOMINATIM_URL is not set, not resolving addresses"
             )
         self.geo_data = GeoData.from_local_cache()
+        load_admin_names(self.geo_data, '/cache')
+        if os.environ.get('PROFILE_TIME_BUDGET'):
+            self.profile_time_budget = float(
+                os.environ['PROFILE_TIME_BUDGET']
+            )
+        else:
+            self.profile_time_budget = None
         self.channel = None
 
         self.custom_fields = {}
@@ -104,20 +104,14 @@ class ProfilePostedData(tornado.web.RequestHandler):
                         geo_data=self.application.geo_data,
                         include_sample=True,
                         search=True, coverage=False, plots=False,
+                        time_budget=self.application.profile_time_budget,
                     )
                 logger.info("Profiled (fast) in %.2fs", time.perf_counter() - start)
 
                 data_profile['materialize'] = materialize
                 data_profile['version'] = os.environ['DATAMART_VERSION']
 
-                self.application.redis.set(
-                    'profile-fast:' + data_hash,
-                    json.dumps(
-                        data_profile,
-                        # Compact
-                        sort_keys=True, indent=None, separators=(',', ':'),
-                    ),
-                )
+                self.cache_profile('profile-fast:' + data_hash, data_profile)
             else:
                 logger.info("Profiling...")
                 start = time.perf_counter()
@@ -126,27 +120,39 @@ class ProfilePostedData(tornado.web.RequestHandler):
                         data=data,
                         lazo_client=self.application.lazo_client,
                         nominatim=self.application.nominatim,
+                        geocode_cache=self.application.geocode_cache,
                         geo_data=self.application.geo_data,
                         search=True,
                         include_sample=True,
                         coverage=True,
+                        time_budget=self.application.profile_time_budget,
                     )
                 logger.info("Profiled in %.2fs", time.perf_counter() - start)
 
                 data_profile['materialize'] = materialize
                 data_profile['version'] = os.environ['DATAMART_VERSION']
 
-                self.application.redis.set(
-                    'profile:' + data_hash,
-                    json.dumps(
-                        data_profile,
-                        # Compact
-                        sort_keys=True, indent=None, separators=(',', ':'),
-                    ),
-                )
+                self.cache_profile('profile:' + data_hash, data_profile)
 
         return data_profile, data_hash
 
+    def cache_profile(self, key, data_profile):
+        # Don't keep profiles that were cut short to fit the time budget
+        if (
+            'skipped_stages' in data_profile
+            or 'approximated_stages' in data_profile
+        ):
+            logger.info("Not caching incomplete profile")
+            return
+        self.application.redis.set(
+            key,
+            json.dumps(
+                data_profile,
+                # Compact
+                sort_keys=True, indent=None, separators=(',', ':'),
+            ),
+        )
+
 
 def get_data_profile_from_es(es, dataset_id):
     try:
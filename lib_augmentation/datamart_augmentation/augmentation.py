@@ -1,19 +1,36 @@
+import contextlib
+import csv
+import io
 import itertools
 import logging
 import numpy as np
+import operator
 import pandas as pd
+import prometheus_client
 from sklearn.neighbors._kd_tree import KDTree
 import time
 
 from datamart_materialize import types
 from datamart_profiler.spatial import median_smallest_distance
-from datamart_profiler.temporal import get_temporal_resolution, \
-    temporal_aggregation_keys
+from datamart_profiler.temporal import floor_datetimes, \
+    get_temporal_resolution, temporal_aggregation_keys, to_datetime64
+
+from .hash_join import HashJoinIndex
 
 
 logger = logging.getLogger(__name__)
 
 
+PROM_JOIN_ROWS_SCANNED = prometheus_client.Counter(
+    'augment_join_rows_scanned',
+    "Rows of companion data read for joins",
+)
+PROM_JOIN_ROWS_KEPT = prometheus_client.Counter(
+    'augment_join_rows_kept',
+    "Rows of companion data kept by the key filter for joins",
+)
+
+
 class AugmentationError(ValueError):
     """Error during augmentation.
     """
@@ -90,6 +107,29 @@ def _transform_data_index(data, level, func):
         data.index = func(data.index)
 
 
+def _index_conversion(column):
+    """Get the function converting the values of a join column to its type.
+
+    :param column: The metadata of the column
+    :return: A function taking and returning an index, or None
+    """
+    if types.DATE_TIME in column['semantic_types']:
+        return lambda idx: pd.to_datetime(idx.map(str), errors='coerce')
+    elif column['structural_type'] == types.INTEGER:
+        return lambda idx: pd.to_numeric(idx, errors='coerce', downcast='integer')
+    elif column['structural_type'] == types.FLOAT:
+        return lambda idx: pd.to_numeric(idx, errors='coerce', downcast='float')
+    elif column['structural_type'] == types.TEXT:
+        return lambda idx: idx.str.lower()
+    else:
+        return None
+
+
+def _index_names(nb_levels):
+    # Names of multiindex have to match for join() to work
+    return ['%04d' % i for i in range(nb_levels)]
+
+
 def set_data_index(data, columns, columns_metadata, drop=False):
     """
     Converts columns in a dataset (pandas.DataFrame) to their corresponding
@@ -103,40 +143,19 @@ def set_data_index(data, columns, columns_metadata, drop=False):
     )
 
     for i, col_idx in enumerate(columns):
-        column = columns_metadata[col_idx]
-        if types.DATE_TIME in column['semantic_types']:
-            _transform_data_index(
-                data, i,
-                lambda idx: pd.to_datetime(idx.map(str), errors='coerce'),
-            )
-        elif column['structural_type'] == types.INTEGER:
-            _transform_data_index(
-                data, i,
-                lambda idx: pd.to_numeric(idx, errors='coerce', downcast='integer'),
-            )
-        elif column['structural_type'] == types.FLOAT:
-            _transform_data_index(
-                data, i,
-                lambda idx: pd.to_numeric(idx, errors='coerce', downcast='float'),
-            )
-        elif column['structural_type'] == types.TEXT:
-            _transform_data_index(
-                data, i,
-                lambda idx: idx.str.lower(),
-            )
+        func = _index_conversion(columns_metadata[col_idx])
+        if func is not None:
+            _transform_data_index(data, i, func)
 
-    # Names of multiindex have to match for join() to work
-    data.index.names = ['%04d' % i for i in range(len(data.index.names))]
+    data.index.names = _index_names(len(data.index.names))
 
     return data
 
 
-def match_temporal_resolutions(input_data, companion_data, temporal_resolution=None):
-    """Matches the resolutions between the datasets.
-
-    This takes in example indexes, and returns a function to update future
-    indexes. This is because we are streaming, and want to decide once how to
-    process multiple batches.
+def _match_temporal_resolutions_levels(input_data, companion_data,
+                                       temporal_resolution=None):
+    """Like :func:`match_temporal_resolutions` but returns one function per
+    level of the index.
     """
 
     if isinstance(input_data.index, pd.MultiIndex):
@@ -154,7 +173,37 @@ def match_temporal_resolutions(input_data, companion_data, temporal_resolution=N
                 )
             else:
                 funcs.append(lambda x: x)
+        return funcs
+    elif (isinstance(input_data.index, pd.DatetimeIndex)
+          and isinstance(companion_data.index, pd.DatetimeIndex)):
+        return [match_column_temporal_resolutions(
+            input_data.index,
+            companion_data.index,
+            0,
+            temporal_resolution,
+        )]
+
+    return [lambda idx: idx]  # no-op
+
 
+def match_temporal_resolutions(input_data, companion_data, temporal_resolution=None):
+    """Matches the resolutions between the datasets.
+
+    This takes in example indexes, and returns a function to update future
+    indexes. This is because we are streaming, and want to decide once how to
+    process multiple batches.
+    """
+
+    funcs = _match_temporal_resolutions_levels(
+        input_data, companion_data, temporal_resolution,
+    )
+    return _levels_transform(funcs, isinstance(input_data.index, pd.MultiIndex))
+
+
+def _levels_transform(funcs, multi):
+    """Build the function updating an index from the functions for each level.
+    """
+    if multi:
         def transform(index):
             old_index = index.to_frame()
             return pd.MultiIndex.from_arrays(
@@ -163,16 +212,123 @@ def match_temporal_resolutions(input_data, companion_data, temporal_resolution=N
             )
 
         return transform
-    elif (isinstance(input_data.index, pd.DatetimeIndex)
-          and isinstance(companion_data.index, pd.DatetimeIndex)):
-        return match_column_temporal_resolutions(
-            input_data.index,
-            companion_data.index,
-            0,
-            temporal_resolution,
+    else:
+        return funcs[0]
+
+
+class KeyFilter(object):
+    """Semi-join filter, dropping the rows of the companion data that can't
+    match any row of the original data.
+
+    It is built once from the join keys of the original data (converted and
+    aligned to the common temporal resolution), and applied to the raw chunks
+    of companion data. The key columns are converted and checked one at a
+    time, the cheapest first, so that date parsing, spatial transforms and the
+    join only run on the candidate rows.
+
+    This can only be used for left and inner joins, since it drops the rows
+    that would only be in the output of a right or outer join.
+
+    :param index: The converted index of the original data
+    :param columns: The indices of the join columns in the companion data
+    :param columns_metadata: The metadata of the columns of the companion data
+    :param level_functions: The temporal alignment for each level, see
+        :func:`match_temporal_resolutions`
+    :param transforms: List of ``(columns, function)`` to run on the
+        companion data before the conversion, e.g. nearest-point spatial
+        transforms
+    :param positions: The positions of the join columns in the chunks, if
+        different from `columns` (when only some columns are read)
+    """
+    def __init__(self, index, columns, columns_metadata, level_functions,
+                 transforms=(), positions=None):
+        # Hash set of the values of each level
+        self.keys = [
+            index.get_level_values(i).unique()
+            for i in range(index.nlevels)
+        ]
+        self.columns = list(columns)
+        if positions is None:
+            self.positions = self.columns
+        else:
+            self.positions = list(positions)
+        self.names = [columns_metadata[col]['name'] for col in columns]
+        self.index_names = _index_names(len(self.columns))
+        self.conversions = []
+        for col_idx, align in zip(columns, level_functions):
+            convert = _index_conversion(columns_metadata[col_idx])
+            if convert is None:
+                self.conversions.append(align)
+            else:
+                self.conversions.append(
+                    lambda idx, convert=convert, align=align:
+                        align(convert(idx))
+                )
+        self.transforms = transforms
+        transformed = set(col for cols, _ in transforms for col in cols)
+        # Cheap levels first, then dates, then spatial levels (which need to
+        # go through the transforms)
+        self.order = sorted(
+            range(len(self.columns)),
+            key=lambda i: (
+                self.positions[i] in transformed,
+                types.DATE_TIME in (
+                    columns_metadata[self.columns[i]]['semantic_types']
+                ),
+            ),
+        )
+        self.nb_transformed = sum(
+            1 for col in self.positions if col in transformed
         )
 
-    return lambda idx: idx  # no-op
+    def _filter(self, data, values, level):
+        mask = values.isin(self.keys[level])
+        if mask.all():
+            return data, None
+        return data[mask], mask
+
+    def filter_index(self, data):
+        """Filter a chunk that has already been converted and indexed.
+        """
+        mask = np.ones(len(data), dtype=bool)
+        for i in self.order:
+            mask &= data.index.get_level_values(i).isin(self.keys[i])
+        PROM_JOIN_ROWS_SCANNED.inc(len(data))
+        PROM_JOIN_ROWS_KEPT.inc(int(mask.sum()))
+        if mask.all():
+            return data
+        return data[mask]
+
+    def apply(self, data):
+        """Filter a raw chunk and index it on its converted join keys.
+
+        This gives the same result as running the transforms,
+        :func:`set_data_index` with ``drop=True`` and the temporal alignment,
+        minus the rows that can't match.
+        """
+        PROM_JOIN_ROWS_SCANNED.inc(len(data))
+        values = [None] * len(self.columns)
+        for step, i in enumerate(self.order):
+            if step == len(self.order) - self.nb_transformed:
+                # Only the levels that need the transforms are left
+                data = data.copy()
+                for cols, transform in self.transforms:
+                    data.iloc[:, cols] = transform(data.iloc[:, cols])
+            # Name the levels the way set_data_index() does
+            values[i] = self.conversions[i](
+                pd.Index(data.iloc[:, self.positions[i]], name=self.index_names[i])
+            )
+            data, mask = self._filter(data, values[i], i)
+            if mask is not None:
+                values = [v if v is None else v[mask] for v in values]
+        PROM_JOIN_ROWS_KEPT.inc(len(data))
+
+        data = data.drop(self.names, axis=1)
+        if len(values) == 1:
+            data.index = values[0]
+        else:
+            data.index = pd.MultiIndex.from_arrays(values)
+        return data
 
 
 def match_column_temporal_resolutions(index_1, index_2, level,
@@ -193,12 +349,8 @@ def match_column_temporal_resolutions(index_1, index_2, level,
 
     # Use the provided resolution
     if temporal_resolution is not None:
-        key = temporal_aggregation_keys[temporal_resolution]
         logger.info("Temporal alignment: requested '%s'", temporal_resolution)
-        if isinstance(key, str):
-            return _transform_index(level, lambda idx: idx.strftime(key))
-        else:
-            return _transform_index(level, lambda idx: idx.map(key))
+        return _transform_index(level, _floor_index(temporal_resolution))
     else:
         # Pick the more coarse of the two resolutions
         resolution_1 = get_temporal_resolution(index_1[~index_1.isna()])
@@ -212,11 +364,7 @@ def match_column_temporal_resolutions(index_1, index_2, level,
                 resolution_1,
                 col,
             )
-            key = temporal_aggregation_keys[resolution_1]
-            if isinstance(key, str):
-                return _transform_index(level, lambda idx: idx.strftime(key))
-            else:
-                return _transform_index(level, lambda idx: idx.map(key))
+            return _transform_index(level, _floor_index(resolution_1))
         else:
             # Change resolution of first index to the second's
             logger.info(
@@ -224,11 +372,19 @@ def match_column_temporal_resolutions(index_1, index_2, level,
                 resolution_2,
                 col,
             )
-            key = temporal_aggregation_keys[resolution_2]
-            if isinstance(key, str):
-                return _transform_index(level, lambda idx: idx.strftime(key))
-            else:
-                return _transform_index(level, lambda idx: idx.map(key))
+            return _transform_index(level, _floor_index(resolution_2))
+
+
+def _floor_index(resolution):
+    """Get a function that floors an index of datetimes to a resolution.
+    """
+    def func(index):
+        return pd.DatetimeIndex(
+            floor_datetimes(to_datetime64(index), resolution)
+            .astype('datetime64[ns]')
+        )
+
+    return func
 
 
 def _first(series):
@@ -257,33 +413,32 @@ AGGREGATION_FUNCTIONS = {
 }
 
 
-def perform_aggregations(
-    data, original_columns,
-    agg_functions=None, augment_columns_name=None,
-):
-    """Performs group by on dataset after join, to keep the shape of the
-    new, augmented dataset the same as the original, input data.
-    """
+def _is_numeric(dtype):
+    return 'int' in str(dtype) or 'float' in str(dtype)
 
-    col_indices = {
-        col: idx for idx, col in enumerate(data.columns)
+
+def _provided_aggregations(agg_functions, augment_columns_name):
+    """Normalize the aggregation functions provided by the user.
+    """
+    if not agg_functions:
+        return None
+    return {
+        # Columns might have been renamed if conflicting, deal with that
+        augment_columns_name[col]:
+            # Turn single value into list
+            [funcs] if isinstance(funcs, str) else funcs
+        for col, funcs in agg_functions.items()
     }
 
-    start = time.perf_counter()
-    original_columns_set = set(original_columns)
-
-    provided_agg_functions = agg_functions
-    if provided_agg_functions:
-        provided_agg_functions = {
-            # Columns might have been renamed if conflicting, deal with that
-            augment_columns_name[col]:
-                # Turn single value into list
-                [funcs] if isinstance(funcs, str) else funcs
-            for col, funcs in provided_agg_functions.items()
-        }
 
+def _aggregation_names(dtypes, original_columns_set, provided_agg_functions):
+    """Get the names of the aggregation functions to apply to each column.
+
+    :param dtypes: The data types of the joined data, as a Series indexed by
+        column name
+    """
     agg_functions = dict()
-    for column in data.columns:
+    for column, dtype in dtypes.items():
         if column == UNIQUE_INDEX_KEY or column in original_columns_set:
             # Just pick the first value
             # (they are all the same, from a single row in the original data)
@@ -299,12 +454,40 @@ def perform_aggregations(
                     else funcs
                 )
         else:
-            if ('int' in str(data.dtypes[column]) or
-                    'float' in str(data.dtypes[column])):
+            if _is_numeric(dtype):
                 agg_functions[column] = ['mean', 'sum', 'max', 'min']
             else:
                 # Just pick the first value
                 agg_functions[column] = ['first']
+    return agg_functions
+
+
+def _aggregated_name(column, func, nb_funcs):
+    if func == 'first' and nb_funcs <= 1:
+        return column
+    else:
+        return ' '.join((func, column)).strip()
+
+
+def perform_aggregations(
+    data, original_columns,
+    agg_functions=None, augment_columns_name=None,
+):
+    """Performs group by on dataset after join, to keep the shape of the
+    new, augmented dataset the same as the original, input data.
+    """
+
+    col_indices = {
+        col: idx for idx, col in enumerate(data.columns)
+    }
+
+    start = time.perf_counter()
+
+    agg_functions = _aggregation_names(
+        data.dtypes,
+        set(original_columns),
+        _provided_aggregations(agg_functions, augment_columns_name),
+    )
 
     # Resolve names into functions using AGGREGATION_FUNCTIONS map
     agg_functions = {
@@ -327,8 +510,7 @@ def perform_aggregations(
 
     # Rename columns
     data.columns = [
-        col[0] if col[1] == 'first' and len(agg_functions[col[0]]) <= 1
-        else ' '.join(col[::-1]).strip()
+        _aggregated_name(col[0], col[1], len(agg_functions[col[0]]))
         for col in data.columns
     ]
 
@@ -336,6 +518,171 @@ def perform_aggregations(
     return data
 
 
+def _combine_partials(previous, partial, reduce):
+    """Combine the partial aggregates of a chunk with the previous ones.
+
+    Only the columns that are in both are kept, columns can be missing if they
+    stopped being numerical or could not be aggregated.
+    """
+    if previous is None:
+        return partial
+    columns = [col for col in partial.columns if col in previous.columns]
+    combined = pd.concat([previous[columns], partial[columns]])
+    return reduce(combined.groupby(level=0))
+
+
+class StreamingAggregation(object):
+    """Performs the aggregations of :func:`perform_aggregations` on a join
+    computed in chunks.
+
+    Each chunk of the join is reduced right away to partial aggregates for
+    each row of the original data (first row, sum, count, minimum and maximum
+    of the values), which are combined with those of the previous chunks.
+    Memory use is then bounded by the size of the original data rather than
+    that of the join, which can be as large as the companion dataset.
+
+    :param original_data: If provided, the chunks only need the unique index
+        column and the companion columns, and the columns of the original
+        data are taken from this instead
+    """
+    def __init__(self, original_columns,
+                 agg_functions=None, augment_columns_name=None,
+                 original_data=None):
+        self.original_columns_set = set(original_columns)
+        self.original_data = original_data
+        self.provided_agg_functions = _provided_aggregations(
+            agg_functions, augment_columns_name,
+        )
+        self._first = None
+        self._count = None
+        self._sum = None
+        self._min = None
+        self._max = None
+        # Columns that have been numerical in every chunk so far
+        self._numeric = None
+
+    def _wants(self, column, funcs):
+        provided = self.provided_agg_functions
+        return (
+            provided is not None and
+            any(func in funcs for func in provided.get(column, ()))
+        )
+
+    def update(self, chunk):
+        """Add a chunk of the join.
+        """
+        keys = chunk[UNIQUE_INDEX_KEY]
+        if keys.hasnans:
+            # Rows that are only in the companion data, grouping drops those
+            chunk = chunk[keys.notna()]
+            keys = chunk[UNIQUE_INDEX_KEY]
+
+        columns = [
+            col for col in chunk.columns
+            if col != UNIQUE_INDEX_KEY and col not in self.original_columns_set
+        ]
+        numeric = set(
+            col for col in columns if _is_numeric(chunk.dtypes[col])
+        )
+        if self._numeric is None:
+            self._numeric = numeric
+        else:
+            self._numeric &= numeric
+        numeric = [col for col in columns if col in self._numeric]
+        minmax = [
+            col for col in columns
+            if col in self._numeric or self._wants(col, ('min', 'max'))
+        ]
+
+        # First row for each key, the previous chunks come first
+        # Concatenating every chunk also gives the columns the same types as
+        # concatenating the whole join would
+        first = chunk[~keys.duplicated()].set_index(UNIQUE_INDEX_KEY)
+        if self._first is None:
+            self._first = first
+        else:
+            first = pd.concat([self._first, first])
+            self._first = first[~first.index.duplicated()]
+
+        grouped = chunk.groupby(UNIQUE_INDEX_KEY)
+        self._count = _combine_partials(
+            self._count, grouped[columns].count(),
+            lambda g: g.sum(),
+        )
+        self._sum = _combine_partials(
+            self._sum, grouped[numeric].sum(min_count=1),
+            lambda g: g.sum(min_count=1),
+        )
+        self._min = _combine_partials(
+            self._min, grouped[minmax].min(),
+            lambda g: g.min(),
+        )
+        self._max = _combine_partials(
+            self._max, grouped[minmax].max(),
+            lambda g: g.max(),
+        )
+
+    def result(self):
+        """Combine the partial aggregates into the aggregated data.
+
+        This has the same rows and columns as :func:`perform_aggregations`,
+        without the unique index column.
+        """
+        start = time.perf_counter()
+        first = self._first.sort_index()
+        if self.original_data is not None:
+            original = self.original_data.set_index(UNIQUE_INDEX_KEY)
+            first = pd.concat([original.reindex(first.index), first], axis=1)
+        agg_functions = _aggregation_names(
+            first.dtypes,
+            self.original_columns_set,
+            self.provided_agg_functions,
+        )
+
+        names = []
+        values = []
+        for column in first.columns:
+            funcs = agg_functions.get(column)
+            if not funcs:
+                continue
+            for func in funcs:
+                try:
+                    if func == 'first':
+                        value = first[column]
+                    elif func == 'count':
+                        value = self._count[column]
+                    elif func == 'sum':
+                        value = self._sum[column]
+                    elif func == 'mean':
+                        value = self._sum[column] / self._count[column]
+                    elif func == 'min':
+                        value = self._min[column]
+                    elif func == 'max':
+                        value = self._max[column]
+                    else:
+                        raise AugmentationError(
+                            "Unknown aggregation function %r" % func
+                        )
+                except KeyError:
+                    # Partial aggregates were dropped (or not computed)
+                    # because the values are not numerical or not comparable
+                    raise AugmentationError(
+                        "Can't compute the %s of column %r" % (func, column)
+                    )
+                names.append(_aggregated_name(column, func, len(funcs)))
+                values.append(value.reindex(first.index))
+
+        data = pd.concat(values, axis=1)
+        data.columns = names
+        data.reset_index(drop=True, inplace=True)
+
+        logger.info(
+            "Aggregations completed in %.4fs",
+            time.perf_counter() - start,
+        )
+        return data
+
+
 CHUNK_SIZE_ROWS = 10000
 
 
@@ -370,6 +717,60 @@ def _tree_nearest(tree, max_dist):
     return transform
 
 
+def _hash_join_chunk(hash_index, original_keys, augment_data, left_columns,
+                     rsuffix='_r'):
+    """Join a chunk of companion data using a :class:`HashJoinIndex`.
+
+    Only the unique index is gathered from the original data, the other
+    columns are added back after the aggregation.
+
+    :param original_keys: The unique index column of the original data, as an
+        array
+    :param left_columns: The names of the columns of the original data, to
+        rename conflicting columns like ``DataFrame.join()`` does
+    """
+    left, right = hash_index.indexers(augment_data.index)
+    augment_data = augment_data.reset_index(drop=True)
+    if (right < 0).any():
+        # Missing rows are filled with NaN, changing the types like a pandas
+        # join would
+        augment_data = augment_data.reindex(right)
+    else:
+        augment_data = augment_data.take(right)
+    augment_data.reset_index(drop=True, inplace=True)
+    augment_data.columns = [
+        col + rsuffix if col in left_columns else col
+        for col in augment_data.columns
+    ]
+    augment_data.insert(0, UNIQUE_INDEX_KEY, original_keys[left])
+    return augment_data
+
+
+def _read_dtypes(columns_metadata, usecols=None):
+    """Get the types to read columns as, from their metadata.
+
+    Only text columns are given a type (``str``), so pandas doesn't guess
+    another one for chunks that happen to only contain numbers or nothing.
+    Booleans are left for pandas to parse. Numerical columns can have
+    unclean values or missing values (that don't fit in an integer column),
+    so they are still inferred.
+    """
+    dtypes = {}
+    for i, column in enumerate(columns_metadata):
+        if usecols is not None and i not in usecols:
+            continue
+        if (
+            column['structural_type'] == types.TEXT and
+            types.BOOLEAN not in column['semantic_types']
+        ):
+            dtypes[column['name']] = str
+    return dtypes
+
+
+#: Join engines, see :func:`join`
+JOIN_ENGINES = ('pandas', 'hash')
+
+
 KEEP_COLUMN_FIELDS = {'name', 'structural_type', 'semantic_types'}
 
 
@@ -379,6 +780,7 @@ def join(
     left_columns, right_columns,
     how='left', columns=None,
     agg_functions=None, temporal_resolution=None,
+    engine='pandas',
 ):
     """
     Performs a join between original_data (pandas.DataFrame or path to CSV)
@@ -386,9 +788,21 @@ def join(
 
     The result is written to the writer object.
 
+    The join of each chunk is done by pandas (``engine='pandas'``) or with a
+    hash table of the factorized keys of the original data
+    (``engine='hash'``), which is faster for composite keys but only supports
+    left and inner joins. Both give the same result.
+
     Returns the metadata for the result.
     """
 
+    if engine not in JOIN_ENGINES:
+        raise ValueError("Unknown join engine %r" % engine)
+    if engine == 'hash' and how not in ('left', 'inner'):
+        raise AugmentationError(
+            "The hash join engine only supports left and inner joins"
+        )
+
     if isinstance(original_data, pd.DataFrame):
         pass
     elif hasattr(original_data, 'read'):
@@ -404,8 +818,6 @@ def join(
             "%r" % type(original_data)
         )
 
-    augment_data_columns = [col['name'] for col in augment_metadata['columns']]
-
     # only converting data types for columns involved in augmentation
     original_join_columns_idx = []
     augment_join_columns_idx = []
@@ -464,10 +876,27 @@ def join(
 
     logger.info("Performing join...")
 
+    # Only read the join columns and the requested columns
+    usecols = None
+    augment_join_columns_pos = augment_join_columns_idx
+    if columns:
+        usecols = sorted(set(columns) | set(augment_join_columns_idx))
+        positions = {col: pos for pos, col in enumerate(usecols)}
+        augment_join_columns_pos = [
+            positions[col] for col in augment_join_columns_idx
+        ]
+        augment_columns_transform = [
+            ([positions[col] for col in cols], transform)
+            for cols, transform in augment_columns_transform
+        ]
+        logger.info("Reading columns %r of augmentation data", usecols)
+
     # Stream the data in
     augment_data_chunks = pd.read_csv(
         augment_data_path,
         error_bad_lines=False,
+        usecols=usecols,
+        dtype=_read_dtypes(augment_metadata['columns'], usecols),
         chunksize=CHUNK_SIZE_ROWS,
     )
     try:
@@ -475,101 +904,123 @@ def join(
     except StopIteration:
         raise AugmentationError("Empty augmentation data")
 
-    # Columns to drop
-    drop_columns = None
-    if columns:
-        drop_columns = list(
-            # Drop all the columns in augment_data
-            set(augment_data_columns[c] for c in columns)
-            # except
-            - (
-                # the requested columns
-                set(columns)
-                # and the join columns
-                | {col[0] for col in right_columns}
-            )
-        )
-
     # Defer temporal alignment until reading the first block from companion
     # (and converting it to the right data types!)
     update_idx = None
     original_data_res = None
 
+    intersection = set(original_data.columns).intersection(set(first_augment_data.columns))
+
+    # map column names for the augmentation data
+    augment_columns_map = {
+        name: name + '_r' if name in intersection else name
+        for name in first_augment_data.columns
+    }
+
+    # Aggregate as we go, so we never hold more than a chunk of the join
+    aggregation = StreamingAggregation(
+        list(original_data.columns),
+        agg_functions,
+        augment_columns_map,
+        # The hash join only gathers the unique index from the original data
+        original_data=original_data if engine == 'hash' else None,
+    )
+
+    # Hash table of the keys of the original data, set up with the first
+    # chunk (after temporal alignment)
+    hash_index = None
+    original_columns_set = set(original_data.columns)
+
+    # Filter on the keys of the original data, set up with the first chunk
+    key_filter = None
+
     # Streaming join
     start = time.perf_counter()
-    join_ = []
     # Iterate over chunks of augment data
     for augment_data in itertools.chain(
             [first_augment_data], augment_data_chunks
     ):
-        # Run transforms
-        for cols, transform in augment_columns_transform:
-            augment_data.iloc[:, cols] = transform(augment_data.iloc[:, cols])
-
-        # Convert data types
-        augment_data = set_data_index(
-            augment_data,
-            augment_join_columns_idx,
-            augment_metadata['columns'],
-            drop=True,  # Drop the join columns on that side (avoid duplicates)
-        )
+        if key_filter is not None:
+            # Drop the rows that can't match while converting data types
+            augment_data = key_filter.apply(augment_data)
+        else:
+            # Run transforms
+            for cols, transform in augment_columns_transform:
+                augment_data.iloc[:, cols] = transform(augment_data.iloc[:, cols])
 
-        if update_idx is None:
-            # Guess temporal resolutions (on first chunk)
-            update_idx = match_temporal_resolutions(
-                original_data,
+            # Convert data types
+            augment_data = set_data_index(
                 augment_data,
-                temporal_resolution,
-            )
-            original_data_res = original_data.set_index(
-                update_idx(original_data.index)
+                augment_join_columns_idx,
+                augment_metadata['columns'],
+                drop=True,  # Drop the join columns on that side (avoid duplicates)
             )
 
-        # Match temporal resolutions
-        augment_data.index = update_idx(augment_data.index)
+            if update_idx is None:
+                # Guess temporal resolutions (on first chunk)
+                level_functions = _match_temporal_resolutions_levels(
+                    original_data,
+                    augment_data,
+                    temporal_resolution,
+                )
+                update_idx = _levels_transform(
+                    level_functions,
+                    isinstance(original_data.index, pd.MultiIndex),
+                )
+                original_data_res = original_data.set_index(
+                    update_idx(original_data.index)
+                )
+
+                if engine == 'hash':
+                    hash_index = HashJoinIndex(original_data_res.index, how)
+
+                # Rows of companion data that don't match don't make it to
+                # the result of left and inner joins, filter them early
+                if how in ('left', 'inner'):
+                    key_filter = KeyFilter(
+                        original_data_res.index,
+                        augment_join_columns_idx,
+                        augment_metadata['columns'],
+                        level_functions,
+                        augment_columns_transform,
+                        augment_join_columns_pos,
+                    )
 
-        # Filter columns
-        if drop_columns:
-            augment_data = augment_data.drop(drop_columns, axis=1)
+            # Match temporal resolutions
+            augment_data.index = update_idx(augment_data.index)
+
+            if key_filter is not None:
+                augment_data = key_filter.filter_index(augment_data)
 
         # Join
-        joined_chunk = original_data_res.join(
-            augment_data,
-            how=how,
-            rsuffix='_r'
-        )
+        if hash_index is not None:
+            joined_chunk = _hash_join_chunk(
+                hash_index,
+                original_data_res[UNIQUE_INDEX_KEY].values,
+                augment_data,
+                original_columns_set,
+            )
+        else:
+            joined_chunk = original_data_res.join(
+                augment_data,
+                how=how,
+                rsuffix='_r'
+            )
 
-        # Drop the join columns we set as index
-        joined_chunk.reset_index(drop=True, inplace=True)
+            # Drop the join columns we set as index
+            joined_chunk.reset_index(drop=True, inplace=True)
 
-        join_.append(joined_chunk)
+        aggregation.update(joined_chunk)
+        del joined_chunk
 
-    join_ = pd.concat(join_)
     logger.info("Join completed in %.4fs", time.perf_counter() - start)
 
-    intersection = set(original_data.columns).intersection(set(first_augment_data.columns))
-
     # qualities
     qualities_list = []
 
-    # map column names for the augmentation data
-    augment_columns_map = {
-        name: name + '_r' if name in intersection else name
-        for name in first_augment_data.columns
-    }
+    # aggregations (without the unique index)
+    join_ = aggregation.result()
 
-    # aggregations
-    join_ = perform_aggregations(
-        join_,
-        list(original_data.columns),
-        agg_functions,
-        augment_columns_map,
-    )
-
-    # drop unique index
-    join_.drop([UNIQUE_INDEX_KEY], axis=1, inplace=True)
-
-    original_columns_set = set(original_data.columns)
     new_columns = [
         col for col in join_.columns if col not in original_columns_set
     ]
@@ -624,6 +1075,163 @@ def join(
     }
 
 
+# Size hint of the blocks of lines read by union(), in characters
+UNION_BLOCK_SIZE = 1 << 20
+
+
+@contextlib.contextmanager
+def _open_csv_text(path_or_file):
+    """Open CSV data as text, from a path or a binary file object.
+    """
+    if hasattr(path_or_file, 'read'):
+        fin = io.TextIOWrapper(path_or_file, encoding='utf-8', newline='')
+        try:
+            yield fin
+        finally:
+            # Don't close the caller's file
+            fin.detach()
+    else:
+        with open(path_or_file, encoding='utf-8', newline='') as fin:
+            yield fin
+
+
+def _union_copy_block(lines, nb_columns):
+    """Get a block of CSV lines as ``csv.writer`` would write them again.
+
+    This only works for simple lines (no quotes, the right number of fields,
+    ``\\n`` or ``\\r\\n`` line endings), otherwise returns None and the lines
+    need to be parsed.
+    """
+    block = ''.join(lines)
+    if '"' in block:
+        return None
+    separators = nb_columns - 1
+    if not all(line.count(',') == separators for line in lines):
+        return None
+    crlf = '\r' in block
+    if not block.endswith('\n'):
+        # Last line of the file, without a line ending
+        block += '\r\n' if crlf else '\n'
+    if not crlf:
+        return block.replace('\n', '\r\n')
+    elif block.count('\r') == block.count('\n') == block.count('\r\n'):
+        return block
+    else:
+        return None
+
+
+def _union_clean_rows(rows, nb_columns, parsed):
+    """Skip blank and bad lines and pad short rows, like pandas does.
+
+    :param parsed: Whether the rows come from ``csv.reader``, in which case a
+        single empty field is a quoted empty string and not a blank line
+    """
+    cleaned = []
+    for row in rows:
+        nb_fields = len(row)
+        if nb_fields > nb_columns:
+            # Bad line, skipped
+            continue
+        elif nb_fields == 0 or (
+            nb_fields == 1 and not row[0].strip() and
+            not (parsed and row[0] == '')
+        ):
+            # Blank line, skipped
+            continue
+        row.extend([''] * (nb_columns - nb_fields))
+        cleaned.append(row)
+    return cleaned
+
+
+def _union_rows(fin, fout, nb_columns, positions,
+                d3m_column=None, d3m_index=0):
+    """Stream the rows of companion data to the result of a union.
+
+    If the columns line up with the original data, blocks of simple lines are
+    copied as-is. Otherwise, the fields are shuffled into the order of the
+    original data, splitting lines on commas when there are no quotes and
+    using the csv module if there are. The result is the same as reading with
+    pandas (``dtype=str``, ``na_filter=False``, ``error_bad_lines=False``)
+    and writing with ``to_csv()``.
+
+    :param fin: The companion data, a text file positioned after the header
+    :param fout: Output file
+    :param nb_columns: The number of columns of the companion data
+    :param positions: For each column of the original data, the position of
+        the companion column to use, or None to leave it empty
+    :param d3m_column: The position of the d3mIndex column to generate, if any
+    :param d3m_index: The first d3mIndex value to generate
+    :return: The number of rows written
+    """
+    copy = (
+        d3m_column is None and
+        nb_columns > 1 and
+        positions == list(range(nb_columns))
+    )
+    # Missing columns take an empty field, and the d3mIndex a generated
+    # value, both added at the end of the rows
+    positions = [nb_columns if pos is None else pos for pos in positions]
+    if d3m_column is not None:
+        positions[d3m_column] = nb_columns + 1
+    if len(positions) == 1:
+        position, = positions
+        shuffle = lambda row: (row[position],)
+    else:
+        shuffle = operator.itemgetter(*positions)
+
+    nb_rows = 0
+    while True:
+        lines = fin.readlines(UNION_BLOCK_SIZE)
+        if not lines:
+            break
+
+        if copy:
+            block = _union_copy_block(lines, nb_columns)
+            if block is not None:
+                fout.write(block)
+                nb_rows += len(lines)
+                continue
+
+        parsed = any('"' in line for line in lines)
+        if parsed:
+            # Parse the lines (a quoted field might continue past the block)
+            reader = csv.reader(itertools.chain(lines, fin))
+            rows = []
+            for row in reader:
+                rows.append(row)
+                if reader.line_num >= len(lines):
+                    break
+        else:
+            rows = [line.rstrip('\r\n').split(',') for line in lines]
+        if not (
+            nb_columns > 1 and
+            all(len(row) == nb_columns for row in rows)
+        ):
+            rows = _union_clean_rows(rows, nb_columns, parsed)
+
+        if d3m_column is not None:
+            for i, row in enumerate(rows, d3m_index + nb_rows):
+                row.append('')
+                row.append(str(i))
+        elif nb_columns in positions:
+            for row in rows:
+                row.append('')
+
+        if parsed or len(positions) == 1:
+            buf = io.StringIO()
+            csv.writer(buf, lineterminator='\r\n').writerows(
+                map(shuffle, rows),
+            )
+            fout.write(buf.getvalue())
+        elif rows:
+            # No field needs quoting
+            fout.write(
+                '\r\n'.join(map(','.join, map(shuffle, rows))) + '\r\n'
+            )
+        nb_rows += len(rows)
+    return nb_rows
+
+
 def union(original_data, augment_data_path, original_metadata, augment_metadata,
           writer,
           left_columns, right_columns):
@@ -669,16 +1277,35 @@ def union(original_data, augment_data_path, original_metadata, augment_metadata,
         rename[augment_data_columns[right[0]]] = \
             first_original_data.columns[left[0]]
 
-    # Missing columns will be created as NaN
-    missing_columns = list(
-        set(first_original_data.columns) - set(augment_data_columns)
-    )
-
     # Sequential d3mIndex if needed, picking up from the last value
     # FIXME: Generated d3mIndex might collide with other splits?
     d3m_index = None
+    d3m_column = None
     if 'd3mIndex' in first_original_data.columns:
-        d3m_index = int(first_original_data['d3mIndex'].max()) + 1
+        d3m_index = int(
+            pd.to_numeric(first_original_data['d3mIndex']).max()
+        ) + 1
+        d3m_column = list(first_original_data.columns).index('d3mIndex')
+
+    # Position of the companion column for each column of the output
+    augment_positions = {}
+    for i, name in enumerate(augment_data_columns):
+        augment_positions.setdefault(rename.get(name, name), i)
+    if d3m_index is not None:
+        augment_positions.pop('d3mIndex', None)
+    positions = [
+        augment_positions.get(name)
+        for name in first_original_data.columns
+    ]
+
+    # Missing columns will be left empty
+    missing_columns = [
+        name
+        for i, (name, pos) in enumerate(
+            zip(first_original_data.columns, positions)
+        )
+        if pos is None and i != d3m_column
+    ]
 
     logger.info("renaming: %r, missing_columns: %r", rename, missing_columns)
 
@@ -700,46 +1327,26 @@ def union(original_data, augment_data_path, original_metadata, augment_metadata,
             if d3m_index is not None:
                 d3m_index = max(
                     d3m_index,
-                    int(chunk['d3mIndex'].max()) + 1,
+                    int(pd.to_numeric(chunk['d3mIndex']).max()) + 1,
                 )
 
-        total_rows = orig_rows
-
-        # Iterate on chunks of augment data
-        augment_data_chunks = pd.read_csv(
-            augment_data_path,
-            error_bad_lines=False,
-            dtype=str,
-            na_filter=False,
-            chunksize=CHUNK_SIZE_ROWS,
-        )
-        for augment_data in augment_data_chunks:
-            # Rename columns to match
-            augment_data = augment_data.rename(columns=rename)
-
-            # Add d3mIndex if needed
-            if d3m_index is not None:
-                augment_data['d3mIndex'] = np.arange(
-                    d3m_index,
-                    d3m_index + len(augment_data),
+        # Stream augment data, without building DataFrames
+        with _open_csv_text(augment_data_path) as fin:
+            header = next(
+                (row for row in csv.reader(fin) if row),
+                [],
+            )
+            if len(header) != len(augment_data_columns):
+                raise AugmentationError(
+                    "Companion data has %d columns, metadata has %d" % (
+                        len(header), len(augment_data_columns),
+                    )
                 )
-                d3m_index += len(augment_data)
-
-            # Add empty column for the missing ones
-            for name in missing_columns:
-                augment_data[name] = np.nan
-
-            # Reorder columns
-            augment_data = augment_data[first_original_data.columns]
-
-            # Add to CSV output
-            augment_data.to_csv(
-                fout,
-                header=False,
-                index=False,
-                line_terminator='\r\n',
+            total_rows = orig_rows + _union_rows(
+                fin, fout,
+                len(augment_data_columns), positions,
+                d3m_column, d3m_index,
             )
-            total_rows += len(augment_data)
 
         size = fout.size
     logger.info("Union completed in %.4fs", time.perf_counter() - start)
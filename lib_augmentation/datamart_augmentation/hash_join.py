@@ -0,0 +1,109 @@
+"""Hash join on factorized keys.
+
+The join keys of the original data are factorized once into integer codes,
+level by level, and the rows are grouped by code into a hash table. Each
+chunk of companion data is then factorized against the same codes and probed
+with vectorized numpy operations, instead of building and joining pandas
+(Multi)Indexes for every chunk.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class HashJoinIndex(object):
+    """Hash table of the join keys of the original data.
+
+    :param index: The index of the original data (the join keys, converted),
+        an ``Index`` or a ``MultiIndex``
+    :param how: Type of join, ``'left'`` or ``'inner'``
+    """
+    def __init__(self, index, how='left'):
+        if how not in ('left', 'inner'):
+            raise ValueError("Unsupported join type %r" % how)
+        self.how = how
+        self.nb_rows = len(index)
+
+        # Distinct values of each level, in which codes are positions (this
+        # keeps NaN as a value, like pandas joins do)
+        self.uniques = []
+        # Distinct combinations of the codes of the levels so far, so codes
+        # stay dense (and don't overflow) however many levels there are
+        self.combinations = []
+        codes = None
+        for i in range(index.nlevels):
+            values = index.get_level_values(i)
+            uniques = values.unique()
+            self.uniques.append(uniques)
+            level_codes = uniques.get_indexer(values)
+            if codes is None:
+                codes = level_codes
+            else:
+                combined = codes * len(uniques) + level_codes
+                combinations = pd.Index(combined).unique()
+                self.combinations.append(combinations)
+                codes = combinations.get_indexer(combined)
+        if self.combinations:
+            self.nb_codes = len(self.combinations[-1])
+        else:
+            self.nb_codes = len(self.uniques[0])
+
+        # Rows of the original data for each code
+        self.order = np.argsort(codes, kind='stable')
+        self.counts = np.bincount(codes, minlength=self.nb_codes)
+        self.starts = np.cumsum(self.counts) - self.counts
+
+    def codes(self, index):
+        """Get the codes of the keys of companion data, -1 if not found.
+        """
+        codes = None
+        for i, uniques in enumerate(self.uniques):
+            level_codes = uniques.get_indexer(index.get_level_values(i))
+            if codes is None:
+                codes = level_codes
+            else:
+                combined = np.where(
+                    (codes >= 0) & (level_codes >= 0),
+                    codes * len(uniques) + level_codes,
+                    -1,
+                )
+                codes = self.combinations[i - 1].get_indexer(combined)
+        return codes
+
+    def indexers(self, index):
+        """Join companion data against the original data.
+
+        :param index: The index of the companion data
+        :return: A tuple ``(left, right)`` of arrays of row positions in the
+            original data and in the companion data; ``right`` is -1 for rows
+            of the original data without a match (left join). Rows are in the
+            order of the original data, and in the order of the companion
+            data within that. Pandas might order the rows differently, but
+            the rows for each row of the original data are in the same order
+            (which is what the aggregation depends on).
+        """
+        codes = self.codes(index)
+        right = np.flatnonzero(codes >= 0)
+        codes = codes[right]
+
+        # Expand each companion row into one row per matching original row
+        repeats = self.counts[codes]
+        right = np.repeat(right, repeats)
+        offsets = (
+            np.arange(len(right)) -
+            np.repeat(np.cumsum(repeats) - repeats, repeats)
+        )
+        left = self.order[np.repeat(self.starts[codes], repeats) + offsets]
+
+        if self.how == 'left':
+            unmatched = np.flatnonzero(
+                np.bincount(left, minlength=self.nb_rows) == 0
+            )
+            left = np.concatenate([left, unmatched])
+            right = np.concatenate([
+                right,
+                np.full(len(unmatched), -1, dtype=right.dtype),
+            ])
+
+        order = np.argsort(left, kind='stable')
+        return left[order], right[order]
@@ -9,6 +9,7 @@ os.chdir(os.path.abspath(os.path.dirname(__file__)))
 req = [
     'pandas',
     'numpy',
+    'prometheus_client',
     'datamart_materialize==0.8.1',
     'datamart_profiler==0.8.1',
 ]
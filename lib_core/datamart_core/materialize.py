@@ -2,6 +2,8 @@ import contextlib
 import csv
 import datamart_materialize
 from datetime import datetime
+import io
+import itertools
 import logging
 import os
 import prometheus_client
@@ -10,15 +12,15 @@ import zipfile
 
 from datamart_core.common import hash_json
 from datamart_core.fscache import cache_get_or_set
-from datamart_materialize.common import skip_rows
+from datamart_materialize.common import iter_skip_rows
 from datamart_materialize.excel import xlsx_to_csv
 from datamart_materialize.excel97 import xls_to_csv
-from datamart_materialize.pivot import pivot_table
+from datamart_materialize.pivot import iter_pivot_rows
 from datamart_materialize.spss import spss_to_csv
 from datamart_materialize.stata import stata_to_csv
-from datamart_materialize.tsv import tsv_to_csv
 from datamart_profiler import parse_date
-from datamart_profiler.core import count_garbage_rows
+from datamart_profiler.core import HEADER_CONSISTENT_ROWS, \
+    HEADER_MAX_GARBAGE, count_garbage_rows
 
 from .discovery import encode_dataset_id
 
@@ -194,6 +196,157 @@ def get_dataset(metadata, dataset_id, format='csv', format_options=None):
         yield cache_path
 
 
+#: Size of the beginning of the file read to detect its format
+DETECT_PREFIX_SIZE = 1 << 20  # 1 MB
+
+#: Number of lines we need to see to detect non-data rows and the header
+DETECT_MIN_LINES = HEADER_MAX_GARBAGE + HEADER_CONSISTENT_ROWS + 1
+
+#: Maximum size read to detect the format, if lines are very long
+DETECT_MAX_PREFIX_SIZE = 16 << 20  # 16 MB
+
+
+def _read_detect_prefix(fp):
+    """Read the beginning of a file, ending on a complete line.
+
+    This reads at least `DETECT_PREFIX_SIZE` bytes (or the whole file), and
+    more if that is not enough to get `DETECT_MIN_LINES` lines (up to
+    `DETECT_MAX_PREFIX_SIZE`).
+    """
+    prefix = fp.read(DETECT_PREFIX_SIZE)
+    eof = len(prefix) < DETECT_PREFIX_SIZE
+    while (
+        not eof and
+        len(prefix) < DETECT_MAX_PREFIX_SIZE and
+        prefix.count(b'\n') <= DETECT_MIN_LINES
+    ):
+        more = fp.read(DETECT_PREFIX_SIZE)
+        eof = len(more) < DETECT_PREFIX_SIZE
+        prefix += more
+    if not eof and b'\n' in prefix:
+        # Drop the last, possibly partial, line
+        prefix = prefix[:prefix.rindex(b'\n') + 1]
+    return prefix
+
+
+def _is_year(name, max_year=None):
+    if max_year is None:
+        max_year = datetime.utcnow().year + 2
+    if len(name) != 4:
+        return False
+    try:
+        return 1900 <= int(name) <= max_year
+    except ValueError:
+        return False
+
+
+def _detect_csv_conversions(prefix):
+    """Detect the conversions needed to turn a text file into clean CSV.
+
+    :param prefix: The beginning of the file, as bytes, ending on a line
+    :return: A tuple ``(separator, conversions, steps)`` where `conversions`
+        are the entries to add to ``materialize['convert']`` and `steps` are
+        functions transforming an iterable of rows, to be applied in order to
+        the file read with `separator` (see :func:`convert_csv_rows`).
+    """
+    conversions = []
+    steps = []
+
+    # Decode the prefix as the file would be read, stopping on invalid data
+    try:
+        prefix.decode('utf-8')
+        decode_error = None
+    except UnicodeDecodeError as error:
+        decode_error = error
+        prefix = prefix[:error.start]
+    text = io.TextIOWrapper(io.BytesIO(prefix), encoding='utf-8')
+
+    # Check for TSV file format
+    sniff_text = text.read(16384)
+    text.seek(0, 0)
+    try:
+        if decode_error is not None and len(sniff_text) < 16384:
+            raise decode_error
+        dialect = csv.Sniffer().sniff(sniff_text)
+    except Exception as error:  # csv.Error, UnicodeDecodeError
+        logger.warning("csv.Sniffer error: %s", error)
+        dialect = csv.get_dialect('excel')
+    separator = getattr(dialect, 'delimiter', ',')
+    if separator != ',':
+        logger.info("Detected separator is %r", separator)
+        conversions.append({
+            'identifier': 'tsv',
+            'separator': separator,
+        })
+
+    # Check for non-data rows at the top of the file
+    # This works on the rows, so it's the same whether the separator is
+    # converted first or not
+    rows = list(itertools.islice(
+        csv.reader(text, delimiter=separator),
+        DETECT_MIN_LINES,
+    ))
+    rows_text = io.StringIO()
+    csv.writer(rows_text).writerows(rows)
+    rows_text.seek(0, 0)
+    non_data_rows = count_garbage_rows(rows_text)
+    if non_data_rows > 0:
+        logger.info("Detected %d lines to skip", non_data_rows)
+        conversions.append({
+            'identifier': 'skip_rows',
+            'nb_rows': non_data_rows,
+        })
+        steps.append(
+            lambda rows: iter_skip_rows(rows, non_data_rows),
+        )
+        rows = rows[non_data_rows:]
+
+    # Check for pivoted temporal table
+    columns = rows[0] if rows else []
+    if len(columns) >= 3:
+        # Look for dates
+        non_dates = [
+            i for i, name in enumerate(columns)
+            if parse_date(name) is None
+        ]
+
+        # Look for years
+        non_years = [
+            i for i, name in enumerate(columns)
+            if not _is_year(name)
+        ]
+
+        # If there's enough matches, pivot
+        non_matches = min([non_dates, non_years], key=len)
+        if len(non_matches) <= max(2.0, 0.20 * len(columns)):
+            date_label = 'year' if non_matches is non_years else 'date'
+
+            logger.info("Detected pivoted table")
+            conversions.append({
+                'identifier': 'pivot',
+                'except_columns': non_matches,
+                'date_label': date_label,
+            })
+            steps.append(
+                lambda rows: iter_pivot_rows(rows, non_matches, date_label),
+            )
+
+    return separator, conversions, steps
+
+
+def convert_csv_rows(source_filename, dest_fileobj, separator, steps):
+    """Read a text file, transform its rows, and write them as CSV.
+
+    This applies the conversions detected by :func:`_detect_csv_conversions`
+    in a single pass, streaming.
+    """
+    with open(source_filename, 'r') as src_fp:
+        rows = csv.reader(src_fp, delimiter=separator)
+        for step in steps:
+            rows = step(rows)
+        csv.writer(dest_fileobj).writerows(rows)
+
+
 def detect_format_convert_to_csv(dataset_path, convert_dataset, materialize):
     """Detect supported formats and convert to CSV.
 
@@ -206,7 +359,9 @@ def detect_format_convert_to_csv(dataset_path, convert_dataset, materialize):
         conversions.
     """
     with open(dataset_path, 'rb') as fp:
-        magic = fp.read(16)
+        prefix = _read_detect_prefix(fp)
+    magic = prefix[:16]
+    converted = False
 
     # Check for Excel XLSX file format (2007+)
     if magic[:4] == b'PK\x03\x04':
@@ -222,6 +377,7 @@ def detect_format_convert_to_csv(dataset_path, convert_dataset, materialize):
 
                 # Update file
                 dataset_path = convert_dataset(xlsx_to_csv, dataset_path)
+                converted = True
 
     # Check for Excel XLS file format (1997-2003)
     if magic[:8] == b'\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1':
@@ -231,6 +387,7 @@ def detect_format_convert_to_csv(dataset_path, convert_dataset, materialize):
 
         # Update file
         dataset_path = convert_dataset(xls_to_csv, dataset_path)
+        converted = True
 
     # Check for Stata file format
     if magic[:11] == b'<stata_dta>' or magic[:4] in (
@@ -244,6 +401,7 @@ def detect_format_convert_to_csv(dataset_path, convert_dataset, materialize):
 
         # Update file
         dataset_path = convert_dataset(stata_to_csv, dataset_path)
+        converted = True
 
     # Check for SPSS file format
     if magic[:4] in (b'\xC1\xE2\xC3\xC9', b'$FL2', b'$FL3'):
@@ -253,90 +411,22 @@ def detect_format_convert_to_csv(dataset_path, convert_dataset, materialize):
 
         # Update file
         dataset_path = convert_dataset(spss_to_csv, dataset_path)
-
-    # Check for TSV file format
-    with open(dataset_path, 'r') as fp:
-        try:
-            dialect = csv.Sniffer().sniff(fp.read(16384))
-        except Exception as error:  # csv.Error, UnicodeDecodeError
-            logger.warning("csv.Sniffer error: %s", error)
-            dialect = csv.get_dialect('excel')
-    if getattr(dialect, 'delimiter', ',') != ',':
+        converted = True
+
+    # Detect the conversions to apply to the text file from its beginning,
+    # then apply all of them in a single pass
+    if converted:
+        with open(dataset_path, 'rb') as fp:
+            prefix = _read_detect_prefix(fp)
+    separator, conversions, steps = _detect_csv_conversions(prefix)
+    if conversions:
         # Update metadata
-        logger.info("Detected separator is %r", dialect.delimiter)
-        materialize.setdefault('convert', []).append({
-            'identifier': 'tsv',
-            'separator': dialect.delimiter,
-        })
+        materialize.setdefault('convert', []).extend(conversions)
 
         # Update file
         dataset_path = convert_dataset(
-            lambda s, d: tsv_to_csv(s, d, separator=dialect.delimiter),
+            lambda path, dst: convert_csv_rows(path, dst, separator, steps),
             dataset_path,
         )
 
-    # Check for non-data rows at the top of the file
-    with open(dataset_path, 'r') as fp:
-        non_data_rows = count_garbage_rows(fp)
-        if non_data_rows > 0:
-            # Update metadata
-            logger.info("Detected %d lines to skip", non_data_rows)
-            materialize.setdefault('convert', []).append({
-                'identifier': 'skip_rows',
-                'nb_rows': non_data_rows,
-            })
-
-            # Update file
-            dataset_path = convert_dataset(
-                lambda s, d: skip_rows(s, d, nb_rows=non_data_rows),
-                dataset_path,
-            )
-
-    # Check for pivoted temporal table
-    with open(dataset_path, 'r') as fp:
-        reader = csv.reader(fp)
-        try:
-            columns = next(iter(reader))
-        except StopIteration:
-            columns = []
-    if len(columns) >= 3:
-        # Look for dates
-        non_dates = [
-            i for i, name in enumerate(columns)
-            if parse_date(name) is None
-        ]
-
-        # Look for years
-        def is_year(name, max_year=datetime.utcnow().year + 2):
-            if len(name) != 4:
-                return False
-            try:
-                return 1900 <= int(name) <= max_year
-            except ValueError:
-                return False
-        non_years = [
-            i for i, name in enumerate(columns)
-            if not is_year(name)
-        ]
-
-        # If there's enough matches, pivot
-        non_matches = min([non_dates, non_years], key=len)
-        if len(non_matches) <= max(2.0, 0.20 * len(columns)):
-            date_label = 'year' if non_matches is non_years else 'date'
-
-            # Update metadata
-            logger.info("Detected pivoted table")
-            materialize.setdefault('convert', []).append({
-                'identifier': 'pivot',
-                'except_columns': non_matches,
-                'date_label': date_label,
-            })
-
-            # Update file
-            dataset_path = convert_dataset(
-                lambda path, dst: pivot_table(path, dst,
-                                              non_matches, date_label),
-                dataset_path,
-            )
-
     return dataset_path
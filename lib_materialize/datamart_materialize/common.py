@@ -3,23 +3,29 @@ import csv
 from datamart_materialize.utils import SimpleConverter
 
 
+def iter_skip_rows(rows, nb_rows):
+    """Skip the first rows of a table, given as an iterable of rows.
+    """
+    src = iter(rows)
+
+    # Skip rows
+    for i in range(nb_rows):
+        try:
+            next(src)
+        except StopIteration:
+            raise ValueError(
+                "Can't skip %d rows, table only has %d" % (nb_rows, i),
+            )
+
+    # Copy rest
+    yield from src
+
+
 def skip_rows(source_filename, dest_fileobj, nb_rows):
     with open(source_filename, 'r') as src_fp:
-        src = iter(csv.reader(src_fp))
+        src = csv.reader(src_fp)
         dst = csv.writer(dest_fileobj)
-
-        # Skip rows
-        for i in range(nb_rows):
-            try:
-                next(src)
-            except StopIteration:
-                raise ValueError(
-                    "Can't skip %d rows, table only has %d" % (nb_rows, i),
-                )
-
-        # Copy rest
-        for row in src:
-            dst.writerow(row)
+        dst.writerows(iter_skip_rows(src, nb_rows))
 
 
 class SkipRowsConverter(SimpleConverter):
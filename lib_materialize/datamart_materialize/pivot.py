@@ -6,37 +6,44 @@ from datamart_materialize.utils import SimpleConverter
 VALUE_COLUMN_LABEL = 'value'
 
 
+def iter_pivot_rows(rows, except_columns, date_label='date'):
+    """Pivot a table given as an iterable of rows, header first.
+    """
+    src = iter(rows)
+
+    # Read original columns, some are carried over
+    try:
+        orig_columns = next(src)
+    except StopIteration:
+        raise ValueError("Empty table")
+    carried_columns = [orig_columns[i] for i in except_columns]
+
+    # Generate new header
+    yield carried_columns + [date_label, VALUE_COLUMN_LABEL]
+
+    # Indexes of date columns
+    date_indexes = [
+        i for i in range(len(orig_columns))
+        if i not in except_columns
+    ]
+    dates = [
+        name for i, name in enumerate(orig_columns)
+        if i not in except_columns
+    ]
+
+    for row in src:
+        carried_values = [row[i] for i in except_columns]
+        for date, date_idx in zip(dates, date_indexes):
+            yield carried_values + [date, row[date_idx]]
+
+
 def pivot_table(
     source_filename, dest_fileobj, except_columns, date_label='date',
 ):
     with open(source_filename, 'r') as src_fp:
-        src = iter(csv.reader(src_fp))
+        src = csv.reader(src_fp)
         dst = csv.writer(dest_fileobj)
-
-        # Read original columns, some are carried over
-        try:
-            orig_columns = next(src)
-        except StopIteration:
-            raise ValueError("Empty table")
-        carried_columns = [orig_columns[i] for i in except_columns]
-
-        # Generate new header
-        dst.writerow(carried_columns + [date_label, VALUE_COLUMN_LABEL])
-
-        # Indexes of date columns
-        date_indexes = [
-            i for i in range(len(orig_columns))
-            if i not in except_columns
-        ]
-        dates = [
-            name for i, name in enumerate(orig_columns)
-            if i not in except_columns
-        ]
-
-        for row in src:
-            carried_values = [row[i] for i in except_columns]
-            for date, date_idx in zip(dates, date_indexes):
-                dst.writerow(carried_values + [date, row[date_idx]])
+        dst.writerows(iter_pivot_rows(src, except_columns, date_label))
 
 
 class PivotConverter(SimpleConverter):
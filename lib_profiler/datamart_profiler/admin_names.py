@@ -0,0 +1,203 @@
+"""Compact set of the names of administrative areas.
+
+Resolving the values of a text column with ``datamart_geo`` is one SQLite
+query per distinct value, which is slow for columns with many distinct values
+that are not place names (people, comments, URLs, ...). This keeps a Bloom
+filter of all the names in the ``datamart_geo`` database, which tells us
+quickly which values can't possibly be resolved.
+
+The filter is built once from the database and saved to a file, which is then
+memory-mapped: every process loading it (or forked from one that did) shares
+the same pages.
+"""
+
+import hashlib
+import logging
+import numpy
+import os
+import prometheus_client
+import sqlite3
+import tempfile
+import time
+
+from datamart_geo import normalize
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Number of bits in the filter per name, 10 gives about 1% false positives
+ADMIN_NAMES_BITS_PER_NAME = 10
+
+#: Number of hash functions
+ADMIN_NAMES_HASHES = 7
+
+
+PROM_ADMIN_NAMES_SKIPPED = prometheus_client.Counter(
+    'profile_admin_names_skipped',
+    "Columns for which administrative areas were not resolved because too " +
+    "few values are known names",
+)
+PROM_ADMIN_NAMES_SAVED_LOOKUPS = prometheus_client.Counter(
+    'profile_admin_names_saved_lookups',
+    "Values not looked up in the administrative areas database because " +
+    "they are not known names",
+)
+
+
+def _hash_positions(names, nb_bits):
+    """Get the bit positions of each name, as a ``(len(names), hashes)`` array.
+
+    Uses double hashing on a 128-bit BLAKE2 digest, which is stable across
+    processes (unlike ``hash()``).
+    """
+    digests = b''.join(
+        hashlib.blake2b(name.encode('utf-8'), digest_size=16).digest()
+        for name in names
+    )
+    hashes = numpy.frombuffer(digests, dtype='<u8').reshape(-1, 2)
+    steps = numpy.arange(ADMIN_NAMES_HASHES, dtype=numpy.uint64)
+    positions = hashes[:, 0:1] + steps * hashes[:, 1:2]  # wraps around
+    return positions % numpy.uint64(nb_bits)
+
+
+class AdminNameFilter(object):
+    """Bloom filter of normalized names.
+
+    :param bits: The filter, as an array of bytes (possibly memory-mapped)
+    """
+    def __init__(self, bits):
+        self.bits = bits
+
+    @classmethod
+    def build(cls, names, nb_names):
+        """Build the filter from an iterable of (normalized) names.
+        """
+        nb_bits = max(8, nb_names * ADMIN_NAMES_BITS_PER_NAME)
+        nb_bits += -nb_bits % 8
+        flags = numpy.zeros(nb_bits, dtype=bool)
+        names = iter(names)
+        while True:
+            chunk = [name for _, name in zip(range(100000), names)]
+            if not chunk:
+                break
+            flags[_hash_positions(chunk, nb_bits).ravel()] = True
+        return cls(numpy.packbits(flags))
+
+    def contains_many(self, values):
+        """Check which values might be names.
+
+        Values are normalized the same way ``datamart_geo`` does before
+        looking them up. There are no false negatives.
+
+        :return: A boolean array
+        """
+        if not len(values):
+            return numpy.zeros(0, dtype=bool)
+        positions = _hash_positions(
+            [normalize(value) for value in values],
+            len(self.bits) * 8,
+        )
+        found = self.bits[positions >> numpy.uint64(3)] & (
+            numpy.uint8(128) >> (positions & numpy.uint64(7)).astype(
+                numpy.uint8,
+            )
+        )
+        return found.all(axis=1)
+
+
+# Loaded filters, by datamart_geo data path
+_filters = {}
+
+
+def _database_signature(db_file):
+    stat = os.stat(db_file)
+    return '%d-%d' % (stat.st_size, int(stat.st_mtime))
+
+
+def _remove_stale_filters(cache_dir, filename):
+    """Remove the filters built for other versions of the database.
+    """
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if (
+            name.startswith('admin_names.') and name.endswith('.npy')
+            and path != filename
+        ):
+            logger.info("Removing old filter %s", path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # Removed by another process
+
+
+def load_admin_names(geo_data, cache_dir=None):
+    """Load or build the name filter for a ``GeoData`` object.
+
+    Once loaded, it is used by :func:`get_admin_names` for this data (in this
+    process and in processes forked from it).
+
+    :param geo_data: A :class:`datamart_profiler.geo_data.GeoData` object
+    :param cache_dir: Directory in which to save the filter so that other
+        processes can map it instead of building it again, replacing filters
+        built for previous versions of the data. If None, the filter is only
+        kept in memory.
+    """
+    data_path = geo_data.data_path
+    if data_path in _filters:
+        return _filters[data_path]
+
+    db_file = os.path.join(data_path, 'admins.sqlite3')
+    filename = None
+    if cache_dir is not None:
+        filename = os.path.join(
+            cache_dir,
+            'admin_names.%s.npy' % _database_signature(db_file),
+        )
+        if os.path.exists(filename):
+            logger.info("Loading administrative area names from %s", filename)
+            name_filter = AdminNameFilter(numpy.load(filename, mmap_mode='r'))
+            _filters[data_path] = name_filter
+            return name_filter
+
+    logger.info("Building filter of administrative area names")
+    start = time.perf_counter()
+    conn = sqlite3.connect(db_file)
+    try:
+        nb_names, = conn.execute(
+            'SELECT count(DISTINCT name) FROM names;',
+        ).fetchone()
+        name_filter = AdminNameFilter.build(
+            (name for name, in conn.execute('SELECT DISTINCT name FROM names;')),
+            nb_names,
+        )
+    finally:
+        conn.close()
+    logger.info(
+        "Built filter of %d names (%d bytes) in %.2fs",
+        nb_names, len(name_filter.bits), time.perf_counter() - start,
+    )
+
+    if filename is not None:
+        # Write to a temporary file then rename, in case other processes are
+        # doing the same
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.npy')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                numpy.save(fp, name_filter.bits)
+            os.rename(tmp, filename)
+        except Exception:
+            os.remove(tmp)
+            raise
+        _remove_stale_filters(cache_dir, filename)
+        name_filter = AdminNameFilter(numpy.load(filename, mmap_mode='r'))
+
+    _filters[data_path] = name_filter
+    return name_filter
+
+
+def get_admin_names(geo_data):
+    """Get the name filter for a ``GeoData`` object if it was loaded with
+    :func:`load_admin_names`, else None.
+    """
+    return _filters.get(getattr(geo_data, 'data_path', None))
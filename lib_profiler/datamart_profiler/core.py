@@ -2,9 +2,12 @@ import codecs
 import collections
 import contextlib
 import csv
+import ctypes
 from datetime import datetime
 import itertools
 import logging
+import multiprocessing
+import multiprocessing.sharedctypes
 import numpy
 import os
 import pandas
@@ -12,15 +15,21 @@ from pandas.errors import EmptyDataError
 import prometheus_client
 import string
 import time
-import random
 import re
 import warnings
 
+from .geo_data import GeoData
 from .numerical import mean_stddev, get_numerical_ranges
-from .profile_types import identify_types, determine_dataset_type
-from .spatial import LatLongColumn, nominatim_resolve_all, \
-    pair_latlong_columns, get_spatial_ranges, parse_wkt_column
+from .profile_types import identify_types, determine_dataset_type, \
+    ParsedColumn, to_str_array
+from .records import sample_records
+from .sketches import ColumnSketch
+from .spatial import LatLongColumn, address_prefilter, \
+    nominatim_resolve_all, pair_latlong_columns, get_spatial_ranges, \
+    parse_wkt_column
 from .temporal import get_temporal_resolution
+from .timings import StageTimings, get_overall_peak_memory, \
+    reset_peak_memory, timed
 from . import types
 
 
@@ -32,8 +41,37 @@ RANDOM_SEED = 89
 MAX_SIZE = 50000000  # 50 MB
 SAMPLE_ROWS = 20
 
+#: Number of rows used to estimate the memory size of a DataFrame
+DATAFRAME_SIZE_SAMPLE_ROWS = 1000
+
+#: Number of rows read at a time when sketching the full data
+FULL_SCAN_CHUNK_ROWS = 100000
+
+#: Minimum number of values (rows times columns) to process columns in
+#: parallel, below that starting the processes is not worth it
+PARALLEL_MIN_VALUES = 1000000
+
 MAX_UNCLEAN_ADDRESSES = 0.20  # 20%
 
+#: Estimated profiling throughput, used to limit the size of the data loaded
+#: when a time budget is given
+TIME_BUDGET_BYTES_PER_SECOND = 2000000  # 2 MB/s
+
+#: Size of the data that is always loaded, whatever the time budget
+TIME_BUDGET_MIN_SIZE = 1000000  # 1 MB
+
+#: Fraction of the time budget that has to be left for an optional stage to
+#: run. Types are always identified; then Lazo sketches and coverage have
+#: priority over plots, address resolution and the sample
+TIME_BUDGET_RESERVES = {
+    'full_scan': 0.5,
+    'lazo': 0.1,
+    'coverage': 0.1,
+    'plots': 0.25,
+    'nominatim': 0.25,
+    'sample': 0.25,
+}
+
 
 #: Maximum number of rows to discard at the top of the file
 HEADER_MAX_GARBAGE = 6
@@ -64,6 +102,14 @@ PROM_LAZO = prometheus_client.Histogram(
     'profile_lazo_seconds', "Profile time with Lazo, time",
     buckets=BUCKETS,
 )
+PROM_FULL_SCAN = prometheus_client.Histogram(
+    'profile_full_scan_seconds', "Profile time sketching the full data",
+    buckets=BUCKETS,
+)
+PROM_PEAK_MEMORY = prometheus_client.Histogram(
+    'profile_peak_memory_bytes', "Peak memory usage while profiling",
+    buckets=[float(1 << i) for i in range(26, 35)] + [float('inf')],
+)
 
 
 _re_word_split = re.compile(r'\W+')
@@ -164,6 +210,125 @@ def count_garbage_rows(file):
         file.seek(0, 0)
 
 
+@contextlib.contextmanager
+def _report_peak_memory():
+    """Report the peak memory usage of the process over a profiling run.
+
+    The peak is reset first if the system allows it, so that it doesn't
+    include previous runs. Memory used by worker processes is not included.
+    """
+    reset_peak_memory(forget=True)
+    yield
+    peak = get_overall_peak_memory()
+    if peak is not None:
+        PROM_PEAK_MEMORY.observe(peak)
+        logger.info("Peak memory usage: %.1f MB", peak / (1 << 20))
+
+
+class TimeBudget(object):
+    """Time left to profile a dataset, and the stages that were cut.
+
+    :param seconds: The time allowed for profiling, or None for no limit
+    """
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        if seconds is None:
+            self.deadline = None
+        else:
+            self.deadline = time.perf_counter() + seconds
+        self.skipped = []
+        self.approximated = []
+
+    def remaining(self):
+        if self.deadline is None:
+            return float('inf')
+        return self.deadline - time.perf_counter()
+
+    def allow(self, stage):
+        """Check whether there is enough time left to run an optional stage.
+
+        If there isn't, the stage is recorded as skipped.
+        """
+        if self.deadline is None:
+            return True
+        if self.remaining() > TIME_BUDGET_RESERVES[stage] * self.seconds:
+            return True
+        self.skip(stage)
+        return False
+
+    def skip(self, stage):
+        if stage not in self.skipped:
+            logger.warning("Time budget running out, skipping %s", stage)
+            self.skipped.append(stage)
+
+    def approximate(self, stage):
+        if stage not in self.approximated:
+            logger.warning("Time budget running out, approximating %s", stage)
+            self.approximated.append(stage)
+
+    def max_size(self, load_max_size):
+        """Limit the size of the data to load to what we have time for.
+        """
+        if self.seconds is None:
+            return load_max_size
+        return min(
+            load_max_size,
+            max(
+                TIME_BUDGET_MIN_SIZE,
+                int(self.seconds * TIME_BUDGET_BYTES_PER_SECOND),
+            ),
+        )
+
+
+def _column_to_str(column):
+    """Convert a column to strings, with a single object per distinct value.
+    """
+    if column.dtype == object:
+        # Factorizing objects uses Python equality, which would merge values
+        # such as True, 1, and 1.0, so convert to strings first
+        # Do fillna() before converting to work around bug
+        # https://github.com/pandas-dev/pandas/issues/25353 (nan as str 'nan')
+        codes, uniques = pandas.factorize(column.fillna('').astype(str))
+        return numpy.asarray(uniques, dtype=object)[codes]
+    try:
+        codes, uniques = pandas.factorize(column)
+    except TypeError:  # Unhashable values
+        # Change to object dtype first and do fillna() to work around bug
+        # https://github.com/pandas-dev/pandas/issues/25353 (nan as str 'nan')
+        return column.astype(object).fillna('').astype(str).values
+    # Missing values are not in uniques, they get an empty string below
+    strings = numpy.empty(len(uniques) + 1, dtype=object)
+    strings[:-1] = to_str_array(uniques)
+    strings[-1] = ''  # Missing values have code -1
+    return strings[codes]
+
+
+def _column_str_list(data, column_idx):
+    """Get a column of the loaded data as a list of strings.
+    """
+    column = data.iloc[:, column_idx]
+    if column.dtype == object:
+        return column.values.tolist()
+    else:
+        return _column_to_str(column).tolist()
+
+
+def _estimate_dataframe_size(data):
+    """Estimate the memory size of a DataFrame, in bytes.
+
+    The size of Python objects is measured on a sample of rows.
+    """
+    if len(data) > DATAFRAME_SIZE_SAMPLE_ROWS:
+        rand = numpy.random.RandomState(RANDOM_SEED)
+        rows = rand.choice(
+            len(data), DATAFRAME_SIZE_SAMPLE_ROWS, replace=False,
+        )
+        size = data.iloc[rows].memory_usage(index=False, deep=True).sum()
+        return size * len(data) / DATAFRAME_SIZE_SAMPLE_ROWS
+    else:
+        return data.memory_usage(index=False, deep=True).sum()
+
+
 def load_data(data, load_max_size=None):
     if not load_max_size:
         load_max_size = MAX_SIZE
@@ -180,13 +345,30 @@ def load_data(data, load_max_size=None):
             data = data.reset_index()
 
         metadata['nb_rows'] = len(data)
-        # Change to object dtype first and do fillna() to work around bug
-        # https://github.com/pandas-dev/pandas/issues/25353 (nan as str 'nan')
-        data = data.astype(object).fillna('').astype(str)
 
+        # Sample rows if the data is too big
+        size = _estimate_dataframe_size(data)
+        logger.info("DataFrame size: about %d bytes", size)
+        if size > load_max_size:
+            ratio = load_max_size / size
+            logger.info("Sampling rows, sample ratio=%r...", ratio)
+            rand = numpy.random.RandomState(RANDOM_SEED)
+            keep = rand.random_sample(len(data)) < ratio
+            data = data.iloc[numpy.flatnonzero(keep)].reset_index(drop=True)
+
+        # Columns of numbers and datetimes are used as they are. Others are
+        # converted to strings one at a time, sharing the strings of equal
+        # values
         column_names = data.columns
-
-        # FIXME: no sampling here!
+        columns = []
+        for i in range(data.shape[1]):
+            column = data.iloc[:, i]
+            if column.dtype.kind not in 'iufM':
+                column = pandas.Series(_column_to_str(column))
+            columns.append(column)
+        if columns:
+            data = pandas.concat(columns, axis=1, copy=False)
+            data.columns = column_names
     else:
         column_names = None  # Avoids a warning
         with contextlib.ExitStack() as stack:
@@ -233,27 +415,30 @@ def load_data(data, load_max_size=None):
             data.seek(0, 0)
 
             # Load the data
+            # It is parsed in a single pass (low_memory=False) so that pandas
+            # uses a single string object for equal values across the file
             if metadata['size'] > load_max_size:
-                logger.info("Counting rows...")
-                metadata['nb_rows'] = sum(1 for _ in data)
+                # Count rows and sub-sample in a single pass
+                ratio = load_max_size / metadata['size']
+                logger.info("Sampling rows, sample ratio=%r...", ratio)
+                metadata['nb_rows'], sample = sample_records(
+                    data, ratio, RANDOM_SEED,
+                )
                 if metadata['nb_rows'] > 0:
                     metadata['average_row_size'] = (
                         metadata['size'] / metadata['nb_rows']
                     )
-                data.seek(0, 0)
 
-                # Sub-sample
-                ratio = load_max_size / metadata['size']
-                logger.info("Loading dataframe, sample ratio=%r...", ratio)
-                rand = random.Random(RANDOM_SEED)
+                logger.info("Loading dataframe...")
                 data = pandas.read_csv(
-                    data,
-                    dtype=str, na_filter=False,
-                    skiprows=lambda i: i != 0 and rand.random() > ratio)
+                    sample,
+                    dtype=str, na_filter=False, low_memory=False)
+                del sample
             else:
                 logger.info("Loading dataframe...")
                 data = pandas.read_csv(data,
-                                       dtype=str, na_filter=False)
+                                       dtype=str, na_filter=False,
+                                       low_memory=False)
 
                 metadata['nb_rows'] = data.shape[0]
                 if metadata['nb_rows'] > 0:
@@ -275,10 +460,24 @@ def process_column(
     coverage=True,
     geo_data=None,
     nominatim=None,
+    geocode_cache=None,
+    budget=None,
+    timings=None,
 ):
+    name = column_meta['name']
+
+    # Parsed representations of the values, shared by the steps below and
+    # dropped when this function returns
+    parsed = ParsedColumn(array)
+    uniques, value_counts = parsed.uniques, parsed.counts
+
     # Identify types
-    structural_type, semantic_types_dict, additional_meta = \
-        identify_types(array, column_meta['name'], geo_data, manual)
+    with timed(timings, 'types', name):
+        structural_type, semantic_types_dict, additional_meta = identify_types(
+            array, name, geo_data, manual,
+            parsed=parsed,
+            timings=timings,
+        )
     logger.info(
         "Column type %s [%s]",
         structural_type,
@@ -295,134 +494,155 @@ def process_column(
     # Insert additional metadata
     column_meta.update(additional_meta)
 
+    # Only the types are needed if we are running out of time
+    column_coverage = coverage
+    if budget is not None:
+        if column_coverage and not budget.allow('coverage'):
+            column_coverage = False
+        if plots and not budget.allow('plots'):
+            plots = False
+
     # Resolved values are returned so they can be used again to compute spatial
     # coverage
     resolved = {}
 
+    # Keep the numbers of latitude and longitude columns, to compute the
+    # coverage once they are paired
+    if coverage and (
+        types.LATITUDE in column_meta['semantic_types']
+        or types.LONGITUDE in column_meta['semantic_types']
+    ):
+        resolved['floats'] = parsed.floats
+
     # Compute ranges for numerical data
-    if structural_type in (types.INTEGER, types.FLOAT) and coverage:
-        # Get numerical ranges
-        numerical_values = []
-        for e in array:
-            try:
-                e = float(e)
-            except ValueError:
-                pass
-            else:
-                if -3.4e38 < e < 3.4e38:  # Overflows in ES
-                    numerical_values.append(e)
+    if structural_type in (types.INTEGER, types.FLOAT) and column_coverage:
+        with timed(timings, 'ranges', name):
+            # Get numerical ranges
+            numerical_values = parsed.floats
+            with numpy.errstate(invalid='ignore'):
+                # Values that are NaN or overflow in ES are dropped
+                numerical_values = numerical_values[
+                    (-3.4e38 < numerical_values) & (numerical_values < 3.4e38)
+                ]
+            numerical_values = numerical_values.tolist()
 
-        column_meta['mean'], column_meta['stddev'] = \
-            mean_stddev(numerical_values)
+            column_meta['mean'], column_meta['stddev'] = \
+                mean_stddev(numerical_values)
 
-        # Compute histogram from numerical values
-        if plots:
-            counts, edges = numpy.histogram(
-                numerical_values,
-                bins=10,
-            )
-            counts = [int(i) for i in counts]
-            edges = [float(f) for f in edges]
-            column_meta['plot'] = {
-                "type": "histogram_numerical",
-                "data": [
-                    {
-                        "count": count,
-                        "bin_start": edges[i],
-                        "bin_end": edges[i + 1],
+            # Compute histogram from numerical values
+            if plots:
+                with timed(timings, 'plots', name):
+                    counts, edges = numpy.histogram(
+                        numerical_values,
+                        bins=10,
+                    )
+                    counts = [int(i) for i in counts]
+                    edges = [float(f) for f in edges]
+                    column_meta['plot'] = {
+                        "type": "histogram_numerical",
+                        "data": [
+                            {
+                                "count": count,
+                                "bin_start": edges[i],
+                                "bin_end": edges[i + 1],
+                            }
+                            for i, count in enumerate(counts)
+                        ]
                     }
-                    for i, count in enumerate(counts)
-                ]
-            }
 
-        ranges = get_numerical_ranges(numerical_values)
-        if ranges:
-            column_meta['coverage'] = ranges
+            ranges = get_numerical_ranges(numerical_values)
+            if ranges:
+                column_meta['coverage'] = ranges
 
     if types.DATE_TIME in semantic_types_dict:
-        datetimes = semantic_types_dict[types.DATE_TIME]
-        resolved['datetimes'] = datetimes
-        timestamps = numpy.empty(
-            len(datetimes),
-            dtype='float32',
-        )
-        for j, dt in enumerate(datetimes):
-            timestamps[j] = dt.timestamp()
-        resolved['timestamps'] = timestamps
+        with timed(timings, 'temporal', name):
+            # Only the distinct values are needed to get the temporal resolution
+            resolved['datetimes'] = parsed.unique_datetime64()
+            timestamps = parsed.unique_timestamps()[parsed.codes]
+            timestamps = timestamps[~numpy.isnan(timestamps)]
+            timestamps = timestamps.astype('float32')
+            resolved['timestamps'] = timestamps
 
         # Compute histogram from temporal values
         if plots and 'plot' not in column_meta:
-            counts, edges = numpy.histogram(timestamps, bins=10)
-            counts = [int(i) for i in counts]
+            with timed(timings, 'plots', name):
+                counts, edges = numpy.histogram(timestamps, bins=10)
+                counts = [int(i) for i in counts]
+                column_meta['plot'] = {
+                    "type": "histogram_temporal",
+                    "data": [
+                        {
+                            "count": count,
+                            "date_start": datetime.utcfromtimestamp(
+                                float(edges[i]),
+                            ).isoformat(),
+                            "date_end": datetime.utcfromtimestamp(
+                                float(edges[i + 1]),
+                            ).isoformat(),
+                        }
+                        for i, count in enumerate(counts)
+                    ]
+                }
+
+    # Compute histogram from categorical values
+    if plots and types.CATEGORICAL in semantic_types_dict:
+        with timed(timings, 'plots', name):
+            counter = collections.Counter()
+            for value, count in zip(uniques, value_counts):
+                if not value:
+                    continue
+                counter[value] = int(count)
+            counts = counter.most_common(5)
+            counts = sorted(counts)
             column_meta['plot'] = {
-                "type": "histogram_temporal",
+                "type": "histogram_categorical",
                 "data": [
                     {
+                        "bin": value,
                         "count": count,
-                        "date_start": datetime.utcfromtimestamp(
-                            edges[i],
-                        ).isoformat(),
-                        "date_end": datetime.utcfromtimestamp(
-                            edges[i + 1],
-                        ).isoformat(),
                     }
-                    for i, count in enumerate(counts)
+                    for value, count in counts
                 ]
             }
 
-    # Compute histogram from categorical values
-    if plots and types.CATEGORICAL in semantic_types_dict:
-        counter = collections.Counter()
-        for value in array:
-            if not value:
-                continue
-            counter[value] += 1
-        counts = counter.most_common(5)
-        counts = sorted(counts)
-        column_meta['plot'] = {
-            "type": "histogram_categorical",
-            "data": [
-                {
-                    "bin": value,
-                    "count": count,
-                }
-                for value, count in counts
-            ]
-        }
-
     # Compute histogram from textual values
     if (
         plots and types.TEXT in semantic_types_dict and
         'plot' not in column_meta
     ):
-        counter = collections.Counter()
-        for value in array:
-            for word in _re_word_split.split(value):
-                word = word.lower()
-                if word:
-                    counter[word] += 1
-        counts = counter.most_common(5)
-        column_meta['plot'] = {
-            "type": "histogram_text",
-            "data": [
-                {
-                    "bin": value,
-                    "count": count,
-                }
-                for value, count in counts
-            ]
-        }
+        with timed(timings, 'plots', name):
+            counter = collections.Counter()
+            for value, count in zip(uniques, value_counts):
+                for word in _re_word_split.split(value):
+                    word = word.lower()
+                    if word:
+                        counter[word] += int(count)
+            counts = counter.most_common(5)
+            column_meta['plot'] = {
+                "type": "histogram_text",
+                "data": [
+                    {
+                        "bin": value,
+                        "count": count,
+                    }
+                    for value, count in counts
+                ]
+            }
 
     # Resolve addresses into coordinates
     if (
         nominatim is not None and
         structural_type == types.TEXT and
-        types.TEXT in semantic_types_dict
+        types.TEXT in semantic_types_dict and
+        (budget is None or budget.allow('nominatim')) and
+        address_prefilter(uniques, value_counts, MAX_UNCLEAN_ADDRESSES)
     ):
-        locations, non_empty = nominatim_resolve_all(
-            nominatim,
-            array,
-        )
+        with timed(timings, 'nominatim', name):
+            locations, non_empty = nominatim_resolve_all(
+                nominatim,
+                array,
+                cache=geocode_cache,
+            )
         if non_empty > 0:
             unclean_ratio = 1.0 - len(locations) / non_empty
             if unclean_ratio <= MAX_UNCLEAN_ADDRESSES:
@@ -435,11 +655,234 @@ def process_column(
         level, areas = semantic_types_dict[types.ADMIN]
         if level is not None:
             column_meta['admin_area_level'] = level
-        resolved['admin_areas'] = areas
+        # Only keep the bounds, Area objects can't be sent between processes
+        resolved['admin_area_bounds'] = [area.bounds for area in areas]
 
     return resolved
 
 
+def _share_bytes(values):
+    """Copy an array or bytes object to a shared memory buffer.
+    """
+    values = numpy.frombuffer(values, dtype=numpy.uint8) \
+        if isinstance(values, bytes) \
+        else numpy.ascontiguousarray(values).view(numpy.uint8).ravel()
+    # RawArray can't be empty
+    shared = multiprocessing.sharedctypes.RawArray(
+        ctypes.c_uint8, max(len(values), 1),
+    )
+    numpy.frombuffer(shared, dtype=numpy.uint8)[:len(values)] = values
+    return shared, len(values)
+
+
+def _load_shared(shared, dtype):
+    """Get a read-only array from a buffer made by `_share_bytes()`.
+    """
+    buffer, size = shared
+    dtype = numpy.dtype(dtype)
+    array = numpy.frombuffer(buffer, dtype=dtype, count=size // dtype.itemsize)
+    array.flags.writeable = False
+    return array
+
+
+def _share_column(column):
+    """Put a column in shared memory, to be sent to the worker processes.
+
+    Numerical and datetime columns are shared as-is. String columns are
+    factorized, and the encoded unique values are shared along with the codes.
+    Columns of other types are pickled.
+    """
+    dtype = column.dtype
+    if isinstance(dtype, numpy.dtype) and dtype.kind in 'iufM':
+        return 'typed', column.name, dtype.str, _share_bytes(column.values)
+    elif dtype == object:
+        codes, uniques = pandas.factorize(column.values)
+        try:
+            encoded = [
+                value.encode('utf-8', 'surrogatepass') for value in uniques
+            ]
+        except AttributeError:
+            pass  # Not strings
+        else:
+            offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+            numpy.cumsum([len(value) for value in encoded], out=offsets[1:])
+            return (
+                'strings', column.name,
+                _share_bytes(b''.join(encoded)),
+                _share_bytes(offsets),
+                codes.dtype.str, _share_bytes(codes),
+            )
+    return 'pickled', column.name, column
+
+
+def _load_column(shared_column):
+    """Rebuild a column from the output of `_share_column()`.
+    """
+    kind, name = shared_column[:2]
+    if kind == 'typed':
+        dtype, values = shared_column[2:]
+        return pandas.Series(_load_shared(values, dtype), name=name)
+    elif kind == 'strings':
+        encoded, offsets, codes_dtype, codes = shared_column[2:]
+        encoded = _load_shared(encoded, numpy.uint8).tobytes()
+        offsets = _load_shared(offsets, numpy.int64).tolist()
+        uniques = numpy.empty(len(offsets) - 1, dtype=object)
+        uniques[:] = [
+            encoded[start:end].decode('utf-8', 'surrogatepass')
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+        # Equal values share the same object, like in the parent
+        values = uniques[_load_shared(codes, codes_dtype)]
+        return pandas.Series(values, name=name)
+    else:
+        return shared_column[2]
+
+
+# State of a worker process, set by _init_column_worker()
+_worker_state = None
+
+
+def _init_column_worker(shared_columns, columns, manual_columns, kwargs):
+    """Set up a worker process.
+
+    Workers are started from a fresh process by the forkserver, so they don't
+    inherit connections or threads from the profiler. The objects in
+    ``kwargs`` open their own connections when unpickled (`GeoData` reopens
+    its database, `SqliteGeocodeCache` connects on first use), and the
+    Nominatim session is per-process.
+    """
+    global _worker_state
+
+    _worker_state = shared_columns, columns, manual_columns, kwargs
+
+
+def _process_column_worker(column_idx):
+    shared_columns, columns, manual_columns, kwargs = _worker_state
+    column_meta = columns[column_idx]
+    if kwargs.get('timings') is not None:
+        # Only send back the entries for this column
+        kwargs = dict(
+            kwargs,
+            timings=StageTimings(memory=kwargs['timings'].memory),
+        )
+    resolved = process_column(
+        _load_column(shared_columns[column_idx]), column_meta,
+        manual=manual_columns.get(column_meta['name']),
+        **kwargs
+    )
+    budget = kwargs.get('budget')
+    skipped = budget.skipped if budget is not None else []
+    timings = kwargs.get('timings')
+    entries = timings.entries if timings is not None else []
+    return column_meta, resolved, skipped, entries
+
+
+def process_columns(data, columns, manual_columns, workers=1, **kwargs):
+    """Run `process_column` on all the columns, possibly in parallel.
+
+    If multiple workers are requested and the data is large enough, columns
+    are processed by a pool of processes started with the forkserver method,
+    since the profiler runs other threads that forking would copy. The columns
+    are put in shared memory rather than pickled for each task.
+
+    :param data: The DataFrame to profile
+    :param columns: List of the columns' metadata, updated in-place
+    :param manual_columns: Dict mapping column names to manual annotations
+    :param workers: Number of processes to use
+    :return: List of the values resolved for each column, in column order
+    """
+    geo_data = kwargs.get('geo_data')
+    if (
+        workers > 1
+        and len(columns) > 1
+        and data.size >= PARALLEL_MIN_VALUES
+        and 'forkserver' in multiprocessing.get_all_start_methods()
+    ):
+        if geo_data is not None and not isinstance(geo_data, GeoData):
+            logger.warning(
+                "geo_data is not a datamart_profiler.geo_data.GeoData, it "
+                "can't be sent to other processes; processing columns "
+                "serially",
+            )
+            workers = 1
+    else:
+        workers = 1
+
+    if workers > 1:
+        workers = min(workers, len(columns))
+        logger.info("Processing columns using %d processes", workers)
+        shared_columns = [
+            _share_column(data.iloc[:, column_idx])
+            for column_idx in range(len(columns))
+        ]
+        context = multiprocessing.get_context('forkserver')
+        # Import the profiler once in the server, rather than in each worker
+        # (and don't import the __main__ module of the service)
+        context.set_forkserver_preload([__name__])
+        with context.Pool(
+            workers,
+            initializer=_init_column_worker,
+            initargs=(shared_columns, columns, manual_columns, kwargs),
+        ) as pool:
+            results = pool.map(
+                _process_column_worker,
+                range(len(columns)),
+                chunksize=1,
+            )
+
+        budget = kwargs.get('budget')
+        timings = kwargs.get('timings')
+        resolved_columns = []
+        for column_meta, (new_column_meta, resolved, skipped, entries) in zip(
+            columns, results,
+        ):
+            column_meta.update(new_column_meta)
+            resolved_columns.append(resolved)
+            for stage in skipped:
+                budget.skip(stage)
+            if timings is not None:
+                timings.add(entries)
+        return resolved_columns
+
+    resolved_columns = []
+    for column_idx, column_meta in enumerate(columns):
+        name = column_meta['name']
+        logger.info("Processing column %d %r...", column_idx, name)
+        array = data.iloc[:, column_idx]
+        # Process the column, updating the column_meta dict
+        resolved_columns.append(process_column(
+            array, column_meta,
+            manual=manual_columns.get(name),
+            **kwargs
+        ))
+    return resolved_columns
+
+
+def sketch_data(data, columns, chunk_rows=FULL_SCAN_CHUNK_ROWS):
+    """Read the whole file in chunks, building sketches for each column.
+
+    :param data: path to dataset, or file object
+    :param columns: The columns' metadata, with their identified types
+    :return: A list of `ColumnSketch`
+    """
+    sketches = [ColumnSketch(column_meta) for column_meta in columns]
+    with contextlib.ExitStack() as stack:
+        if isinstance(data, (str, bytes)):
+            data = stack.enter_context(open(data, 'rb'))
+        else:
+            data.seek(0, 0)
+        chunks = pandas.read_csv(
+            data,
+            dtype=str, na_filter=False,
+            chunksize=chunk_rows,
+        )
+        for chunk_idx, chunk in enumerate(chunks):
+            logger.info("Sketching chunk %d, %d rows", chunk_idx, len(chunk))
+            for column_idx, sketch in enumerate(sketches):
+                sketch.update(chunk.iloc[:, column_idx].values)
+    return sketches
+
+
 @PROM_LAZO.time()
 def lazo_index_data(
     data, data_path,
@@ -464,7 +907,7 @@ def lazo_index_data(
         for idx, name in zip(columns_textual, column_textual_names):
             def call_lazo():
                 lazo_client.index_data(
-                    data.iloc[:, idx].values.tolist(),
+                    _column_str_list(data, idx),
                     dataset_id,
                     name,
                 )
@@ -500,7 +943,7 @@ def get_lazo_data_sketch(
         for idx, name in zip(columns_textual, column_textual_names):
             def call_lazo():
                 return lazo_client.get_lazo_sketch_from_data(
-                    data.iloc[:, idx].values.tolist(),
+                    _column_str_list(data, idx),
                     "",
                     name,
                 )
@@ -514,10 +957,14 @@ def get_lazo_data_sketch(
 
 
 @PROM_PROFILE.time()
+@_report_peak_memory()
 def process_dataset(data, dataset_id=None, metadata=None,
                     lazo_client=None, nominatim=None, geo_data=None,
                     search=False, include_sample=False,
-                    coverage=True, plots=False, load_max_size=None, **kwargs):
+                    coverage=True, plots=False, load_max_size=None,
+                    full_scan=False, workers=1, time_budget=None,
+                    geocode_cache=None, timings=None,
+                    **kwargs):
     """Compute all metafeatures from a dataset.
 
     :param data: path to dataset, or file object, or DataFrame
@@ -527,7 +974,9 @@ def process_dataset(data, dataset_id=None, metadata=None,
     :param lazo_client: client for the Lazo Index Server
     :param nominatim: URL of the Nominatim server
     :param geo_data: a datamart_geo.GeoData instance to use to resolve named
-        administrative territorial entities
+        administrative territorial entities. Use
+        ``datamart_profiler.geo_data.GeoData`` so it can be used from multiple
+        worker processes.
     :param search: True if this method is being called during the search
         operation (and not for indexing).
     :param include_sample: Set to True to include a few random rows to the
@@ -537,6 +986,23 @@ def process_dataset(data, dataset_id=None, metadata=None,
     :param load_max_size: Target size of the data to be analyzed. The data will
         be randomly sampled if it is bigger. Defaults to `MAX_SIZE`, currently
         50 MB. This is different from the sample data included in the result.
+    :param full_scan: If the data had to be sampled, read the whole file
+        again in chunks after identifying types, to compute missing values,
+        distinct counts, ranges and plots from sketches of the full data rather
+        than from the sample. Memory usage stays bounded.
+    :param workers: Number of processes to use to process columns in parallel.
+        Small datasets are always processed serially.
+    :param time_budget: Time allowed for profiling, in seconds. Less data will
+        be loaded, and as time runs out optional stages will be skipped (Lazo
+        and coverage last, then plots, address resolution and the sample).
+        Those are listed in ``skipped_stages`` and ``approximated_stages`` in
+        the result. This is a target, not a hard limit.
+    :param geocode_cache: a
+        :class:`~datamart_profiler.geocode_cache.GeocodeCache` keeping the
+        results of Nominatim queries across datasets
+    :param timings: a :class:`~datamart_profiler.timings.StageTimings` in
+        which to record the time and peak memory of each stage for each
+        column. This report is not part of the returned metadata.
     :return: JSON structure (dict)
     """
     if 'sample_size' in kwargs:
@@ -554,12 +1020,19 @@ def process_dataset(data, dataset_id=None, metadata=None,
     if metadata is None:
         metadata = {}
 
+    budget = TimeBudget(time_budget)
+
     # Load or prepare data for processing
+    source = data
+    if not load_max_size:
+        load_max_size = MAX_SIZE
+    budget_max_size = budget.max_size(load_max_size)
     try:
-        data, data_path, file_metadata, column_names = load_data(
-            data,
-            load_max_size=load_max_size,
-        )
+        with timed(timings, 'load'):
+            data, data_path, file_metadata, column_names = load_data(
+                data,
+                load_max_size=budget_max_size,
+            )
     except EmptyDataError:
         logger.warning("Dataframe is empty!")
         metadata['nb_rows'] = 0
@@ -570,6 +1043,11 @@ def process_dataset(data, dataset_id=None, metadata=None,
     metadata.update(file_metadata)
     metadata['nb_profiled_rows'] = data.shape[0]
     metadata['nb_columns'] = data.shape[1]
+    if (
+        budget_max_size < load_max_size
+        and metadata['nb_profiled_rows'] < metadata['nb_rows']
+    ):
+        budget.approximate('rows')
 
     if 'columns' in metadata:
         columns = metadata['columns']
@@ -603,28 +1081,38 @@ def process_dataset(data, dataset_id=None, metadata=None,
     # useful for spatial coverage computation: admin areas and addresses
     # Having to resolve them once to see if they're valid and a second time to
     # build coverage information would be too slow
-    resolved_columns = {}
-
     # Identify types
     logger.info("Identifying types, %d columns...", len(columns))
     with PROM_TYPES.time():
-        for column_idx, column_meta in enumerate(columns):
-            name = column_meta['name']
-            logger.info("Processing column %d %r...", column_idx, name)
-            array = data.iloc[:, column_idx]
-            if name in manual_columns:
-                manual = manual_columns[name]
-            else:
-                manual = None
-            # Process the column, updating the column_meta dict
-            resolved_columns[column_idx] = process_column(
-                array, column_meta,
-                manual=manual,
-                plots=plots,
-                coverage=coverage,
-                geo_data=geo_data,
-                nominatim=nominatim,
-            )
+        resolved_columns = dict(enumerate(process_columns(
+            data, columns, manual_columns,
+            workers=workers,
+            plots=plots,
+            coverage=coverage,
+            geo_data=geo_data,
+            nominatim=nominatim,
+            geocode_cache=geocode_cache,
+            budget=budget,
+            timings=timings,
+        )))
+
+    # Go over the full data if it was sampled
+    if (
+        full_scan
+        and not isinstance(source, pandas.DataFrame)
+        and metadata['nb_profiled_rows'] < metadata['nb_rows']
+        and budget.allow('full_scan')
+    ):
+        logger.info("Sketching full data...")
+        with PROM_FULL_SCAN.time(), timed(timings, 'full_scan'):
+            sketches = sketch_data(source, columns)
+            for column_idx, sketch in enumerate(sketches):
+                sketch.update_metadata(
+                    columns[column_idx], resolved_columns[column_idx],
+                    plots=plots,
+                    coverage=coverage,
+                )
+        del sketches
 
     # Textual columns
     columns_textual = [
@@ -635,39 +1123,40 @@ def process_dataset(data, dataset_id=None, metadata=None,
             and types.DATE_TIME not in col['semantic_types']
         )
     ]
-    if lazo_client and columns_textual:
-        # Indexing with lazo
-        column_textual_names = [columns[idx]['name'] for idx in columns_textual]
-        if not search:
-            try:
-                lazo_index_data(
-                    data, data_path,
-                    dataset_id,
-                    columns_textual, column_textual_names,
-                    lazo_client,
-                )
-            except Exception:
-                logger.warning("Error indexing textual attributes from %s", dataset_id)
-                raise
-        else:
-            try:
-                lazo_sketches = get_lazo_data_sketch(
-                    data, data_path,
-                    columns_textual, column_textual_names,
-                    lazo_client,
-                )
-            except Exception:
-                logger.warning("Error getting Lazo sketches")
-                raise
+    if lazo_client and columns_textual and budget.allow('lazo'):
+        with timed(timings, 'lazo'):
+            # Indexing with lazo
+            column_textual_names = [columns[idx]['name'] for idx in columns_textual]
+            if not search:
+                try:
+                    lazo_index_data(
+                        data, data_path,
+                        dataset_id,
+                        columns_textual, column_textual_names,
+                        lazo_client,
+                    )
+                except Exception:
+                    logger.warning("Error indexing textual attributes from %s", dataset_id)
+                    raise
             else:
-                # saving sketches into metadata
-                for sketch, idx in zip(lazo_sketches, columns_textual):
-                    n_permutations, hash_values, cardinality = sketch
-                    columns[idx]['lazo'] = dict(
-                        n_permutations=n_permutations,
-                        hash_values=list(hash_values),
-                        cardinality=cardinality,
+                try:
+                    lazo_sketches = get_lazo_data_sketch(
+                        data, data_path,
+                        columns_textual, column_textual_names,
+                        lazo_client,
                     )
+                except Exception:
+                    logger.warning("Error getting Lazo sketches")
+                    raise
+                else:
+                    # saving sketches into metadata
+                    for sketch, idx in zip(lazo_sketches, columns_textual):
+                        n_permutations, hash_values, cardinality = sketch
+                        columns[idx]['lazo'] = dict(
+                            n_permutations=n_permutations,
+                            hash_values=list(hash_values),
+                            cardinality=cardinality,
+                        )
 
     # Pair lat & long columns
     columns_lat = [
@@ -723,22 +1212,19 @@ def process_dataset(data, dataset_id=None, metadata=None,
             metadata[key] = dataset_types[d_type]
     metadata['types'] = sorted(set(dataset_types))
 
-    if coverage:
+    if coverage and budget.allow('coverage'):
         logger.info("Computing spatial coverage...")
         spatial_coverage = []
-        with PROM_SPATIAL.time():
+        with PROM_SPATIAL.time(), timed(timings, 'spatial_coverage'):
             # Compute ranges from lat/long pairs
             for col_lat, col_long in latlong_pairs:
-                lat_values = data.iloc[:, col_lat.index]
-                lat_values = pandas.to_numeric(lat_values, errors='coerce')
-                long_values = data.iloc[:, col_long.index]
-                long_values = pandas.to_numeric(long_values, errors='coerce')
-                mask = (
-                    ~numpy.isnan(lat_values)
-                    & ~numpy.isnan(long_values)
-                    & (-90.0 < lat_values) & (lat_values < 90.0)
-                    & (-180.0 < long_values) & (long_values < 180.0)
-                )
+                lat_values = resolved_columns[col_lat.index]['floats']
+                long_values = resolved_columns[col_long.index]['floats']
+                with numpy.errstate(invalid='ignore'):
+                    mask = (
+                        (-90.0 < lat_values) & (lat_values < 90.0)
+                        & (-180.0 < long_values) & (long_values < 180.0)
+                    )
 
                 if mask.any():
                     lat_values = lat_values[mask]
@@ -803,8 +1289,8 @@ def process_dataset(data, dataset_id=None, metadata=None,
                             'ranges': spatial_ranges,
                         })
 
-                if 'admin_areas' in resolved:
-                    areas = resolved['admin_areas']
+                if 'admin_area_bounds' in resolved:
+                    areas = resolved['admin_area_bounds']
 
                     name = columns[idx]['name']
                     logger.info(
@@ -814,10 +1300,7 @@ def process_dataset(data, dataset_id=None, metadata=None,
 
                     # Compute ranges from administrative areas
                     merged = None
-                    for area in areas:
-                        if area is None:
-                            continue
-                        new = area.bounds
+                    for new in areas:
                         if new:
                             if merged is None:
                                 merged = new
@@ -859,33 +1342,34 @@ def process_dataset(data, dataset_id=None, metadata=None,
         logging.info("Computing temporal coverage...")
         temporal_coverage = []
 
-        # Datetime columns
-        for idx, col in enumerate(columns):
-            if types.DATE_TIME not in col['semantic_types']:
-                continue
-            datetimes = resolved_columns[idx]['datetimes']
-            timestamps = resolved_columns[idx]['timestamps']
-            logger.info(
-                "Computing temporal ranges datetime=%r (%d rows)",
-                col['name'], len(datetimes),
-            )
+        with timed(timings, 'temporal_coverage'):
+            # Datetime columns
+            for idx, col in enumerate(columns):
+                if types.DATE_TIME not in col['semantic_types']:
+                    continue
+                datetimes = resolved_columns[idx]['datetimes']
+                timestamps = resolved_columns[idx]['timestamps']
+                logger.info(
+                    "Computing temporal ranges datetime=%r (%d rows)",
+                    col['name'], len(timestamps),
+                )
 
-            # Get temporal ranges
-            ranges = get_numerical_ranges(timestamps)
-            if not ranges:
-                continue
+                # Get temporal ranges
+                ranges = get_numerical_ranges(timestamps)
+                if not ranges:
+                    continue
 
-            # Get temporal resolution
-            resolution = get_temporal_resolution(datetimes)
+                # Get temporal resolution
+                resolution = get_temporal_resolution(datetimes)
 
-            temporal_coverage.append({
-                'type': 'datetime',
-                'column_names': [col['name']],
-                'column_indexes': [idx],
-                'column_types': [types.DATE_TIME],
-                'ranges': ranges,
-                'temporal_resolution': resolution,
-            })
+                temporal_coverage.append({
+                    'type': 'datetime',
+                    'column_names': [col['name']],
+                    'column_indexes': [idx],
+                    'column_types': [types.DATE_TIME],
+                    'ranges': ranges,
+                    'temporal_resolution': resolution,
+                })
 
         # TODO: Times split over multiple columns
 
@@ -902,17 +1386,27 @@ def process_dataset(data, dataset_id=None, metadata=None,
     metadata['attribute_keywords'] = attribute_keywords
 
     # Sample data
-    if include_sample:
-        rand = numpy.random.RandomState(RANDOM_SEED)
-        choose_rows = rand.choice(
-            len(data),
-            min(SAMPLE_ROWS, len(data)),
-            replace=False,
-        )
-        choose_rows.sort()  # Keep it in order
-        sample = data.iloc[choose_rows]
-        sample = sample.applymap(truncate_string)  # Truncate long values
-        metadata['sample'] = sample.to_csv(index=False, line_terminator='\r\n')
+    if include_sample and budget.allow('sample'):
+        with timed(timings, 'sample'):
+            rand = numpy.random.RandomState(RANDOM_SEED)
+            choose_rows = rand.choice(
+                len(data),
+                min(SAMPLE_ROWS, len(data)),
+                replace=False,
+            )
+            choose_rows.sort()  # Keep it in order
+            sample = data.iloc[choose_rows]
+            sample = pandas.DataFrame(
+                {i: _column_str_list(sample, i) for i in range(sample.shape[1])},
+            )
+            sample.columns = data.columns
+            sample = sample.applymap(truncate_string)  # Truncate long values
+            metadata['sample'] = sample.to_csv(index=False, line_terminator='\r\n')
+
+    if budget.skipped:
+        metadata['skipped_stages'] = budget.skipped
+    if budget.approximated:
+        metadata['approximated_stages'] = budget.approximated
 
     # Return it -- it will be inserted into Elasticsearch, and published to the
     # feed and the waiting on-demand searches
@@ -0,0 +1,26 @@
+"""Access to the ``datamart_geo`` database from multiple processes.
+
+``datamart_geo.GeoData`` keeps an SQLite connection, which can't be shared
+with other processes, and doesn't expose the directory it was loaded from. The
+:class:`GeoData` here does, so that worker processes and the name filter can
+open the same data.
+"""
+
+import datamart_geo
+import os
+
+
+class GeoData(datamart_geo.GeoData):
+    """``datamart_geo.GeoData`` that can be reopened in other processes.
+
+    The data directory is available as :attr:`data_path`. Pickling an object
+    only sends that path, the process that unpickles it opens its own
+    database connection.
+    """
+    def __init__(self, data_path):
+        super(GeoData, self).__init__(data_path)
+        #: The absolute path to the directory of the data
+        self.data_path = os.path.abspath(data_path)
+
+    def __reduce__(self):
+        return type(self), (self.data_path,)
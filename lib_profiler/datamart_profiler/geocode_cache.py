@@ -0,0 +1,147 @@
+"""Persistent caches for the locations of addresses resolved with Nominatim.
+
+The same addresses come up in many datasets, so the results of Nominatim
+queries are kept across profiling runs. Addresses that couldn't be found are
+cached too (negative caching), for a shorter time.
+
+Locations are ``(latitude, longitude)`` tuples, None for addresses that were
+not found.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+#: How long to keep the location of an address, in seconds
+GEOCODE_TTL = 90 * 24 * 3600  # 90 days
+
+#: How long to remember that an address couldn't be found, in seconds
+GEOCODE_NEGATIVE_TTL = 7 * 24 * 3600  # 7 days
+
+# Maximum number of parameters in a single SQLite query
+_SQLITE_MAX_PARAMS = 500
+
+
+class GeocodeCache(object):
+    """Base class for geocoding caches.
+
+    :param ttl: How long to keep locations, in seconds
+    :param negative_ttl: How long to remember that an address was not found,
+        in seconds
+    """
+    def __init__(self, ttl=GEOCODE_TTL, negative_ttl=GEOCODE_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+    def get_many(self, addresses):
+        """Look up addresses in the cache.
+
+        :return: A dict mapping the addresses that are in the cache to their
+            location, or None if it is known that they can't be found.
+        """
+        raise NotImplementedError
+
+    def set_many(self, locations):
+        """Add the result of queries to the cache.
+
+        :param locations: A dict mapping addresses to their location, or None
+            if they couldn't be found.
+        """
+        raise NotImplementedError
+
+
+class SqliteGeocodeCache(GeocodeCache):
+    """Cache of locations in a local SQLite database.
+
+    The file can be shared by multiple processes. A connection is opened for
+    each process and thread that uses the cache.
+    """
+    def __init__(self, path, **kwargs):
+        super(SqliteGeocodeCache, self).__init__(**kwargs)
+        self.path = path
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # Connections are not sent to other processes, they open their own
+        state = dict(self.__dict__)
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connect(self):
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            # Don't share the connection with the parent process
+            conn = sqlite3.connect(self.path, timeout=30.0)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS geocode(
+                    address TEXT PRIMARY KEY,
+                    latitude REAL,
+                    longitude REAL,
+                    expires REAL NOT NULL
+                );
+                ''',
+            )
+            # Purge expired entries, once per connection
+            with conn:
+                conn.execute(
+                    'DELETE FROM geocode WHERE expires <= ?;',
+                    [time.time()],
+                )
+            self._local.conn = conn
+            self._local.pid = pid
+        return self._local.conn
+
+    def get_many(self, addresses):
+        addresses = list(addresses)
+        conn = self._connect()
+        now = time.time()
+        found = {}
+        for i in range(0, len(addresses), _SQLITE_MAX_PARAMS):
+            chunk = addresses[i:i + _SQLITE_MAX_PARAMS]
+            cursor = conn.execute(
+                '''
+                SELECT address, latitude, longitude FROM geocode
+                WHERE expires > ? AND address IN (%s);
+                ''' % ', '.join('?' * len(chunk)),
+                [now] + chunk,
+            )
+            for address, latitude, longitude in cursor:
+                if latitude is None:
+                    found[address] = None
+                else:
+                    found[address] = latitude, longitude
+        return found
+
+    def set_many(self, locations):
+        conn = self._connect()
+        now = time.time()
+        rows = []
+        for address, location in locations.items():
+            if location is None:
+                rows.append((address, None, None, now + self.negative_ttl))
+            else:
+                rows.append((
+                    address, location[0], location[1], now + self.ttl,
+                ))
+        with conn:
+            conn.executemany(
+                '''
+                INSERT OR REPLACE INTO geocode(
+                    address, latitude, longitude, expires
+                )
+                VALUES (?, ?, ?, ?);
+                ''',
+                rows,
+            )
@@ -1,10 +1,6 @@
 import logging
 import math
 import numpy
-from sklearn.cluster import KMeans
-from sklearn.exceptions import ConvergenceWarning
-
-from .warning_tools import ignore_warnings
 
 
 logger = logging.getLogger(__name__)
@@ -35,11 +31,121 @@ def mean_stddev(array):
     return mean, stddev
 
 
+class _SegmentCosts(object):
+    """Sum of squared distances to the mean for ranges of sorted values.
+
+    This uses prefix sums so that the cost of any range is computed in constant
+    time (and vectorized over arrays of ranges).
+    """
+    def __init__(self, values, weights):
+        # Center the values to limit loss of precision
+        values = values - numpy.average(values, weights=weights)
+        self.count = numpy.concatenate([[0], numpy.cumsum(weights)])
+        self.sum = numpy.concatenate([[0.0], numpy.cumsum(weights * values)])
+        self.sum_sq = numpy.concatenate(
+            [[0.0], numpy.cumsum(weights * values * values)],
+        )
+
+    def __call__(self, start, end):
+        """Cost of the values in ``[start, end)``, which must not be empty.
+        """
+        count = self.count[end] - self.count[start]
+        total = self.sum[end] - self.sum[start]
+        cost = self.sum_sq[end] - self.sum_sq[start] - total * total / count
+        return numpy.maximum(cost, 0.0)
+
+
+def _best_two_segments(costs, nb_values):
+    """Find the best split in two of every prefix of the values.
+
+    The position of the best split is non-decreasing with the length of the
+    prefix, which allows a divide-and-conquer search in O(n log n). Each level
+    of the recursion is computed at once with numpy.
+
+    :return: ``(cost, split)`` where ``cost[j]`` is the cost of the best
+        segmentation of the first `j` values in two, and ``split[j]`` is the
+        start of the second segment.
+    """
+    best_cost = numpy.full(nb_values + 1, numpy.inf)
+    best_split = numpy.zeros(nb_values + 1, dtype=numpy.int64)
+    first_cost = costs(0, numpy.arange(1, nb_values + 1))
+
+    # Tasks: compute prefixes [lo, hi] knowing split is in [split_lo, split_hi]
+    lo = numpy.array([2])
+    hi = numpy.array([nb_values])
+    split_lo = numpy.array([1])
+    split_hi = numpy.array([nb_values - 1])
+    while len(lo):
+        mid = (lo + hi) // 2
+        first = split_lo
+        last = numpy.minimum(mid - 1, split_hi)
+        lengths = last - first + 1
+
+        # Try all the possible splits of all the tasks at once
+        task = numpy.repeat(numpy.arange(len(lo)), lengths)
+        offsets = numpy.cumsum(lengths) - lengths
+        split = first[task] + numpy.arange(len(task)) - offsets[task]
+        cost = first_cost[split - 1] + costs(split, mid[task])
+
+        # Find the best split for each task (the first, if several are equal)
+        min_cost = numpy.minimum.reduceat(cost, offsets)
+        best = numpy.flatnonzero(cost == min_cost[task])
+        first_best = numpy.flatnonzero(numpy.diff(task[best], prepend=-1))
+        split = split[best[first_best]]
+        best_cost[mid] = min_cost
+        best_split[mid] = split
+
+        # Recurse on both halves
+        left = lo <= mid - 1
+        right = mid + 1 <= hi
+        lo, hi, split_lo, split_hi = (
+            numpy.concatenate([lo[left], mid[right] + 1]),
+            numpy.concatenate([mid[left] - 1, hi[right]]),
+            numpy.concatenate([split_lo[left], split[right]]),
+            numpy.concatenate([split[left], split_hi[right]]),
+        )
+
+    return best_cost, best_split
+
+
+def optimal_segments(values, weights, nb_segments):
+    """Split sorted values in segments minimizing the sum of squared distances.
+
+    This is the optimal solution to 1-dimensional k-means, for up to 3
+    segments.
+
+    :param values: Sorted distinct values
+    :param weights: Number of occurrences of each value
+    :param nb_segments: Number of segments, 1 to 3, at most the number of values
+    :return: List of ``(start, end)`` ranges of indices into `values`
+    """
+    nb_values = len(values)
+    if nb_segments == 1:
+        return [(0, nb_values)]
+
+    costs = _SegmentCosts(values, weights)
+    if nb_segments == 2:
+        split = numpy.arange(1, nb_values)
+        cost = costs(0, split) + costs(split, nb_values)
+        split = int(split[numpy.argmin(cost)])
+        return [(0, split), (split, nb_values)]
+    elif nb_segments == 3:
+        prefix_cost, prefix_split = _best_two_segments(costs, nb_values)
+        split2 = numpy.arange(2, nb_values)
+        cost = prefix_cost[split2] + costs(split2, nb_values)
+        split2 = int(split2[numpy.argmin(cost)])
+        split1 = int(prefix_split[split2])
+        return [(0, split1), (split1, split2), (split2, nb_values)]
+    else:
+        raise ValueError("Unsupported number of segments %r" % nb_segments)
+
+
 def get_numerical_ranges(values):
     """
     Retrieve the numeral ranges given the input (timestamp, integer, or float).
 
-    This performs K-Means clustering, returning a maximum of 3 ranges.
+    This clusters the values optimally (1-dimensional k-means), returning a
+    maximum of 3 ranges.
     """
 
     if not len(values):
@@ -47,35 +153,33 @@ def get_numerical_ranges(values):
 
     logger.info("Computing numerical ranges, %d values", len(values))
 
-    clustering = KMeans(n_clusters=min(N_RANGES, len(values)),
-                        random_state=0)
-    values_array = numpy.array(values).reshape(-1, 1)
-    with ignore_warnings(ConvergenceWarning):
-        clustering.fit(values_array)
-    logger.info("K-Means clusters: %r", list(clustering.cluster_centers_))
+    values, weights = numpy.unique(numpy.asarray(values), return_counts=True)
+    segments = optimal_segments(
+        values.astype(numpy.float64),
+        weights,
+        min(N_RANGES, len(values)),
+    )
+    # Position of each distinct value in the sorted data
+    positions = numpy.concatenate([[0], numpy.cumsum(weights)])
+    total = positions[-1]
 
     # Compute confidence intervals for each range
     ranges = []
     sizes = []
-    for rg in range(N_RANGES):
-        cluster = [values[i]
-                   for i in range(len(values))
-                   if clustering.labels_[i] == rg]
-        if not cluster:
-            continue
+    for start, end in segments:
+        size = positions[end] - positions[start]
 
         # Eliminate clusters of outliers
-        if len(cluster) < MIN_RANGE_SIZE * len(values):
+        if size < MIN_RANGE_SIZE * total:
             continue
 
-        cluster.sort()
-        min_idx = int(0.05 * len(cluster))
-        max_idx = int(0.95 * len(cluster))
+        min_idx = positions[start] + int(0.05 * size)
+        max_idx = positions[start] + int(0.95 * size)
         ranges.append([
-            cluster[min_idx],
-            cluster[max_idx],
+            values[numpy.searchsorted(positions, min_idx, side='right') - 1],
+            values[numpy.searchsorted(positions, max_idx, side='right') - 1],
         ])
-        sizes.append(len(cluster))
+        sizes.append(int(size))
     ranges.sort()
     logger.info("Ranges: %r", ranges)
     logger.info("Sizes: %r", sizes)
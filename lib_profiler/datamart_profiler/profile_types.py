@@ -2,12 +2,18 @@ import collections
 from datetime import datetime
 import dateutil.tz
 import functools
+import math
+import numpy
+import pandas
 import re
 import regex
 
 from . import types
+from .admin_names import PROM_ADMIN_NAMES_SAVED_LOOKUPS, \
+    PROM_ADMIN_NAMES_SKIPPED, get_admin_names
 from .spatial import LATITUDE, LONGITUDE, disambiguate_admin_areas
-from .temporal import parse_date
+from .temporal import parse_date, parse_date_array, to_datetime64
+from .timings import timed
 
 
 _re_int = re.compile(
@@ -77,36 +83,384 @@ TEXT_WORDS_THRESHOLD = 0.5  # 50%
 MAX_CATEGORICAL_RATIO = 0.10  # 10%
 
 
-def regular_exp_count(array):
-    """Count instances matching the structure of each data type, using regexes.
+BOOLEAN_VALUES = ('0', '1', 'true', 'false', 'y', 'n', 'yes', 'no')
+
+
+# Minimum ratio of distinct values that are administrative areas
+ADMIN_AREAS_RATIO = 0.7  # 70%
+
+# Number of distinct values checked against the names of administrative areas
+# before looking up the whole column
+ADMIN_NAMES_SAMPLE = 500
+
+
+# Progressive type identification: columns with many distinct values are
+# first classified from a sample of rows, and only scanned fully if the result
+# is close to one of the thresholds above
+PROGRESSIVE_SAMPLE_ROWS = 2000
+PROGRESSIVE_MIN_DISTINCT = 10000
+# How many standard errors away from a threshold a ratio measured on the
+# sample has to be for the decision to be considered clear
+PROGRESSIVE_MARGIN = 6.0
+
+
+def _line_pattern(pattern, module=re):
+    """Turn a pattern for a single value into one matching lines in a string.
     """
-    re_count = collections.Counter()
+    expr = pattern.pattern
+    assert expr.startswith('^') and expr.endswith('$')
+    return module.compile(
+        r'^(?:' + expr[1:-1] + r')$',
+        module.MULTILINE,
+    )
+
+
+# Patterns matching a whole line, in order of priority (a value is counted for
+# the first pattern that matches it), with a substring that has to be present
+# for the pattern to possibly match anything
+_structural_line_patterns = [
+    ('int', _line_pattern(_re_int), None),
+    ('float', _line_pattern(_re_float), '.'),
+    ('point', _line_pattern(_re_wkt_point), 'POINT'),
+    ('geo_combined', _line_pattern(_re_geo_combined, regex), ')'),
+    ('other_point', _line_pattern(_re_other_point), 'POINT'),
+    ('latlong_point', _line_pattern(_re_latlong_point), ')'),
+    ('polygon', _line_pattern(_re_wkt_polygon), 'POLYGON'),
+]
+# At least TEXT_WORDS - 1 separate runs of whitespace on a line
+_re_text_line = re.compile(
+    r'^\S*' + r'\S+'.join([r'[^\S\n]+'] * (TEXT_WORDS - 1)),
+    re.MULTILINE,
+)
+_re_bool_line = re.compile(
+    r'^(?:%s)$' % '|'.join(BOOLEAN_VALUES),
+    re.MULTILINE,
+)
 
-    for elem in array:
+
+def _regular_exp_count_elementwise(array, counts, re_count):
+    for elem, count in zip(array, counts):
         if not elem:
-            re_count['empty'] += 1
+            re_count['empty'] += count
         elif _re_int.match(elem):
-            re_count['int'] += 1
+            re_count['int'] += count
         elif _re_float.match(elem):
-            re_count['float'] += 1
+            re_count['float'] += count
         elif _re_wkt_point.match(elem):
-            re_count['point'] += 1
+            re_count['point'] += count
         elif _re_geo_combined.match(elem):
-            re_count['geo_combined'] += 1
+            re_count['geo_combined'] += count
         elif _re_other_point.match(elem):
-            re_count['other_point'] += 1
+            re_count['other_point'] += count
         elif _re_latlong_point.match(elem):
-            re_count['latlong_point'] += 1
+            re_count['latlong_point'] += count
         elif _re_wkt_polygon.match(elem):
-            re_count['polygon'] += 1
+            re_count['polygon'] += count
         elif len(_re_whitespace.findall(elem)) >= TEXT_WORDS - 1:
-            re_count['text'] += 1
-        if elem.lower() in ('0', '1', 'true', 'false', 'y', 'n', 'yes', 'no'):
-            re_count['bool'] += 1
+            re_count['text'] += count
+        if elem.lower() in BOOLEAN_VALUES:
+            re_count['bool'] += count
+
+
+def _matching_lines(pattern, buffer, line_starts):
+    """Find the indices of the lines in the buffer that match the pattern.
+    """
+    positions = numpy.fromiter(
+        (m.start() for m in pattern.finditer(buffer)),
+        dtype=numpy.int64,
+    )
+    return numpy.searchsorted(line_starts, positions, side='right') - 1
+
+
+def _join_lines(values):
+    """Join values with newlines, also returning the offset of each line.
+    """
+    lengths = numpy.fromiter(
+        map(len, values),
+        dtype=numpy.int64, count=len(values),
+    )
+    line_starts = numpy.zeros(len(values), dtype=numpy.int64)
+    numpy.cumsum(lengths[:-1] + 1, out=line_starts[1:])
+    return '\n'.join(values), line_starts
+
+
+def regular_exp_count(array, counts=None):
+    """Count instances matching the structure of each data type, using regexes.
+
+    Rather than trying each pattern on each value in turn, this joins the whole
+    column into a single string and runs each pattern over it once, only
+    keeping the unmatched lines for the next (lower-priority) pattern. The few
+    values that contain newlines themselves are checked separately.
+
+    :param array: The values to inspect
+    :param counts: If provided, the number of times each value is present. This
+        allows passing only the distinct values of a column.
+    """
+    re_count = collections.Counter()
+
+    if isinstance(array, pandas.Series):
+        array = array.values
+    array = numpy.asarray(array, dtype=object)
+    if counts is None:
+        counts = numpy.ones(len(array), dtype=numpy.int64)
+    else:
+        counts = numpy.asarray(counts, dtype=numpy.int64)
+    if not len(array):
+        return re_count
+
+    def count(key, weights):
+        nb = int(weights.sum())
+        if nb:
+            re_count[key] += nb
+
+    count('empty', counts[array == ''])
+
+    if sum(len(elem) for elem in array if '\n' in elem):
+        # Some values contain newlines, handle them separately
+        multiline = numpy.array(['\n' in elem for elem in array], dtype=bool)
+        _regular_exp_count_elementwise(
+            array[multiline], counts[multiline],
+            re_count,
+        )
+        array = array[~multiline]
+        counts = counts[~multiline]
+
+    buffer, line_starts = _join_lines(array)
+
+    lowered = buffer.lower()
+    if len(lowered) != len(buffer):
+        # Some characters changed length
+        lowered, bool_line_starts = _join_lines([e.lower() for e in array])
+    else:
+        bool_line_starts = line_starts
+    count(
+        'bool',
+        counts[_matching_lines(_re_bool_line, lowered, bool_line_starts)],
+    )
+    del lowered
+
+    # Match each pattern in turn, only keeping the lines that didn't match
+    for key, pattern, required in _structural_line_patterns:
+        if required is not None and required not in buffer:
+            continue
+        lines = _matching_lines(pattern, buffer, line_starts)
+        if not len(lines):
+            continue
+        count(key, counts[lines])
+        unmatched = numpy.ones(len(array), dtype=bool)
+        unmatched[lines] = False
+        array = array[unmatched]
+        counts = counts[unmatched]
+        buffer, line_starts = _join_lines(array)
+
+    count('text', counts[_matching_lines(_re_text_line, buffer, line_starts)])
+
+    return re_count
+
+
+@functools.lru_cache()
+def _unmatched_line_pattern(keys):
+    """Build a pattern matching the non-empty lines that no pattern matches.
+    """
+    patterns = {
+        key: pattern for key, pattern, _ in _structural_line_patterns
+    }
+    # Line patterns are '^(?:...)$'
+    alternatives = '|'.join(patterns[key].pattern[1:] for key in keys)
+    return re.compile(
+        r'^(?!' + alternatives + r')[^\n]+$',
+        re.MULTILINE,
+    )
+
+
+def count_unmatched(array, counts, keys):
+    """Count the non-empty values that don't match any of the given structures.
+
+    This gives the same result as using :func:`regular_exp_count`, but is
+    faster for clean columns since only the unmatched values are iterated on.
+
+    :param keys: Keys from `_structural_line_patterns`, only 'int' and 'float'
+        are supported
+    """
+    array = numpy.asarray(array, dtype=object)
+    counts = numpy.asarray(counts, dtype=numpy.int64)
+
+    unmatched = 0
+    multiline = numpy.array(['\n' in elem for elem in array], dtype=bool)
+    if multiline.any():
+        re_count = collections.Counter()
+        _regular_exp_count_elementwise(
+            array[multiline], counts[multiline],
+            re_count,
+        )
+        unmatched += int(counts[multiline].sum()) - re_count['empty']
+        unmatched -= sum(re_count[key] for key in keys)
+        array = array[~multiline]
+        counts = counts[~multiline]
+
+    buffer, line_starts = _join_lines(array)
+    lines = _matching_lines(
+        _unmatched_line_pattern(tuple(keys)),
+        buffer, line_starts,
+    )
+    unmatched += int(counts[lines].sum())
+    return unmatched
+
+
+def _sample_margin(ratio, total):
+    """How far a ratio measured on `total` sampled rows can be from `ratio`
+    while still being unclear.
+    """
+    return PROGRESSIVE_MARGIN * math.sqrt(ratio * (1.0 - ratio) / total)
+
+
+def _clearly_below(count, total, ratio):
+    """Whether the ratio `count / total` measured on a sample is clearly below
+    `ratio` for the whole column.
+    """
+    if total == 0:
+        return False
+    return count / total < ratio - _sample_margin(ratio, total)
+
+
+def _clearly_above(count, total, ratio):
+    """Whether the ratio `count / total` measured on a sample is clearly above
+    `ratio` for the whole column.
+    """
+    if total == 0:
+        return False
+    return count / total > ratio + _sample_margin(ratio, total)
+
+
+def progressive_regular_exp_count(uniques, counts, sample_uniques,
+                                  sample_counts):
+    """Get structure counts for a column from a sample, if that is conclusive.
+
+    The counts returned lead to the same decisions as the counts for the whole
+    column: counts that are clearly under their threshold in the sample are
+    set to zero, and the count for the structural type that is picked is exact
+    (it is used for the unclean values ratio).
+
+    :param uniques: The distinct values of the column
+    :param counts: The number of occurrences of each distinct value
+    :param sample_uniques: The distinct values in a sample of rows
+    :param sample_counts: The number of occurrences in the sample
+    :return: A `Counter` like :func:`regular_exp_count`, or None if the whole
+        column needs to be scanned
+    """
+    num_total = int(counts.sum())
+    num_empty = int(counts[uniques == ''].sum())
+    threshold = max(1, (1.0 - MAX_UNCLEAN) * (num_total - num_empty))
+
+    sample_count = regular_exp_count(sample_uniques, sample_counts)
+    sample_total = int(sample_counts.sum()) - sample_count['empty']
+    if sample_total == 0:
+        return None
+
+    def below(count, ratio=1.0 - MAX_UNCLEAN):
+        return _clearly_below(count, sample_total, ratio)
+
+    re_count = collections.Counter()
+    if num_empty:
+        re_count['empty'] = num_empty
+    if not below(sample_count['bool']):
+        return None
+
+    if not below(sample_count['int']):
+        key, keys = 'int', ('int',)
+    elif not below(sample_count['int'] + sample_count['float']):
+        key, keys = 'float', ('int', 'float')
+    elif all(
+        below(sample_count[k])
+        for k in ('point', 'geo_combined', 'other_point', 'latlong_point',
+                  'polygon')
+    ):
+        # Text, check for free text
+        text_ratio = 1.0 - TEXT_WORDS_THRESHOLD
+        if _clearly_above(sample_count['text'], sample_total, text_ratio):
+            re_count['text'] = num_total - num_empty
+        elif not _clearly_below(sample_count['text'], sample_total, text_ratio):
+            return None
+        return re_count
+    else:
+        return None
 
+    # Get the exact count for the structural type
+    num_matched = num_total - num_empty - count_unmatched(uniques, counts, keys)
+    if num_matched < threshold:
+        return None
+    re_count[key] = num_matched
     return re_count
 
 
+def _clearly_not_dates(sample_uniques, sample_counts):
+    """Whether a sample of rows shows that a column is not temporal.
+    """
+    ratio = 1.0 - MAX_UNCLEAN
+    total = sample_counts[sample_uniques != ''].sum()
+    if total == 0:
+        return False
+    # Stop parsing as soon as there can't be enough dates
+    min_count = (ratio - _sample_margin(ratio, total)) * total
+    dates = parse_date_array(sample_uniques, sample_counts, min_count=min_count)
+    return dates is None
+
+
+def resolve_names(geo_data, values):
+    """Resolve administrative areas from names, like
+    ``geo_data.resolve_names_all()``.
+
+    Values that are not known names are not looked up.
+    """
+    name_filter = get_admin_names(geo_data)
+    if name_filter is None:
+        return geo_data.resolve_names_all(values)
+    values = list(values)
+    found = name_filter.contains_many(values)
+    PROM_ADMIN_NAMES_SAVED_LOOKUPS.inc(len(values) - int(found.sum()))
+    resolved = geo_data.resolve_names_all(
+        [value for value, f in zip(values, found) if f],
+    )
+    resolved = iter(resolved)
+    return [next(resolved) if f else [] for f in found]
+
+
+def resolve_admin_areas(geo_data, values, ratio):
+    """Resolve distinct values to administrative areas, skipping the lookup if
+    less than `ratio` of them can be names.
+
+    :return: The non-empty resolutions, or an empty list if the lookup was
+        skipped
+    """
+    name_filter = get_admin_names(geo_data)
+    if name_filter is None:
+        admin_areas = geo_data.resolve_names_all(values)
+        return [r for r in admin_areas if r]
+    values = list(values)
+
+    # Check a sample first
+    if len(values) > ADMIN_NAMES_SAMPLE:
+        rand = numpy.random.RandomState(0)
+        sample = rand.choice(len(values), ADMIN_NAMES_SAMPLE, replace=False)
+        hits = name_filter.contains_many([values[i] for i in sample])
+        if _clearly_below(int(hits.sum()), ADMIN_NAMES_SAMPLE, ratio):
+            PROM_ADMIN_NAMES_SKIPPED.inc()
+            PROM_ADMIN_NAMES_SAVED_LOOKUPS.inc(len(values))
+            return []
+
+    # There are no false negatives, so only candidates can resolve
+    found = name_filter.contains_many(values)
+    nb_found = int(found.sum())
+    PROM_ADMIN_NAMES_SAVED_LOOKUPS.inc(len(values) - nb_found)
+    if nb_found <= ratio * len(values):
+        PROM_ADMIN_NAMES_SKIPPED.inc()
+        return []
+    admin_areas = geo_data.resolve_names_all(
+        [value for value, f in zip(values, found) if f],
+    )
+    return [r for r in admin_areas if r]
+
+
 def unclean_values_ratio(c_type, re_count, num_total):
     """Count how many values don't match a given type.
 
@@ -142,7 +496,181 @@ def parse_dates(array):
     return parsed_dates
 
 
-def identify_types(array, name, geo_data, manual=None):
+def factorize_column(array):
+    """Find the distinct values of a column and how often they appear.
+
+    :return: A tuple ``(codes, uniques, counts)`` where `uniques` is an array
+        of the distinct values in order of first appearance, `codes` is the
+        index into `uniques` of each element of `array`, and `counts` is the
+        number of occurrences of each distinct value.
+    """
+    codes, uniques = pandas.factorize(numpy.asarray(array, dtype=object))
+    counts = numpy.bincount(codes, minlength=len(uniques))
+    return codes, numpy.asarray(uniques, dtype=object), counts
+
+
+def expand_distinct(values, codes):
+    """Expand values computed for each distinct value back to each row.
+
+    This is the reverse of :func:`factorize_column`, dropping rows for which
+    the value is ``None``. The original row order is kept.
+    """
+    array = numpy.empty(len(values), dtype=object)
+    array[:] = values
+    return [e for e in array[codes] if e is not None]
+
+
+def to_str_array(values):
+    """Convert values to strings, the same way for all kinds of columns.
+
+    `values` should not contain missing values.
+    """
+    return pandas.Series(values).astype(object).astype(str).values
+
+
+class ParsedColumn(object):
+    """Representations of a column's values, computed when first needed.
+
+    This is shared by the profiling steps so that parsing the values is only
+    done once. Most representations are computed once per distinct value.
+
+    The column can be made of strings, or be a pandas Series of numbers or
+    datetimes. For the latter, `uniques` still contains strings (missing
+    values become the empty string), which type detection relies on, but
+    numbers and dates are taken from the typed values directly rather than
+    parsed.
+    """
+    def __init__(self, array):
+        self.array = array
+        dtype = getattr(array, 'dtype', None)
+        #: Whether the column is a Series of numbers or datetimes
+        self.typed = dtype is not None and dtype.kind in 'iufM'
+        self._factorized = None
+        self._typed_uniques = None
+        self._unique_floats = None
+        self._floats = None
+        #: The dates for each distinct value (or None), set once the column
+        #: has been identified as temporal
+        self.unique_dates = None
+
+    @property
+    def codes(self):
+        """Index of each row's value into `uniques`.
+        """
+        return self._factorize()[0]
+
+    @property
+    def uniques(self):
+        """Distinct values, in order of first appearance.
+        """
+        return self._factorize()[1]
+
+    @property
+    def counts(self):
+        """Number of occurrences of each distinct value.
+        """
+        return self._factorize()[2]
+
+    def _factorize(self):
+        if self._factorized is None:
+            if self.typed:
+                self._factorized = self._factorize_typed()
+            else:
+                self._factorized = factorize_column(self.array)
+        return self._factorized
+
+    def _factorize_typed(self):
+        codes, typed_uniques = pandas.factorize(self.array)
+        self._typed_uniques = typed_uniques
+        uniques = to_str_array(typed_uniques)
+        missing = codes == -1
+        if missing.any():
+            codes[missing] = len(uniques)
+            uniques = numpy.append(uniques, '')
+        counts = numpy.bincount(codes, minlength=len(uniques))
+        return codes, uniques, counts
+
+    def sample(self, size):
+        """Draw a sample of rows, with replacement.
+
+        :return: A tuple ``(uniques, counts)`` of the distinct values in the
+            sample and the number of times they were drawn.
+        """
+        rand = numpy.random.RandomState(0)
+        rows = rand.randint(0, len(self.codes), size)
+        counts = numpy.bincount(self.codes[rows], minlength=len(self.uniques))
+        drawn = numpy.flatnonzero(counts)
+        return self.uniques[drawn], counts[drawn]
+
+    @property
+    def unique_floats(self):
+        """Float value of each distinct value, NaN if it is not a number.
+        """
+        if self._unique_floats is None and self.typed:
+            floats = numpy.full(len(self.uniques), numpy.nan)
+            if self.array.dtype.kind != 'M':
+                nb_typed = len(self._typed_uniques)
+                floats[:nb_typed] = numpy.asarray(
+                    self._typed_uniques, dtype=numpy.float64,
+                )
+            self._unique_floats = floats
+        elif self._unique_floats is None:
+            floats = numpy.full(len(self.uniques), numpy.nan)
+            for i, e in enumerate(self.uniques):
+                try:
+                    floats[i] = float(e)
+                except ValueError:
+                    pass
+            self._unique_floats = floats
+        return self._unique_floats
+
+    @property
+    def floats(self):
+        """Float value of each row, NaN if it is not a number.
+        """
+        if self._floats is None:
+            self._floats = self.unique_floats[self.codes]
+        return self._floats
+
+    def parse_dates(self, min_count=None):
+        """Parse each distinct value as a date.
+
+        :param min_count: See :func:`parse_date_array`
+        :return: An array of `datetime` (or None) for each distinct value, or
+            None if `min_count` can't be reached.
+        """
+        if self.typed and self.array.dtype.kind == 'M':
+            self._factorize()
+            dates = numpy.full(len(self.uniques), None, dtype=object)
+            typed_uniques = pandas.DatetimeIndex(self._typed_uniques)
+            pydatetimes = typed_uniques.to_pydatetime()
+            if typed_uniques.tz is None:
+                pydatetimes = [
+                    dt.replace(tzinfo=dateutil.tz.UTC) for dt in pydatetimes
+                ]
+            dates[:len(typed_uniques)] = pydatetimes
+            return dates
+        return parse_date_array(self.uniques, self.counts, min_count=min_count)
+
+    def unique_timestamps(self):
+        """UNIX timestamp of each distinct value that is a date, else NaN.
+        """
+        timestamps = numpy.full(len(self.unique_dates), numpy.nan)
+        for i, dt in enumerate(self.unique_dates):
+            if dt is not None:
+                timestamps[i] = dt.timestamp()
+        return timestamps
+
+    def unique_datetime64(self):
+        """The distinct dates, as a datetime64 array of wall-clock times.
+        """
+        return to_datetime64(
+            [dt for dt in self.unique_dates if dt is not None],
+        )
+
+
+def identify_types(array, name, geo_data, manual=None, parsed=None,
+                   progressive=True, timings=None):
     """Identify the structural type and semantic types of an array.
 
     :param array: The list, series, or array to inspect
@@ -150,6 +678,14 @@ def identify_types(array, name, geo_data, manual=None):
         heuristics like latitude, longitude, year number.
     :param manual: Manual information provided by the user that will be
         reconciled with the observed data.
+    :param parsed: A :class:`ParsedColumn` for `array`, if one already
+        exists. Its `unique_dates` will be set if the column is temporal.
+    :param progressive: If the column has many distinct values, classify a
+        sample of rows first, and only look at the whole column if the result
+        is close to the thresholds.
+    :param timings: A :class:`~datamart_profiler.timings.StageTimings` to
+        record the time spent parsing dates and resolving administrative
+        areas.
     :return: A tuple ``(structural_type, semantic_types_dict, column_meta)``
         where `structural_type` is the detected structural type (e.g. storage
         format), `semantic_types_dict` is a dict mapping semantic types (e.g.
@@ -159,8 +695,20 @@ def identify_types(array, name, geo_data, manual=None):
     num_total = len(array)
     column_meta = {}
 
+    # Most of the work is done once per distinct value, weighted by count
+    if parsed is None:
+        parsed = ParsedColumn(array)
+    codes, uniques, counts = parsed.codes, parsed.uniques, parsed.counts
+
+    # Try to identify the types from a sample first
+    re_count = sample = None
+    if progressive and not manual and len(uniques) >= PROGRESSIVE_MIN_DISTINCT:
+        sample = parsed.sample(PROGRESSIVE_SAMPLE_ROWS)
+        re_count = progressive_regular_exp_count(uniques, counts, *sample)
+
     # This function let you check/count how many instances match a structure of particular data type
-    re_count = regular_exp_count(array)
+    if re_count is None:
+        re_count = regular_exp_count(uniques, counts)
 
     # Identify structural type and compute unclean values ratio
     threshold = max(1, (1.0 - MAX_UNCLEAN) * (num_total - re_count['empty']))
@@ -191,7 +739,9 @@ def identify_types(array, name, geo_data, manual=None):
     if structural_type != types.MISSING_DATA and re_count['empty'] > 0:
         column_meta['missing_values_ratio'] = re_count['empty'] / num_total
 
-    distinct_values = functools.lru_cache()(lambda: set(e for e in array if e))
+    distinct_values = functools.lru_cache()(lambda: set(e for e in uniques if e))
+    # Values in uniques are distinct, the empty string might be one of them
+    num_distinct = len(uniques) - (1 if re_count['empty'] else 0)
 
     semantic_types_dict = {}
     if manual:
@@ -203,19 +753,25 @@ def identify_types(array, name, geo_data, manual=None):
                 column_meta['unclean_values_ratio'] = \
                     unclean_values_ratio(types.BOOLEAN, re_count, num_total)
             if el == types.DATE_TIME:
-                dates = parse_dates(array)
+                with timed(timings, 'dates', name):
+                    parsed.unique_dates = parsed.parse_dates()
+                dates = expand_distinct(parsed.unique_dates, codes)
                 semantic_types_dict[types.DATE_TIME] = dates
             if el == types.ADMIN:
-                if geo_data is not None and len(distinct_values()) >= 3:
-                    admin_areas = geo_data.resolve_names_all(array)
-                    admin_areas = [r for r in admin_areas if r]
+                if geo_data is not None and num_distinct >= 3:
+                    with timed(timings, 'admin_areas', name):
+                        admin_areas = expand_distinct(
+                            resolve_names(geo_data, uniques),
+                            codes,
+                        )
+                        admin_areas = [r for r in admin_areas if r]
+                        if admin_areas:
+                            admin_areas = disambiguate_admin_areas(admin_areas)
                     if admin_areas:
-                        admin_areas = disambiguate_admin_areas(admin_areas)
-                        if admin_areas is not None:
-                            semantic_types_dict[types.ADMIN] = admin_areas
+                        semantic_types_dict[types.ADMIN] = admin_areas
             if el == types.CATEGORICAL or el == types.INTEGER:
                 # Count distinct values
-                column_meta['num_distinct_values'] = len(distinct_values())
+                column_meta['num_distinct_values'] = num_distinct
                 if el == types.CATEGORICAL:
                     semantic_types_dict[types.CATEGORICAL] = distinct_values()
     else:
@@ -233,15 +789,18 @@ def identify_types(array, name, geo_data, manual=None):
             categorical = False
 
             # Administrative areas
-            if geo_data is not None and len(distinct_values()) >= 3:
-                admin_areas = geo_data.resolve_names_all(distinct_values())
-                admin_areas = [r for r in admin_areas if r]
-                if len(admin_areas) > 0.7 * len(distinct_values()):
-
-                    admin_areas = disambiguate_admin_areas(admin_areas)
-                    if admin_areas is not None:
-                        semantic_types_dict[types.ADMIN] = admin_areas
-                        categorical = True
+            if geo_data is not None and num_distinct >= 3:
+                with timed(timings, 'admin_areas', name):
+                    admin_areas = resolve_admin_areas(
+                        geo_data, distinct_values(), ADMIN_AREAS_RATIO,
+                    )
+                    if len(admin_areas) > ADMIN_AREAS_RATIO * num_distinct:
+                        admin_areas = disambiguate_admin_areas(admin_areas)
+                    else:
+                        admin_areas = None
+                if admin_areas is not None:
+                    semantic_types_dict[types.ADMIN] = admin_areas
+                    categorical = True
 
             # Different threshold there, we don't need all text to be many words
             text_threshold = max(
@@ -253,11 +812,11 @@ def identify_types(array, name, geo_data, manual=None):
                 semantic_types_dict[types.TEXT] = None
             else:
                 # Count distinct values
-                column_meta['num_distinct_values'] = len(distinct_values())
+                column_meta['num_distinct_values'] = num_distinct
                 max_categorical = MAX_CATEGORICAL_RATIO * (len(array) - num_empty)
                 if (
                     categorical or
-                    len(distinct_values()) <= max_categorical or
+                    num_distinct <= max_categorical or
                     types.BOOLEAN in semantic_types_dict
                 ):
                     semantic_types_dict[types.CATEGORICAL] = distinct_values()
@@ -274,47 +833,52 @@ def identify_types(array, name, geo_data, manual=None):
                 semantic_types_dict[types.ID] = None
 
             # Count distinct values
-            column_meta['num_distinct_values'] = len(distinct_values())
+            column_meta['num_distinct_values'] = num_distinct
 
             # Identify years
             if name.strip().lower() == 'year':
                 dates = []
-                for year in array:
+                for year in uniques:
                     try:
                         dates.append(datetime(
                             int(year), 1, 1,
                             tzinfo=dateutil.tz.UTC,
                         ))
                     except ValueError:
-                        pass
+                        dates.append(None)
+                unique_dates = dates
+                dates = expand_distinct(unique_dates, codes)
                 if len(dates) >= threshold:
                     structural_type = types.TEXT
                     semantic_types_dict[types.DATE_TIME] = dates
+                    parsed.unique_dates = unique_dates
 
         # Identify lat/long
         if structural_type == types.FLOAT:
-            num_lat = num_long = 0
-            for elem in array:
-                try:
-                    elem = float(elem)
-                except ValueError:
-                    pass
-                else:
-                    if -180.0 <= float(elem) <= 180.0:
-                        num_long += 1
-                        if -90.0 <= float(elem) <= 90.0:
-                            num_lat += 1
+            floats = parsed.unique_floats
+            with numpy.errstate(invalid='ignore'):
+                num_long = counts[(-180.0 <= floats) & (floats <= 180.0)].sum()
+                num_lat = counts[(-90.0 <= floats) & (floats <= 90.0)].sum()
 
             if num_lat >= threshold and any(n in name.lower() for n in LATITUDE):
                 semantic_types_dict[types.LATITUDE] = None
             if num_long >= threshold and any(n in name.lower() for n in LONGITUDE):
                 semantic_types_dict[types.LONGITUDE] = None
 
-        # Identify dates
-        parsed_dates = parse_dates(array)
+        # Identify dates, giving up early if there can't be enough of them
+        if sample is not None and _clearly_not_dates(*sample):
+            unique_dates = None
+        else:
+            with timed(timings, 'dates', name):
+                unique_dates = parsed.parse_dates(min_count=threshold)
+        if unique_dates is None:
+            parsed_dates = []
+        else:
+            parsed_dates = expand_distinct(unique_dates, codes)
 
         if len(parsed_dates) >= threshold:
             semantic_types_dict[types.DATE_TIME] = parsed_dates
+            parsed.unique_dates = unique_dates
             if structural_type == types.INTEGER:
                 # 'YYYYMMDD' format means values can be parsed as integers, but
                 # that's not what they are
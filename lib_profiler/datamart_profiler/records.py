@@ -0,0 +1,126 @@
+import io
+import logging
+import numpy
+
+
+logger = logging.getLogger(__name__)
+
+
+CHUNK_SIZE = 8 << 20  # 8 MiB
+
+#: If a record grows larger than this, assume that a stray quote character
+#: made us miss its end
+MAX_RECORD_SIZE = 16 << 20  # 16 MiB
+
+_QUOTE = ord('"')
+_NEWLINE = ord('\n')
+_CARRIAGE_RETURN = ord('\r')
+
+
+def iter_record_chunks(fp, chunk_size=CHUNK_SIZE):
+    """Read a CSV file in buffers made of complete records.
+
+    Newlines are only considered the end of a record if they are not in a
+    quoted field, which is determined by counting quote characters.
+
+    :param fp: A file object, in binary or text mode (text will be encoded to
+        UTF-8)
+    :return: An iterator of ``(buffer, ends)`` tuples, where `buffer` is a
+        `bytes` object made of complete records and `ends` is a numpy array of
+        the offset right after each record (after its newline, except maybe
+        for the last record of the file).
+    """
+    tail = b''
+    while True:
+        chunk = fp.read(chunk_size)
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        if not chunk:
+            break
+        buffer = tail + chunk
+        del chunk
+
+        array = numpy.frombuffer(buffer, dtype=numpy.uint8)
+        newlines = numpy.flatnonzero(array == _NEWLINE)
+        quotes = numpy.flatnonzero(array == _QUOTE)
+        del array
+        # A newline ends a record if there is an even number of quotes in the
+        # buffer before it (the buffer always starts at the start of a record)
+        quotes_before = numpy.searchsorted(quotes, newlines)
+        ends = newlines[quotes_before % 2 == 0] + 1
+        if not len(ends) and len(newlines) and len(buffer) > MAX_RECORD_SIZE:
+            logger.warning(
+                "No end of record in %d bytes, ignoring a quote character",
+                len(buffer),
+            )
+            ends = newlines[quotes_before % 2 == 1] + 1
+
+        if len(ends):
+            tail = buffer[ends[-1]:]
+            yield buffer[:ends[-1]], ends
+        else:
+            tail = buffer
+
+    if tail:
+        yield tail, numpy.array([len(tail)], dtype=numpy.int64)
+
+
+def record_is_blank(buffer, starts, ends):
+    """Check which records of a buffer are empty lines.
+
+    Those are skipped by ``pandas.read_csv()``.
+    """
+    lengths = ends - starts
+    array = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    last = array[numpy.maximum(ends - 1, 0)]
+    second_last = array[numpy.maximum(ends - 2, 0)]
+    # Record is just '\n' or '\r\n'
+    return (
+        (lengths == 0) |
+        ((lengths == 1) & (last == _NEWLINE)) |
+        ((lengths == 2) & (last == _NEWLINE) & (second_last == _CARRIAGE_RETURN))
+    )
+
+
+def sample_records(fp, ratio, random_seed, chunk_size=CHUNK_SIZE):
+    """Count the rows of a CSV file and sample them, in a single pass.
+
+    Each row is kept with probability `ratio`, using a seeded random generator
+    so that results are reproducible. Empty lines are ignored.
+
+    :return: A tuple ``(nb_rows, sample)`` where `nb_rows` is the total
+        number of rows in the file (not counting the header) and `sample` is a
+        binary file object containing the header and the selected rows.
+    """
+    rand = numpy.random.RandomState(random_seed)
+    nb_rows = 0
+    header = True
+    sample = io.BytesIO()
+    for buffer, ends in iter_record_chunks(fp, chunk_size):
+        starts = numpy.empty_like(ends)
+        starts[0] = 0
+        starts[1:] = ends[:-1]
+
+        # Drop empty lines
+        not_blank = ~record_is_blank(buffer, starts, ends)
+        starts = starts[not_blank]
+        ends = ends[not_blank]
+
+        # Always keep the header
+        if header and len(ends):
+            sample.write(buffer[starts[0]:ends[0]])
+            if buffer[ends[0] - 1] != _NEWLINE:
+                sample.write(b'\n')
+            starts = starts[1:]
+            ends = ends[1:]
+            header = False
+
+        nb_rows += len(ends)
+        keep = rand.random_sample(len(ends)) < ratio
+        sample.write(b''.join([
+            buffer[start:end]
+            for start, end in zip(starts[keep].tolist(), ends[keep].tolist())
+        ]))
+
+    sample.seek(0, 0)
+    return nb_rows, sample
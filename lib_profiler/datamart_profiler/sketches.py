@@ -0,0 +1,447 @@
+import collections
+from datetime import datetime
+import dateutil.tz
+import logging
+import math
+import numpy
+import pandas
+import re
+
+from .numerical import get_numerical_ranges
+from .temporal import parse_date_array
+from . import types
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Number of bits of the hash used to pick a HyperLogLog register
+HLL_PRECISION = 14  # 16384 registers, ~0.8% error
+
+#: Number of values kept at the top level of the quantile sketch
+QUANTILE_SKETCH_SIZE = 1024
+
+#: Number of evenly-spaced quantiles used in place of the data to compute
+#: ranges
+QUANTILE_POINTS = 1000
+
+#: Number of entries kept by the top-k counters
+TOP_K_SIZE = 1000
+
+_re_word_split = re.compile(r'\W+')
+
+
+class HyperLogLog(object):
+    """Approximate count of distinct values.
+    """
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = numpy.zeros(1 << precision, dtype=numpy.uint8)
+
+    def update(self, values):
+        """Add values (strings) to the sketch.
+        """
+        if not len(values):
+            return
+        hashes = pandas.util.hash_array(numpy.asarray(values, dtype=object))
+        self.update_hashes(hashes)
+
+    def update_hashes(self, hashes):
+        """Add 64-bit hashes of values to the sketch.
+        """
+        hashes = numpy.asarray(hashes, dtype=numpy.uint64)
+        bits = 64 - self.precision
+        index = (hashes >> numpy.uint64(bits)).astype(numpy.int64)
+        # Position of the leftmost 1 in the remaining bits. Those are exactly
+        # represented as floats, so frexp() gives their bit length
+        rest = hashes & numpy.uint64((1 << bits) - 1)
+        _, bit_length = numpy.frexp(rest.astype(numpy.float64))
+        rank = (bits + 1 - bit_length).astype(numpy.uint8)
+        numpy.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("Can't merge HyperLogLog of different precision")
+        numpy.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self):
+        nb_registers = len(self.registers)
+        alpha = 0.7213 / (1.0 + 1.079 / nb_registers)
+        estimate = alpha * nb_registers * nb_registers / numpy.sum(
+            numpy.ldexp(1.0, -self.registers.astype(numpy.int64))
+        )
+        zeros = numpy.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * nb_registers and zeros:
+            # Small range correction (linear counting)
+            estimate = nb_registers * math.log(nb_registers / zeros)
+        return int(round(estimate))
+
+
+class QuantileSketch(object):
+    """Approximate distribution of numerical values, with exact min and max.
+
+    This is a stack of compactors (as in the KLL sketch): when a level gets
+    full, it is sorted and every other value is promoted to the next level,
+    where each value counts double.
+    """
+    def __init__(self, size=QUANTILE_SKETCH_SIZE):
+        self.size = size
+        self.levels = [numpy.empty(0)]
+        self.count = 0
+        self.min = self.max = None
+        self._rand = numpy.random.RandomState(0)
+
+    def update(self, values):
+        """Add values (floats) to the sketch.
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        values = values[~numpy.isnan(values)]
+        if not len(values):
+            return
+        self._update_range(len(values), values.min(), values.max())
+        self.levels[0] = numpy.concatenate([self.levels[0], values])
+        self._compress()
+
+    def merge(self, other):
+        if not other.count:
+            return
+        self._update_range(other.count, other.min, other.max)
+        for level, values in enumerate(other.levels):
+            if level < len(self.levels):
+                self.levels[level] = numpy.concatenate(
+                    [self.levels[level], values],
+                )
+            else:
+                self.levels.append(values.copy())
+        self._compress()
+
+    def _update_range(self, count, min_, max_):
+        if self.count:
+            self.min = min(self.min, min_)
+            self.max = max(self.max, max_)
+        else:
+            self.min, self.max = min_, max_
+        self.count += count
+
+    def _capacity(self, level):
+        # Lower levels hold fewer values, as in KLL
+        depth = len(self.levels) - 1 - level
+        return max(8, int(self.size * (2.0 / 3.0) ** depth))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if len(values) > self._capacity(level):
+                values = numpy.sort(values)
+                # Keep one value here if odd, so that total weight is exact
+                if len(values) % 2:
+                    self.levels[level] = values[-1:]
+                    values = values[:-1]
+                else:
+                    self.levels[level] = values[:0]
+                promoted = values[self._rand.randint(2)::2]
+                if level + 1 == len(self.levels):
+                    self.levels.append(promoted)
+                else:
+                    self.levels[level + 1] = numpy.concatenate(
+                        [self.levels[level + 1], promoted],
+                    )
+            level += 1
+
+    def _weighted(self):
+        values = numpy.concatenate(self.levels)
+        weights = numpy.concatenate([
+            numpy.full(len(values), 1 << level, dtype=numpy.int64)
+            for level, values in enumerate(self.levels)
+        ])
+        order = numpy.argsort(values, kind='stable')
+        return values[order], weights[order]
+
+    def quantiles(self, fractions):
+        """Get the approximate values at the given quantiles (0-1).
+        """
+        if not self.count:
+            return numpy.empty(0)
+        values, weights = self._weighted()
+        cumulative = numpy.cumsum(weights)
+        ranks = numpy.asarray(fractions, dtype=numpy.float64) * self.count
+        idx = numpy.searchsorted(cumulative, ranks, side='right')
+        result = values[numpy.minimum(idx, len(values) - 1)]
+        # Min and max are exact
+        result[ranks <= 0] = self.min
+        result[ranks >= self.count] = self.max
+        return result
+
+    def quantile_points(self, nb_points=QUANTILE_POINTS):
+        """Get evenly-spaced quantiles, that can stand in for the data.
+        """
+        nb_points = min(nb_points, self.count)
+        if not nb_points:
+            return numpy.empty(0)
+        return self.quantiles((numpy.arange(nb_points) + 0.5) / nb_points)
+
+    def histogram(self, bins=10):
+        """Compute an approximate histogram, like `numpy.histogram()`.
+        """
+        if not self.count:
+            return numpy.zeros(bins, dtype=numpy.int64), numpy.zeros(bins + 1)
+        if self.min == self.max:
+            edges = numpy.linspace(self.min - 0.5, self.max + 0.5, bins + 1)
+        else:
+            edges = numpy.linspace(self.min, self.max, bins + 1)
+        values, weights = self._weighted()
+        cumulative = numpy.concatenate([[0], numpy.cumsum(weights)])
+        below = cumulative[numpy.searchsorted(values, edges, side='left')]
+        # Last bin includes its upper edge
+        below[-1] = self.count
+        return numpy.diff(below), edges
+
+
+class TopK(object):
+    """Bounded counter that keeps track of the most frequent values.
+
+    Counts of values that get dropped are lost, so counts are underestimated
+    for values that are not much more frequent than others.
+    """
+    def __init__(self, size=TOP_K_SIZE):
+        self.size = size
+        self.counter = collections.Counter()
+
+    def update(self, values, counts):
+        for value, count in zip(values, counts):
+            self.counter[value] += int(count)
+        self._truncate()
+
+    def merge(self, other):
+        self.counter.update(other.counter)
+        self._truncate()
+
+    def _truncate(self):
+        if len(self.counter) > 2 * self.size:
+            self.counter = collections.Counter(
+                dict(self.counter.most_common(self.size)),
+            )
+
+    def most_common(self, n):
+        return self.counter.most_common(n)
+
+
+class Moments(object):
+    """Streaming mean and standard deviation.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, values):
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if not len(values):
+            return
+        other = Moments()
+        other.count = len(values)
+        other.mean = float(values.mean())
+        other.m2 = float(((values - other.mean) ** 2).sum())
+        self.merge(other)
+
+    def merge(self, other):
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+
+    def stddev(self):
+        return math.sqrt(self.m2 / self.count) if self.count else 0
+
+
+class ColumnSketch(object):
+    """Mergeable summary of a column, to profile data that doesn't fit in memory.
+
+    Which summaries are kept depends on the types identified for the column
+    (from a sample). Sketches of different chunks of a file can be merged.
+    """
+    def __init__(self, column_meta):
+        structural_type = column_meta['structural_type']
+        semantic_types = column_meta['semantic_types']
+        self.year = column_meta['name'].strip().lower() == 'year'
+
+        self.nb_values = 0
+        self.nb_empty = 0
+        self.distinct = HyperLogLog()
+        self.numbers = self.moments = None
+        if structural_type in (types.INTEGER, types.FLOAT):
+            self.numbers = QuantileSketch()
+            self.moments = Moments()
+        self.timestamps = None
+        if types.DATE_TIME in semantic_types:
+            self.timestamps = QuantileSketch()
+        self.values = None
+        if types.CATEGORICAL in semantic_types:
+            self.values = TopK()
+        self.words = None
+        if types.TEXT in semantic_types:
+            self.words = TopK()
+
+    def update(self, array):
+        """Add a chunk of the column (strings) to the sketch.
+        """
+        array = numpy.asarray(array, dtype=object)
+        self.nb_values += len(array)
+        codes, uniques = pandas.factorize(array)
+        counts = numpy.bincount(codes, minlength=len(uniques))
+        empty = uniques == ''
+        if empty.any():
+            self.nb_empty += int(counts[empty].sum())
+            uniques = uniques[~empty]
+            counts = counts[~empty]
+
+        self.distinct.update(uniques)
+
+        if self.numbers is not None:
+            numbers = pandas.to_numeric(
+                pandas.Series(uniques),
+                errors='coerce',
+            ).values.astype(numpy.float64)
+            # Values that overflow in Elasticsearch are ignored
+            valid = (-3.4e38 < numbers) & (numbers < 3.4e38)
+            numbers = numpy.repeat(numbers[valid], counts[valid])
+            self.numbers.update(numbers)
+            self.moments.update(numbers)
+
+        if self.timestamps is not None:
+            timestamps = numpy.full(len(uniques), numpy.nan)
+            dates = parse_date_array(uniques)
+            for i, (value, dt) in enumerate(zip(uniques, dates)):
+                if dt is None and self.year:
+                    try:
+                        dt = datetime(int(value), 1, 1, tzinfo=dateutil.tz.UTC)
+                    except ValueError:
+                        pass
+                if dt is not None:
+                    timestamps[i] = dt.timestamp()
+            valid = ~numpy.isnan(timestamps)
+            self.timestamps.update(numpy.repeat(
+                timestamps[valid], counts[valid],
+            ))
+
+        if self.values is not None:
+            self.values.update(uniques, counts)
+
+        if self.words is not None:
+            words = collections.Counter()
+            for value, count in zip(uniques, counts):
+                for word in _re_word_split.split(value):
+                    word = word.lower()
+                    if word:
+                        words[word] += int(count)
+            self.words.update(words.keys(), words.values())
+
+    def merge(self, other):
+        """Merge the sketch of another chunk of the same column.
+        """
+        self.nb_values += other.nb_values
+        self.nb_empty += other.nb_empty
+        self.distinct.merge(other.distinct)
+        for attr in ('numbers', 'moments', 'timestamps', 'values', 'words'):
+            mine = getattr(self, attr)
+            if mine is not None:
+                mine.merge(getattr(other, attr))
+
+    def update_metadata(self, column_meta, resolved, *, plots, coverage):
+        """Replace information computed from the sample with the sketch's.
+
+        :param column_meta: The column's metadata, updated in-place
+        :param resolved: The values resolved from the sample for this column,
+            used to compute dataset-level coverage, updated in-place
+        """
+        if not self.nb_values:
+            return
+
+        if column_meta['structural_type'] != types.MISSING_DATA:
+            if self.nb_empty:
+                column_meta['missing_values_ratio'] = \
+                    self.nb_empty / self.nb_values
+            else:
+                column_meta.pop('missing_values_ratio', None)
+
+        if 'num_distinct_values' in column_meta:
+            column_meta['num_distinct_values'] = self.distinct.count()
+
+        plot = column_meta.get('plot', {}).get('type') if plots else None
+
+        if self.numbers is not None and self.numbers.count and coverage:
+            column_meta['mean'] = self.moments.mean
+            column_meta['stddev'] = self.moments.stddev()
+            ranges = get_numerical_ranges(
+                self.numbers.quantile_points().tolist(),
+            )
+            if ranges:
+                column_meta['coverage'] = ranges
+            else:
+                column_meta.pop('coverage', None)
+            if plot == 'histogram_numerical':
+                counts, edges = self.numbers.histogram()
+                column_meta['plot']['data'] = [
+                    {
+                        "count": int(count),
+                        "bin_start": float(edges[i]),
+                        "bin_end": float(edges[i + 1]),
+                    }
+                    for i, count in enumerate(counts)
+                ]
+
+        if self.timestamps is not None and self.timestamps.count:
+            resolved['timestamps'] = self.timestamps.quantile_points()
+            if plot == 'histogram_temporal':
+                counts, edges = self.timestamps.histogram()
+                column_meta['plot']['data'] = [
+                    {
+                        "count": int(count),
+                        "date_start": datetime.utcfromtimestamp(
+                            float(edges[i]),
+                        ).isoformat(),
+                        "date_end": datetime.utcfromtimestamp(
+                            float(edges[i + 1]),
+                        ).isoformat(),
+                    }
+                    for i, count in enumerate(counts)
+                ]
+
+        if self.values is not None and plot == 'histogram_categorical':
+            counts = sorted(self.values.most_common(5))
+            column_meta['plot']['data'] = [
+                {
+                    "bin": value,
+                    "count": count,
+                }
+                for value, count in counts
+            ]
+
+        if self.words is not None and plot == 'histogram_text':
+            column_meta['plot']['data'] = [
+                {
+                    "bin": value,
+                    "count": count,
+                }
+                for value, count in self.words.most_common(5)
+            ]
+
+
+def sketch_dataframe(data, columns):
+    """Build the sketches for each column of a chunk of data.
+
+    :param data: A DataFrame of strings, as read by ``read_csv(dtype=str)``
+    :param columns: The columns' metadata, with their identified types
+    :return: A list of `ColumnSketch`, that can be merged with the sketches of
+        the other chunks
+    """
+    sketches = []
+    for column_idx, column_meta in enumerate(columns):
+        sketch = ColumnSketch(column_meta)
+        sketch.update(data.iloc[:, column_idx].values)
+        sketches.append(sketch)
+    return sketches
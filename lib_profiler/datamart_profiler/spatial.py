@@ -1,15 +1,18 @@
 import collections
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 import json
 import logging
 import numpy
 import numpy.random
+import os
 import prometheus_client
 import re
 import requests
 from sklearn.cluster import KMeans
 from sklearn.exceptions import ConvergenceWarning
 from sklearn.neighbors._kd_tree import KDTree
+import threading
 import time
 import typing
 from urllib.parse import urlencode
@@ -26,10 +29,19 @@ MIN_RANGE_SIZE = 0.10  # 10%
 SPATIAL_RANGE_DELTA_LONG = 0.0001
 SPATIAL_RANGE_DELTA_LAT = 0.0001
 
+# Maximum number of points used to compute the clusters
+SPATIAL_CLUSTERING_SAMPLE_SIZE = 50000
+
 MAX_ADDRESS_LENGTH = 90  # 90 characters
 MAX_NOMINATIM_REQUESTS = 200
 NOMINATIM_BATCH_SIZE = 20
 NOMINATIM_MIN_SPLIT_BATCH_SIZE = 2  # Batches >=this are divided on failure
+NOMINATIM_CONCURRENT_BATCHES = 4  # Batches sent to Nominatim at the same time
+
+# Columns are checked for address-like values before querying Nominatim
+ADDRESS_SAMPLE_SIZE = 200
+# Minimum ratio of sampled values that have to look like addresses
+MIN_ADDRESS_LIKE = 0.50  # 50%
 
 LATITUDE = ('latitude', 'lat', 'ycoord', 'y_coord')
 LONGITUDE = ('longitude', 'long', 'lon', 'lng', 'xcoord', 'x_coord')
@@ -43,43 +55,83 @@ PROM_NOMINATIM_REQS = prometheus_client.Counter(
 PROM_NOMINATIM_REQ_TIME = prometheus_client.Histogram(
     'profile_nominatim_req_seconds', "Time for Nominatim to answer a query",
 )
+PROM_NOMINATIM_CACHE_HITS = prometheus_client.Counter(
+    'profile_nominatim_cache_hits', "Addresses found in the geocoding cache",
+)
+PROM_NOMINATIM_CACHE_MISSES = prometheus_client.Counter(
+    'profile_nominatim_cache_misses',
+    "Addresses not found in the geocoding cache",
+)
+PROM_NOMINATIM_SAVED_REQS = prometheus_client.Counter(
+    'profile_nominatim_saved_reqs',
+    "Queries to Nominatim avoided thanks to the geocoding cache",
+)
+PROM_ADDRESS_PREFILTER_COLUMNS = prometheus_client.Counter(
+    'profile_address_prefilter_columns',
+    "Columns checked for addresses before querying Nominatim",
+)
+PROM_ADDRESS_PREFILTER_REJECTED = prometheus_client.Counter(
+    'profile_address_prefilter_rejected',
+    "Columns not sent to Nominatim because they don't look like addresses",
+)
+PROM_ADDRESS_PREFILTER_SAVED_REQS = prometheus_client.Counter(
+    'profile_address_prefilter_saved_reqs',
+    "Estimated queries to Nominatim avoided by rejecting columns",
+)
+PROM_ADDRESS_PREFILTER_SAVED_SECONDS = prometheus_client.Counter(
+    'profile_address_prefilter_saved_seconds',
+    "Estimated time waiting for Nominatim avoided by rejecting columns",
+)
 
 
 def get_spatial_ranges(values):
     """Build a small number (3) of bounding boxes from lat/long points.
 
     This performs K-Means clustering, returning a maximum of 3 clusters as
-    bounding boxes.
+    bounding boxes. If there are many points, the clusters are computed on a
+    sample, and all the points are then assigned to the closest cluster.
     """
 
+    values = numpy.asarray(values, dtype=numpy.float64).reshape(-1, 2)
+    if not len(values):
+        return []
+
     clustering = KMeans(n_clusters=min(N_RANGES, len(values)),
                         random_state=0)
-    with ignore_warnings(ConvergenceWarning):
-        clustering.fit(values)
+    if len(values) > SPATIAL_CLUSTERING_SAMPLE_SIZE:
+        rnd = numpy.random.RandomState(0)
+        sample_idx = rnd.choice(
+            len(values), SPATIAL_CLUSTERING_SAMPLE_SIZE, replace=False,
+        )
+        with ignore_warnings(ConvergenceWarning):
+            clustering.fit(values[sample_idx])
+        labels = clustering.predict(values)
+    else:
+        with ignore_warnings(ConvergenceWarning):
+            clustering.fit(values)
+        labels = clustering.labels_
     logger.info("K-Means clusters: %r", list(clustering.cluster_centers_))
 
     # Compute confidence intervals for each range
     ranges = []
     sizes = []
     for rg in range(N_RANGES):
-        cluster = [values[i]
-                   for i in range(len(values))
-                   if clustering.labels_[i] == rg]
-        if not cluster:
+        cluster = values[labels == rg]
+        if not len(cluster):
             continue
 
         # Eliminate clusters of outliers
         if len(cluster) < MIN_RANGE_SIZE * len(values):
             continue
 
-        cluster.sort(key=lambda p: p[0])
         min_idx = int(0.05 * len(cluster))
         max_idx = int(0.95 * len(cluster))
-        min_lat = cluster[min_idx][0]
-        max_lat = cluster[max_idx][0]
-        cluster.sort(key=lambda p: p[1])
-        min_long = cluster[min_idx][1]
-        max_long = cluster[max_idx][1]
+        lats = numpy.partition(cluster[:, 0], [min_idx, max_idx])
+        longs = numpy.partition(cluster[:, 1], [min_idx, max_idx])
+        min_lat = float(lats[min_idx])
+        max_lat = float(lats[max_idx])
+        min_long = float(longs[min_idx])
+        max_long = float(longs[max_idx])
         ranges.append([
             [min_long, max_lat],
             [max_long, min_lat],
@@ -207,7 +259,17 @@ def parse_wkt_column(values, latlong=False):
     return list(values)
 
 
-_nominatim_session = requests.Session()
+# requests doesn't guarantee that sessions can be used from multiple threads
+_nominatim_local = threading.local()
+
+
+def _nominatim_session():
+    pid = os.getpid()
+    if getattr(_nominatim_local, 'pid', None) != pid:
+        # Don't share the pooled connections with the parent process
+        _nominatim_local.session = requests.Session()
+        _nominatim_local.pid = pid
+    return _nominatim_local.session
 
 
 def nominatim_query(url, *, q):
@@ -220,7 +282,7 @@ def nominatim_query(url, *, q):
         start = time.perf_counter()
         if isinstance(q, (tuple, list)):
             # Batch query
-            res = _nominatim_session.get(
+            res = _nominatim_session().get(
                 url +
                 '/search?' +
                 urlencode({
@@ -230,7 +292,7 @@ def nominatim_query(url, *, q):
             )
         else:
             # Normal query
-            res = _nominatim_session.get(
+            res = _nominatim_session().get(
                 url +
                 '/search?' +
                 urlencode({'q': q, 'format': 'jsonv2'}),
@@ -252,49 +314,74 @@ def nominatim_query(url, *, q):
         return res.json()
 
 
-def _nominatim_batch(url, batch, locations, cache):
+def _nominatim_batch(url, batch):
+    """Resolve a batch of addresses, splitting it if Nominatim rejects it.
+
+    :return: A dict mapping the addresses to their location, or None if they
+        were not found.
+    """
     try:
-        locs = nominatim_query(url, q=list(batch.keys()))
+        locs = nominatim_query(url, q=batch)
     except requests.HTTPError as e:
         if (
             e.response.status_code in (500, 414)
             and len(batch) >= max(2, NOMINATIM_MIN_SPLIT_BATCH_SIZE)
         ):
             # Try smaller batch size
-            batch_list = list(batch.items())
             mid = len(batch) // 2
-            return (
-                _nominatim_batch(url, dict(batch_list[:mid]), locations, cache)
-                +
-                _nominatim_batch(url, dict(batch_list[mid:]), locations, cache)
-            )
+            resolved = _nominatim_batch(url, batch[:mid])
+            resolved.update(_nominatim_batch(url, batch[mid:]))
+            return resolved
         raise e from None
 
-    not_found = 0
-    for location, (value, count) in zip(locs, batch.items()):
+    resolved = {}
+    for location, value in zip(locs, batch):
         if location:
-            loc = (
+            resolved[value] = (
                 float(location[0]['lat']),
                 float(location[0]['lon']),
             )
-            cache[value] = loc
-            locations.extend([loc] * count)
         else:
-            cache[value] = None
-            not_found += count
-    batch.clear()
-    return not_found
-
-
-def nominatim_resolve_all(url, array, max_requests=MAX_NOMINATIM_REQUESTS):
-    cache = {}
-    locations = []
-    not_found = 0  # Unique locations not found
+            resolved[value] = None
+    return resolved
+
+
+def nominatim_resolve_all(url, array, max_requests=MAX_NOMINATIM_REQUESTS,
+                          cache=None):
+    """Resolve addresses into locations using Nominatim.
+
+    :param url: URL of the Nominatim server
+    :param array: The addresses
+    :param max_requests: Maximum number of distinct addresses to query from
+        Nominatim. Addresses after that are ignored; addresses found in the
+        cache don't count.
+    :param cache: A :class:`~datamart_profiler.geocode_cache.GeocodeCache`
+        to use across calls
+    :return: A tuple ``(locations, non_empty)`` where `locations` is a list of
+        ``(latitude, longitude)`` tuples for the addresses that were resolved
+        and `non_empty` is the number of non-empty addresses that were looked
+        at.
+    """
+    counts = {}  # Occurrences of each address, in order of first appearance
+    resolved = {}  # Location of each address (or None if not found)
+    queries = []  # Addresses to query from Nominatim
     non_empty = 0
     start = time.perf_counter()
     processed = 0
-    batch = {}
+    lookup = []
+
+    def lookup_cache():
+        if cache is not None:
+            found = cache.get_many(lookup)
+            resolved.update(found)
+            PROM_NOMINATIM_CACHE_HITS.inc(len(found))
+            PROM_NOMINATIM_CACHE_MISSES.inc(len(lookup) - len(found))
+            queries.extend(value for value in lookup if value not in found)
+        else:
+            queries.extend(lookup)
+        lookup.clear()
 
+    # Find the distinct addresses, up to the maximum number of queries
     for processed, value in enumerate(array):
         value = value.strip()
         if not value:
@@ -303,32 +390,186 @@ def nominatim_resolve_all(url, array, max_requests=MAX_NOMINATIM_REQUESTS):
 
         if len(value) > MAX_ADDRESS_LENGTH:
             continue
-        elif value in cache:
-            if cache[value] is not None:
-                locations.append(cache[value])
-        elif value in batch:
-            batch[value] += 1
+        elif value in counts:
+            counts[value] += 1
         else:
-            batch[value] = 1
-            if len(batch) == NOMINATIM_BATCH_SIZE:
-                not_found += _nominatim_batch(url, batch, locations, cache)
-                if len(cache) >= max_requests:
+            counts[value] = 1
+            lookup.append(value)
+            if len(lookup) == NOMINATIM_BATCH_SIZE:
+                lookup_cache()
+                if len(queries) >= max_requests:
                     break
+    if lookup:
+        lookup_cache()
 
-    if batch and len(cache) < max_requests:
-        not_found += _nominatim_batch(url, batch, locations, cache)
+    # Send the queries in batches, a few at a time
+    batches = [
+        queries[i:i + NOMINATIM_BATCH_SIZE]
+        for i in range(0, len(queries), NOMINATIM_BATCH_SIZE)
+    ]
+    if len(batches) > 1 and NOMINATIM_CONCURRENT_BATCHES > 1:
+        with ThreadPoolExecutor(NOMINATIM_CONCURRENT_BATCHES) as executor:
+            results = list(executor.map(
+                lambda batch: _nominatim_batch(url, batch),
+                batches,
+            ))
+    else:
+        results = [_nominatim_batch(url, batch) for batch in batches]
+    for result in results:
+        resolved.update(result)
+        if cache is not None:
+            cache.set_many(result)
+    if cache is not None:
+        nb_hits = len(resolved) - len(queries)
+        PROM_NOMINATIM_SAVED_REQS.inc(
+            (nb_hits + NOMINATIM_BATCH_SIZE - 1) // NOMINATIM_BATCH_SIZE
+        )
+
+    locations = []
+    for value, count in counts.items():
+        location = resolved.get(value)
+        if location is not None:
+            locations.extend([location] * count)
 
     logger.info(
-        "Performed %d Nominatim queries in %fs (%d hits). Found %d/%d",
-        len(cache),
+        "Performed %d Nominatim queries in %fs (%d from cache). Found %d/%d",
+        len(queries),
         time.perf_counter() - start,
-        len(cache) - not_found,
+        len(resolved) - len(queries),
         len(locations),
         processed,
     )
     return locations, non_empty
 
 
+_re_house_number = re.compile(r'^[0-9]+[A-Za-z]?(?:-[0-9]+[A-Za-z]?)?$')
+_re_postal_code = re.compile(
+    r'(?:^|[ ,])(?:'
+    r'[0-9]{5}(?:-[0-9]{4})?|'  # US
+    r'[A-Z][0-9][A-Z] ?[0-9][A-Z][0-9]|'  # Canada
+    r'[A-Z]{1,2}[0-9][A-Z0-9]? ?[0-9][A-Z]{2}'  # UK
+    r')(?:$|[ ,])'
+)
+_address_words = {
+    'st', 'street', 'ave', 'av', 'avenue', 'rd', 'road', 'blvd',
+    'boulevard', 'dr', 'drive', 'ln', 'lane', 'way', 'pl', 'place', 'ct',
+    'court', 'sq', 'square', 'hwy', 'highway', 'pkwy', 'parkway', 'ter',
+    'terrace', 'cir', 'circle', 'plz', 'plaza', 'broadway', 'rue', 'strasse',
+    'calle', 'apt', 'suite', 'ste', 'floor', 'fl', 'po', 'box', 'n', 's', 'e',
+    'w', 'ne', 'nw', 'se', 'sw', 'north', 'south', 'east', 'west',
+}
+_re_address_token = re.compile(r'[^\s,]+')
+
+
+def looks_like_address(value):
+    """Quickly check whether a string could be an address.
+
+    Addresses are short and usually contain a house number, a street type, a
+    postal code, or multiple parts separated by commas. A house number with
+    a street type, or a postal code, is enough whatever the case. Otherwise,
+    values made mostly of lower-case words are taken to be prose. Place names
+    (only capitalized words) are accepted too.
+    """
+    if len(value) > MAX_ADDRESS_LENGTH:
+        return False
+    tokens = _re_address_token.findall(value)
+    if not tokens:
+        return False
+
+    words = [t for t in tokens if t[0].isalpha()]
+    house_number = any(_re_house_number.match(t) for t in tokens)
+    street_word = any(t.rstrip('.').lower() in _address_words for t in words)
+    if (
+        (house_number and street_word)
+        or _re_postal_code.search(value) is not None
+    ):
+        return True
+
+    # Prose is mostly lower-case words
+    lower = sum(1 for w in words if w[0].islower())
+    if lower * 2 > len(tokens):
+        return False
+
+    return (
+        (lower == 0 and len(words) >= 2)
+        or house_number
+        or street_word
+        or value.count(',') >= 1
+    )
+
+
+def address_prefilter(values, counts, max_unclean):
+    """Check whether a column might be made of addresses before geocoding it.
+
+    This looks at a sample of values, and rejects columns for which the
+    Nominatim results would be thrown away anyway, because fewer than
+    `1 - max_unclean` values could be resolved.
+
+    :param values: The distinct values of the column
+    :param counts: The number of occurrences of each distinct value
+    :param max_unclean: Ratio of values that can fail to resolve
+    :return: False if the column clearly doesn't contain addresses
+    """
+    PROM_ADDRESS_PREFILTER_COLUMNS.inc()
+    start = time.perf_counter()
+    values = numpy.array([v.strip() for v in values], dtype=object)
+    counts = numpy.asarray(counts, dtype=numpy.int64)
+    non_empty = values != ''
+    values, counts = values[non_empty], counts[non_empty]
+    total = counts.sum()
+
+    # Values that are too long can't be resolved
+    too_long = numpy.array(
+        [len(v) > MAX_ADDRESS_LENGTH for v in values],
+        dtype=bool,
+    )
+    if total == 0:
+        reject = False
+    elif counts[too_long].sum() > max_unclean * total:
+        reject = True
+    else:
+        rand = numpy.random.RandomState(0)
+        sample = rand.choice(
+            len(values),
+            min(ADDRESS_SAMPLE_SIZE, total),
+            p=counts / total,
+        )
+        nb_like = sum(1 for i in sample if looks_like_address(values[i]))
+        reject = nb_like < MIN_ADDRESS_LIKE * len(sample)
+
+    if reject:
+        # Estimate the number of queries that would have been made
+        nb_distinct = min(len(values), MAX_NOMINATIM_REQUESTS)
+        nb_reqs = (
+            nb_distinct + NOMINATIM_BATCH_SIZE - 1
+        ) // NOMINATIM_BATCH_SIZE
+        PROM_ADDRESS_PREFILTER_REJECTED.inc()
+        PROM_ADDRESS_PREFILTER_SAVED_REQS.inc(nb_reqs)
+        req_time = _mean_nominatim_request_time()
+        if req_time is not None:
+            PROM_ADDRESS_PREFILTER_SAVED_SECONDS.inc(max(
+                0.0,
+                nb_reqs * req_time - (time.perf_counter() - start),
+            ))
+        logger.info(
+            "Column doesn't look like addresses, not querying Nominatim",
+        )
+    return not reject
+
+
+def _mean_nominatim_request_time():
+    total = count = None
+    for metric in PROM_NOMINATIM_REQ_TIME.collect():
+        for sample in metric.samples:
+            if sample.name.endswith('_sum'):
+                total = sample.value
+            elif sample.name.endswith('_count'):
+                count = sample.value
+    if not count:
+        return None
+    return total / count
+
+
 def disambiguate_admin_areas(admin_areas):
     """This takes admin areas resolved from names and tries to disambiguate.
 
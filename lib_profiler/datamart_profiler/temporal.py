@@ -1,9 +1,11 @@
 import collections
-from datetime import datetime
+from datetime import datetime, timedelta
 import dateutil.parser
 import dateutil.tz
 import logging
+import numpy
 import pandas
+import re
 
 from .warning_tools import raise_warnings
 
@@ -33,37 +35,114 @@ temporal_aggregation_keys = {
 }
 
 
+_epoch = datetime(1970, 1, 1)
+_microsecond = timedelta(microseconds=1)
+_nat = numpy.datetime64('NaT').astype(numpy.int64)
+
+# Units of numpy.datetime64 for the resolutions that can be floored by a cast
+_datetime64_units = {
+    'year': 'Y',
+    'month': 'M',
+    'day': 'D',
+    'hour': 'h',
+    'minute': 'm',
+    'second': 's',
+}
+
+
+def to_datetime64(values):
+    """Convert datetimes to a numpy datetime64 array of their wall-clock time.
+
+    Timezone-aware values are represented in their own timezone, which is what
+    `strftime` uses. Python `datetime` objects are converted to microseconds,
+    which can represent all of them.
+
+    :param values: A list or array of `datetime` objects, or a pandas
+        `DatetimeIndex` or `Series`
+    """
+    if isinstance(values, pandas.Series):
+        values = pandas.Index(values)
+    if isinstance(values, pandas.DatetimeIndex):
+        if values.tz is not None:
+            values = values.tz_localize(None)
+        return values.values
+    if isinstance(values, (set, frozenset)):
+        values = list(values)
+    values = numpy.asarray(values)
+    if values.dtype.kind == 'M':
+        return values
+    # Much faster than letting numpy convert the objects
+    return numpy.fromiter(
+        (
+            _nat if value is None or value is pandas.NaT
+            else (value.replace(tzinfo=None) - _epoch) // _microsecond
+            for value in values
+        ),
+        dtype=numpy.int64,
+        count=len(values),
+    ).view('datetime64[us]')
+
+
+def floor_datetimes(values, resolution):
+    """Floor datetime64 values to the start of their period.
+
+    :param values: A numpy datetime64 array
+    :param resolution: One of the keys of `temporal_aggregation_keys`
+    :return: A numpy datetime64 array, with a unit that depends on
+        `resolution`
+    """
+    values = numpy.asarray(values)
+    if resolution in _datetime64_units:
+        return values.astype('datetime64[%s]' % _datetime64_units[resolution])
+    elif resolution == 'quarter':
+        months = values.astype('datetime64[M]')
+        nat = numpy.isnat(months)
+        months = months.astype(numpy.int64)
+        floored = (months - months % 3).astype('datetime64[M]')
+        floored[nat] = numpy.datetime64('NaT')
+        return floored
+    elif resolution == 'week':
+        days = values.astype('datetime64[D]')
+        nat = numpy.isnat(days)
+        days = days.astype(numpy.int64)
+        # Day 0 (1970-01-01) was a Thursday, map each day to the Monday before
+        floored = (days - (days + 3) % 7).astype('datetime64[D]')
+        floored[nat] = numpy.datetime64('NaT')
+        return floored
+    else:
+        raise ValueError("Unknown temporal resolution %r" % resolution)
+
+
 def get_temporal_resolution(values):
     """Returns the resolution of the temporal attribute.
     """
 
-    if not isinstance(values, set):
-        values = set(values)
+    values = numpy.unique(to_datetime64(values))
+    values = values[~numpy.isnat(values)]
 
     if len(values) == 1:
-        value, = values
-        if value.second:
+        def changes(resolution, coarser):
+            return (
+                floor_datetimes(values, resolution)[0] !=
+                floor_datetimes(values, coarser)[0]
+            )
+
+        if changes('second', 'minute'):
             return 'second'
-        elif value.minute:
+        elif changes('minute', 'hour'):
             return 'minute'
-        elif value.hour:
+        elif changes('hour', 'day'):
             return 'hour'
         else:
             return 'day'
 
     # Python 3.7+ iterates on dict in insertion order
-    for resolution, key in temporal_aggregation_keys.items():
-        counts = collections.defaultdict(collections.Counter)
-        if isinstance(key, str):
-            for value in values:
-                bin = value.strftime(key)
-                counts[bin][value] += 1
-        else:
-            for value in values:
-                bin = key(value)
-                counts[bin][value] += 1
+    for resolution in temporal_aggregation_keys:
+        # Values are sorted, so are the bins
+        bins = floor_datetimes(values, resolution)
+        nb_bins = 1 + numpy.count_nonzero(bins[1:] != bins[:-1])
 
-        avg_per_bin = sum(len(v) for v in counts.values()) / len(counts)
+        avg_per_bin = len(values) / nb_bins
         if avg_per_bin < 1.05:
             # 5 % error tolerated
             return resolution
@@ -100,3 +179,162 @@ def parse_date(string):
     if dt1.tzinfo is None:
         dt1 = dt1.replace(tzinfo=dateutil.tz.UTC)
     return dt1
+
+
+# Formats that can be converted in bulk by pandas, with a regular expression
+# strictly matching them. Those are only used where they give the exact same
+# result as parse_date(); anything else goes through dateutil
+_date_formats = [
+    (re.compile(r'^[0-9]{4}-[0-9]{2}-[0-9]{2}$'), '%Y-%m-%d'),
+    (re.compile(r'^[0-9]{4}/[0-9]{2}/[0-9]{2}$'), '%Y/%m/%d'),
+    (re.compile(r'^[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}$'),
+     '%Y-%m-%d %H:%M'),
+    (re.compile(r'^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}$'),
+     '%Y-%m-%dT%H:%M'),
+    (re.compile(r'^[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}$'),
+     '%Y-%m-%d %H:%M:%S'),
+    (re.compile(r'^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}$'),
+     '%Y-%m-%dT%H:%M:%S'),
+    (re.compile(
+        r'^[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}\.[0-9]{1,6}$'
+    ), '%Y-%m-%d %H:%M:%S.%f'),
+    (re.compile(
+        r'^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}\.[0-9]{1,6}$'
+    ), '%Y-%m-%dT%H:%M:%S.%f'),
+    (re.compile(r'^[0-9]{2}/[0-9]{2}/[0-9]{4}$'), '%m/%d/%Y'),
+    (re.compile(r'^[0-9]{8}$'), '%Y%m%d'),
+    (re.compile(r'^[0-9]{4}-[0-9]{2}$'), '%Y-%m'),
+]
+
+# Years that pandas can represent
+_min_year = pandas.Timestamp.min.year + 1
+_max_year = pandas.Timestamp.max.year - 1
+
+# How many values to look at to pick the formats to try
+DATE_FORMAT_SAMPLE_SIZE = 100
+# How many of the formats above to try on a column at most
+MAX_DATE_FORMATS = 3
+
+# Numbers, which can only be dates if they look like YYMMDD or
+# YYYYMMDD[hhmm[ss]]
+_re_number = re.compile(r'^[+-]?[0-9]*\.?[0-9]*$')
+_re_number_date = re.compile(
+    r'^[+-]?\.?(?:[0-9]{6}|[0-9]{8}|[0-9]{12}|[0-9]{14})\.?$'
+)
+
+
+def could_be_date(string):
+    """Quickly rule out strings for which `parse_date` will return None.
+
+    This returns False for empty strings and for most numbers. If this returns
+    True, the string still might not be a date.
+    """
+    if not string:
+        return False
+    if _re_number.match(string) and not _re_number_date.match(string):
+        return False
+    return True
+
+
+def infer_date_formats(values):
+    """Pick the formats to try on an array of strings, from a sample.
+
+    :return: A list of ``(regex, format)`` pairs, most frequent first.
+    """
+    if len(values) > DATE_FORMAT_SAMPLE_SIZE:
+        step = len(values) / DATE_FORMAT_SAMPLE_SIZE
+        sample = [
+            values[int(i * step)] for i in range(DATE_FORMAT_SAMPLE_SIZE)
+        ]
+    else:
+        sample = values
+
+    counts = collections.Counter()
+    for value in sample:
+        for i, (regex, _) in enumerate(_date_formats):
+            if regex.match(value):
+                counts[i] += 1
+                break
+    return [_date_formats[i] for i, _ in counts.most_common(MAX_DATE_FORMATS)]
+
+
+def parse_date_array(values, counts=None, min_count=None):
+    """Parse an array of strings into dates.
+
+    This gives the same result as calling `parse_date` on each value, but
+    values that match a common format are converted in bulk, and values that
+    can't be dates are skipped. Only the rest is parsed by dateutil.
+
+    :param values: The strings to parse
+    :param counts: How many times each value is present, used for `min_count`
+    :param min_count: If provided, return None as soon as it is clear that
+        fewer values than this are dates
+    :return: An array of the same length as `values` containing `datetime`
+        objects, or None for strings that are not valid dates
+    """
+    values = numpy.asarray(values, dtype=object)
+    if counts is None:
+        counts = numpy.ones(len(values), dtype=numpy.int64)
+    else:
+        counts = numpy.asarray(counts, dtype=numpy.int64)
+    result = numpy.full(len(values), None, dtype=object)
+
+    # Skip values that can't be dates
+    remaining = numpy.fromiter(
+        (could_be_date(value) for value in values),
+        dtype=bool, count=len(values),
+    )
+    if min_count is not None and counts[remaining].sum() < min_count:
+        return None
+
+    # Convert in bulk the values matching the most common formats
+    nb_parsed = 0
+    for regex, date_format in infer_date_formats(values[remaining]):
+        matching = remaining.copy()
+        matching[remaining] = numpy.fromiter(
+            (bool(regex.match(value)) for value in values[remaining]),
+            dtype=bool, count=remaining.sum(),
+        )
+        if not matching.any():
+            continue
+        converted = pandas.to_datetime(
+            values[matching],
+            format=date_format,
+            errors='coerce',
+        )
+        valid = ~numpy.asarray(converted.isna())
+        indices = numpy.flatnonzero(matching)[valid]
+        result[indices] = [
+            dt.replace(tzinfo=dateutil.tz.UTC)
+            for dt in converted[valid].to_pydatetime()
+        ]
+        remaining[indices] = False
+        nb_parsed += counts[indices].sum()
+
+        # Values that failed are invalid dates (e.g. month 13), unless they
+        # are out of the range of pandas, in which case they are left for
+        # dateutil
+        if date_format.startswith('%Y'):
+            invalid = numpy.flatnonzero(matching)[~valid]
+            remaining[invalid] = [
+                not (_min_year <= int(value[:4]) <= _max_year)
+                for value in values[invalid]
+            ]
+
+    if (
+        min_count is not None and
+        nb_parsed + counts[remaining].sum() < min_count
+    ):
+        return None
+
+    # Parse the stragglers with dateutil
+    if min_count is not None:
+        nb_possible = nb_parsed + counts[remaining].sum()
+    for i in numpy.flatnonzero(remaining):
+        result[i] = parse_date(values[i])
+        if result[i] is None and min_count is not None:
+            nb_possible -= counts[i]
+            if nb_possible < min_count:
+                return None
+
+    return result
@@ -0,0 +1,186 @@
+"""Timing and memory report of the profiling stages.
+
+Pass a :class:`StageTimings` to ``process_dataset()`` to find out which stage
+of which column took the time (type identification, date parsing,
+administrative areas, numerical ranges, plots, Nominatim, ...). The report is
+kept separate from the metadata, so it doesn't get indexed.
+"""
+
+import contextlib
+import logging
+import prometheus_client
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+STAGE_BUCKETS = [
+    0.01, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.0, 4.0, 7.0, 12.0, 20.0, 32.0, 52.0, 80.0, 120.0, 190.0,
+    300.0, 480.0, 720.0, 1200.0, 1800.0, 3600.0,
+    float('inf'),
+]
+
+PROM_STAGE = prometheus_client.Histogram(
+    'profile_stage_seconds', "Profile time per stage, for each column",
+    ['stage'],
+    buckets=STAGE_BUCKETS,
+)
+PROM_STAGE_PEAK_MEMORY = prometheus_client.Histogram(
+    'profile_stage_peak_memory_bytes', "Peak memory usage per profile stage",
+    ['stage'],
+    buckets=[float(1 << i) for i in range(26, 35)] + [float('inf')],
+)
+
+
+# Highest peak memory usage seen before the peak was last reset, so that the
+# peak of a whole run can be reported even if stages reset it
+_peak_before_reset = 0
+
+
+def get_peak_memory():
+    """Get the peak resident set size of this process, in bytes.
+
+    This is only available on Linux, None is returned on other systems.
+    """
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_memory(forget=False):
+    """Reset the peak resident set size of this process, if allowed.
+
+    :param forget: Also forget the peak seen before previous resets, see
+        :func:`get_overall_peak_memory`
+    """
+    global _peak_before_reset
+
+    if forget:
+        _peak_before_reset = 0
+    else:
+        peak = get_peak_memory()
+        if peak is not None:
+            _peak_before_reset = max(_peak_before_reset, peak)
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')  # Reset the peak resident set size
+    except OSError:
+        pass
+
+
+def get_overall_peak_memory():
+    """Get the peak resident set size since ``reset_peak_memory(forget=True)``.
+    """
+    peak = get_peak_memory()
+    if peak is None:
+        return None
+    return max(peak, _peak_before_reset)
+
+
+class StageTimings(object):
+    """Time and peak memory of each stage of profiling, for each column.
+
+    Stages can be nested; the time of a stage doesn't include the stages
+    nested in it, so that the entries add up to the total.
+
+    :param memory: Whether to record the peak memory usage of each stage.
+        This resets the peak resident set size of the process (Linux only).
+    """
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.entries = []
+        self._stack = []
+
+    @contextlib.contextmanager
+    def stage(self, stage, column=None):
+        """Context manager timing a stage.
+
+        :param stage: Name of the stage, e.g. ``'types'``, ``'plots'``
+        :param column: The name of the column, None for stages that are about
+            the whole dataset
+        """
+        if self.memory:
+            reset_peak_memory()
+        # Time and peak memory of nested stages
+        nested = [0.0, 0]
+        self._stack.append(nested)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._stack.pop()
+            entry = {'stage': stage, 'seconds': elapsed - nested[0]}
+            if column is not None:
+                entry['column'] = column
+            peak = None
+            if self.memory:
+                peak = get_peak_memory()
+                if peak is not None:
+                    peak = max(peak, nested[1])
+                    entry['peak_memory'] = peak
+            if self._stack:
+                self._stack[-1][0] += elapsed
+                if peak is not None:
+                    self._stack[-1][1] = max(self._stack[-1][1], peak)
+            self.add([entry])
+
+    def add(self, entries):
+        """Add entries, for example recorded by another process.
+        """
+        for entry in entries:
+            self.entries.append(entry)
+            PROM_STAGE.labels(entry['stage']).observe(entry['seconds'])
+            if 'peak_memory' in entry:
+                PROM_STAGE_PEAK_MEMORY.labels(entry['stage']).observe(
+                    entry['peak_memory'],
+                )
+
+    def total(self):
+        """Total time recorded, in seconds.
+        """
+        return sum(entry['seconds'] for entry in self.entries)
+
+    def top(self, n=10):
+        """The entries that took the most time.
+        """
+        return sorted(
+            self.entries,
+            key=lambda entry: entry['seconds'],
+            reverse=True,
+        )[:n]
+
+    def log_top(self, n=10, level=logging.WARNING):
+        """Log the entries that took the most time.
+        """
+        for entry in self.top(n):
+            if 'column' in entry:
+                where = "column %r" % entry['column']
+            else:
+                where = "dataset"
+            if 'peak_memory' in entry:
+                logger.log(
+                    level, "%8.2fs  %-12s %s, peak memory %.1f MB",
+                    entry['seconds'], entry['stage'], where,
+                    entry['peak_memory'] / (1 << 20),
+                )
+            else:
+                logger.log(
+                    level, "%8.2fs  %-12s %s",
+                    entry['seconds'], entry['stage'], where,
+                )
+
+
+def timed(timings, stage, column=None):
+    """Time a stage with `timings` if it is not None.
+    """
+    if timings is None:
+        return contextlib.nullcontext()
+    return timings.stage(stage, column)
@@ -22,9 +22,12 @@ from datamart_core.common import setup_logging, add_dataset_to_index, \
 from datamart_core.fscache import cache_get_or_set
 from datamart_core.materialize import get_dataset, dataset_cache_key, \
     detect_format_convert_to_csv
-from datamart_geo import GeoData
 from datamart_materialize import DatasetTooBig
 from datamart_profiler import process_dataset
+from datamart_profiler.admin_names import load_admin_names
+from datamart_profiler.geo_data import GeoData
+from datamart_profiler.geocode_cache import SqliteGeocodeCache
+from datamart_profiler.timings import StageTimings
 
 
 logger = logging.getLogger(__name__)
@@ -88,7 +91,8 @@ class LazoDeleteFirst(object):
 def materialize_and_process_dataset(
     dataset_id, metadata,
     lazo_client, nominatim, geo_data,
-    profile_semaphore,
+    profile_semaphore, profile_workers=1, geocode_cache=None,
+    report_threshold=None,
 ):
     with contextlib.ExitStack() as stack:
         # Remove converters, we'll discover what's needed
@@ -133,6 +137,7 @@ def materialize_and_process_dataset(
             with prom_incremented(PROM_PROFILING):
                 logger.info("Profiling dataset %r", dataset_id)
                 start = time.perf_counter()
+                timings = StageTimings()
                 metadata = process_dataset(
                     data=dataset_path,
                     dataset_id=dataset_id,
@@ -143,12 +148,22 @@ def materialize_and_process_dataset(
                     include_sample=True,
                     coverage=True,
                     plots=True,
+                    workers=profile_workers,
+                    geocode_cache=geocode_cache,
+                    timings=timings,
                 )
+                elapsed = time.perf_counter() - start
                 logger.info(
                     "Profiling dataset %r took %.2fs",
                     dataset_id,
-                    time.perf_counter() - start,
+                    elapsed,
                 )
+                if report_threshold is not None and elapsed > report_threshold:
+                    logger.warning(
+                        "Profiling dataset %r was slow, top stages:",
+                        dataset_id,
+                    )
+                    timings.log_top()
 
         metadata['materialize'] = materialize
         return metadata
@@ -181,12 +196,22 @@ class Profiler(object):
         )
         if os.environ.get('NOMINATIM_URL'):
             self.nominatim = os.environ['NOMINATIM_URL']
+            self.geocode_cache = SqliteGeocodeCache('/cache/geocode.sqlite3')
         else:
             self.nominatim = None
+            self.geocode_cache = None
             logger.warning(
                 "$NOMINATIM_URL is not set, not resolving addresses"
             )
         self.geo_data = GeoData.from_local_cache()
+        load_admin_names(self.geo_data, '/cache')
+        self.profile_workers = int(os.environ.get('PROFILE_WORKERS') or 1)
+        if os.environ.get('PROFILE_REPORT_THRESHOLD'):
+            self.profile_report_threshold = float(
+                os.environ['PROFILE_REPORT_THRESHOLD']
+            )
+        else:
+            self.profile_report_threshold = None
         self.channel = None
 
         assert(os.path.isdir('/cache/datasets'))
@@ -262,6 +287,9 @@ class Profiler(object):
                 self.nominatim,
                 self.geo_data,
                 self.profile_semaphore,
+                self.profile_workers,
+                self.geocode_cache,
+                self.profile_report_threshold,
             )
 
             future.add_done_callback(
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+"""This script compares the numerical ranges computation with K-Means.
+
+The ranges used to be computed by running K-Means from scikit-learn on all the
+values; they are now obtained from an exact 1-dimensional segmentation. This
+runs both on synthetic data and shows the time taken and the ranges found.
+"""
+
+import numpy
+import sys
+import time
+import warnings
+
+from sklearn.cluster import KMeans
+from sklearn.exceptions import ConvergenceWarning
+
+from datamart_profiler.numerical import get_numerical_ranges, \
+    N_RANGES, MIN_RANGE_SIZE
+
+
+def kmeans_numerical_ranges(values):
+    """Previous implementation, using K-Means.
+    """
+    if not len(values):
+        return []
+
+    clustering = KMeans(n_clusters=min(N_RANGES, len(values)),
+                        random_state=0)
+    values_array = numpy.array(values).reshape(-1, 1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=ConvergenceWarning)
+        clustering.fit(values_array)
+
+    ranges = []
+    for rg in range(N_RANGES):
+        cluster = [values[i]
+                   for i in range(len(values))
+                   if clustering.labels_[i] == rg]
+        if not cluster:
+            continue
+        if len(cluster) < MIN_RANGE_SIZE * len(values):
+            continue
+        cluster.sort()
+        ranges.append([
+            cluster[int(0.05 * len(cluster))],
+            cluster[int(0.95 * len(cluster))],
+        ])
+    ranges.sort()
+    return [{'range': {'gte': float(rg[0]), 'lte': float(rg[1])}}
+            for rg in ranges]
+
+
+def make_datasets(size):
+    rand = numpy.random.RandomState(0)
+    yield 'uniform floats', rand.uniform(0.0, 100.0, size)
+    yield 'gaussian mixture', numpy.concatenate([
+        rand.normal(10.0, 2.0, size // 2),
+        rand.normal(50.0, 5.0, size // 4),
+        rand.normal(200.0, 20.0, size - size // 2 - size // 4),
+    ])
+    yield 'integers', rand.randint(0, 50, size).astype(numpy.float64)
+    yield 'timestamps', rand.randint(
+        1500000000, 1600000000, size,
+    ).astype(numpy.float32)
+
+
+def format_ranges(ranges):
+    return ', '.join(
+        '[%g, %g]' % (rg['range']['gte'], rg['range']['lte'])
+        for rg in ranges
+    )
+
+
+def main(sizes):
+    for size in sizes:
+        for name, values in make_datasets(size):
+            values = values.tolist()
+            results = []
+            for func in (kmeans_numerical_ranges, get_numerical_ranges):
+                start = time.perf_counter()
+                ranges = func(values)
+                results.append((time.perf_counter() - start, ranges))
+
+            print("%s, %d values:" % (name, size))
+            for label, (elapsed, ranges) in zip(
+                ('K-Means', 'segmentation'),
+                results,
+            ):
+                print("  %-12s %8.3fs  %s" % (
+                    label, elapsed, format_ranges(ranges),
+                ))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        sizes = [int(a) for a in sys.argv[1:]]
+    else:
+        sizes = [10000, 100000, 1000000]
+    main(sizes)
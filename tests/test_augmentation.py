@@ -1,9 +1,16 @@
 import contextlib
+import functools
+import io
+import numpy as np
 import os
 import tempfile
+from unittest import mock
 
-from datamart_augmentation import join, union
-from datamart_materialize import make_writer
+import pandas as pd
+
+from datamart_augmentation import augmentation, join, union
+from datamart_augmentation.hash_join import HashJoinIndex
+from datamart_materialize import make_writer, types
 from datamart_profiler import process_dataset
 
 from .test_profile import check_ranges
@@ -111,6 +118,40 @@ class TestJoin(DataTestCase):
             },
         )
 
+    def test_join_columns(self):
+        """Join keeping only some columns of the companion data"""
+        with setup_augmentation('basic_aug.csv', 'basic.csv') as (
+            orig_data, aug_data, orig_meta, aug_meta, result, writer,
+        ):
+            output_metadata = join(
+                orig_data,
+                aug_data,
+                orig_meta,
+                aug_meta,
+                writer,
+                [[0]],
+                [[2]],
+                columns=[0],
+            )
+
+            with open(result) as table:
+                self.assertCsvEqualNoOrder(
+                    table.read(),
+                    'number,desk_faces,name',
+                    [
+                        '5,west,james',
+                        '4,south,john',
+                        '7,west,michael',
+                        '6,east,robert',
+                        '11,,christopher',
+                    ],
+                )
+
+        self.assertEqual(
+            output_metadata['qualities'][0]['qualValue']['new_columns'],
+            ['name'],
+        )
+
     def test_agg_join(self):
         """Join with aggregation between integer keys"""
         with setup_augmentation('agg_aug.csv', 'agg.csv') as (
@@ -301,6 +342,48 @@ class TestJoin(DataTestCase):
             },
         )
 
+    def test_agg_join_chunks(self):
+        """Join with aggregation, reading the companion in small chunks"""
+        with setup_augmentation('agg_aug.csv', 'agg.csv') as (
+            orig_data, aug_data, orig_meta, aug_meta, result, writer,
+        ):
+            with mock.patch.object(augmentation, 'CHUNK_SIZE_ROWS', 3):
+                output_metadata = join(
+                    orig_data,
+                    aug_data,
+                    orig_meta,
+                    aug_meta,
+                    writer,
+                    [[0]],
+                    [[0]],
+                    agg_functions={
+                        'work': 'count',
+                        'salary': ['mean', 'sum', 'min'],
+                    },
+                )
+
+            with open(result) as table:
+                self.assertCsvEqualNoOrder(
+                    table.read(),
+                    'id,location,count work,mean salary,sum salary,'
+                    'min salary',
+                    [
+                        '30,south korea,2,150.0,300.0,100.0',
+                        '40,brazil,1,,,',
+                        '70,usa,2,600.0,600.0,600.0',
+                        '80,canada,1,200.0,200.0,200.0',
+                        '100,france,2,250.0,500.0,200.0',
+                    ],
+                )
+
+        self.assertEqual(
+            [col['name'] for col in output_metadata['columns']],
+            [
+                'id', 'location', 'count work',
+                'mean salary', 'sum salary', 'min salary',
+            ],
+        )
+
     def test_geo_join(self):
         """Join with lat,long keys"""
         with setup_augmentation('geo_aug.csv', 'geo.csv') as (
@@ -813,6 +896,95 @@ class TestJoin(DataTestCase):
         )
 
 
+class TestHashJoin(TestJoin):
+    """Same tests as TestJoin, using the hash join engine"""
+    def setUp(self):
+        super(TestHashJoin, self).setUp()
+        patcher = mock.patch(
+            __name__ + '.join',
+            functools.partial(join, engine='hash'),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_indexers(self):
+        """Check the order of the joined rows and the NaN keys"""
+        index = pd.MultiIndex.from_arrays([
+            ['a', 'b', 'a', 'c', np.nan],
+            [1, 2, 1, 3, 4],
+        ])
+        companion = pd.MultiIndex.from_arrays([
+            ['a', 'c', 'a', 'b', np.nan, 'c'],
+            [1, 2, 1, 2, 4, 3],
+        ])
+
+        left, right = HashJoinIndex(index, 'left').indexers(companion)
+        self.assertEqual(list(left), [0, 0, 1, 2, 2, 3, 4])
+        self.assertEqual(list(right), [0, 2, 3, 0, 2, 5, 4])
+
+        index = pd.Index(['a', 'b', 'd'])
+        companion = pd.Index(['d', 'e', 'a', 'd'])
+        left, right = HashJoinIndex(index, 'left').indexers(companion)
+        self.assertEqual(list(left), [0, 1, 2, 2])
+        self.assertEqual(list(right), [2, -1, 0, 3])
+        left, right = HashJoinIndex(index, 'inner').indexers(companion)
+        self.assertEqual(list(left), [0, 2, 2])
+        self.assertEqual(list(right), [2, 0, 3])
+
+
+class TestKeyFilter(DataTestCase):
+    def test_filter(self):
+        """Filter companion rows on text and integer keys"""
+        metadata = [
+            {
+                'name': 'name',
+                'structural_type': types.TEXT,
+                'semantic_types': [],
+            },
+            {
+                'name': 'year',
+                'structural_type': types.INTEGER,
+                'semantic_types': [],
+            },
+            {
+                'name': 'value',
+                'structural_type': types.FLOAT,
+                'semantic_types': [],
+            },
+        ]
+        original = augmentation.set_data_index(
+            pd.DataFrame({
+                'name': ['Alice', 'bob', 'Carol'],
+                'year': ['2019', '2020', '2020'],
+            }),
+            [0, 1],
+            metadata,
+        )
+        key_filter = augmentation.KeyFilter(
+            original.index,
+            [0, 1],
+            metadata,
+            [lambda idx: idx, lambda idx: idx],
+        )
+
+        chunk = key_filter.apply(pd.DataFrame({
+            'name': ['ALICE', 'dave', 'Bob', 'alice', 'carol', 'eve'],
+            'year': [2019, 2019, 2020, 2020, 2020, 2021],
+            'value': [1.0, 2.0, 3.0, 4.0, 5.0, 6.0],
+        }))
+        # Rows are filtered on each column separately, the join does the rest
+        self.assertEqual(
+            list(chunk.index),
+            [
+                ('alice', 2019), ('bob', 2020),
+                ('alice', 2020), ('carol', 2020),
+            ],
+        )
+        self.assertEqual(list(chunk.index.names), ['0000', '0001'])
+        self.assertEqual(list(chunk.columns), ['value'])
+        self.assertEqual(list(chunk['value']), [1.0, 3.0, 4.0, 5.0])
+
+
 class TestUnion(DataTestCase):
     def test_geo_union(self):
         """Test union on geo.csv"""
@@ -890,3 +1062,120 @@ class TestUnion(DataTestCase):
                 ],
             },
         )
+
+    def test_union_columns(self):
+        """Test union with renamed, reordered, missing, and d3mIndex columns"""
+        original = pd.DataFrame({
+            'd3mIndex': ['0', '1', '9', '10'],
+            'name': ['a', 'b', 'c', 'd'],
+            'value': ['1', '2', '3', '4'],
+            'note': ['w', 'x', 'y', 'z'],
+        })
+        original_metadata = {
+            'columns': [
+                {
+                    'name': name,
+                    'structural_type': types.TEXT,
+                    'semantic_types': [],
+                }
+                for name in original.columns
+            ],
+        }
+        augment_metadata = {
+            'columns': [
+                {
+                    'name': name,
+                    'structural_type': types.TEXT,
+                    'semantic_types': [],
+                }
+                for name in ['val', 'label']
+            ],
+        }
+        augment_data = io.BytesIO(
+            b'val,label\n'
+            b'5,e\n'
+            b'6,"multi\nline"\n'
+            b'\n'
+            b'7,f,bad\n'
+            b'8\n'
+            b'9,"g,h"\n'
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            result = os.path.join(tmp, 'result.csv')
+            # Small blocks, so the quoted field spans two of them
+            with mock.patch.object(augmentation, 'UNION_BLOCK_SIZE', 10):
+                output_metadata = union(
+                    original,
+                    augment_data,
+                    original_metadata,
+                    augment_metadata,
+                    make_writer(result),
+                    [[1], [2]],
+                    [[1], [0]],
+                )
+
+            with open(result, newline='') as table:
+                self.assertEqual(
+                    table.read(),
+                    'd3mIndex,name,value,note\r\n'
+                    '0,a,1,w\r\n'
+                    '1,b,2,x\r\n'
+                    '9,c,3,y\r\n'
+                    '10,d,4,z\r\n'
+                    '11,e,5,\r\n'
+                    '12,"multi\nline",6,\r\n'
+                    '13,,8,\r\n'
+                    '14,"g,h",9,\r\n',
+                )
+
+        self.assertEqual(
+            output_metadata['qualities'][0]['qualValue'],
+            {
+                'new_columns': [],
+                'removed_columns': [],
+                'nb_rows_before': 4,
+                'nb_rows_after': 8,
+                'augmentation_type': 'union',
+            },
+        )
+
+    def test_union_copy(self):
+        """Test copying companion rows in blocks when the columns line up"""
+        original = pd.DataFrame({'a': ['1'], 'b': ['2']})
+        metadata = {
+            'columns': [
+                {
+                    'name': name,
+                    'structural_type': types.TEXT,
+                    'semantic_types': [],
+                }
+                for name in original.columns
+            ],
+        }
+        augment_data = io.BytesIO(
+            b'a,b\n'
+            b'3,4\n'
+            b'5,6\r\n'
+            b'"7",8\n'
+            b'9,10'
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            result = os.path.join(tmp, 'result.csv')
+            with mock.patch.object(augmentation, 'UNION_BLOCK_SIZE', 5):
+                union(
+                    original,
+                    augment_data,
+                    metadata,
+                    metadata,
+                    make_writer(result),
+                    [[0], [1]],
+                    [[0], [1]],
+                )
+
+            with open(result, newline='') as table:
+                self.assertEqual(
+                    table.read(),
+                    'a,b\r\n1,2\r\n3,4\r\n5,6\r\n7,8\r\n9,10\r\n',
+                )
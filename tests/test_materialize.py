@@ -353,3 +353,52 @@ class TestConvert(unittest.TestCase):
                 f_out.getvalue(),
                 f_exp.read(),
             )
+
+    def test_detect_single_pass(self):
+        """Test detecting and applying multiple conversions at once"""
+        from datamart_core.materialize import detect_format_convert_to_csv
+
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        src = os.path.join(tmp, 'src.tsv')
+        with open(src, 'w', newline='') as fp:
+            fp.write('Yearly numbers\n\n')
+            fp.write('area\t2018\t2019\t2020\n')
+            for i in range(200):
+                fp.write('area%d\t%d\t%d\t%d\n' % (i, i, i + 10, i + 20))
+
+        conversions = []
+
+        def convert_dataset(func, path):
+            dst = os.path.join(tmp, 'converted%d.csv' % len(conversions))
+            with open(dst, 'w', newline='') as fp:
+                func(path, fp)
+            conversions.append(dst)
+            return dst
+
+        materialize = {}
+        result = detect_format_convert_to_csv(
+            src, convert_dataset, materialize,
+        )
+        self.assertEqual(
+            materialize,
+            {'convert': [
+                {'identifier': 'tsv', 'separator': '\t'},
+                {'identifier': 'skip_rows', 'nb_rows': 2},
+                {
+                    'identifier': 'pivot',
+                    'except_columns': [0],
+                    'date_label': 'year',
+                },
+            ]},
+        )
+        # The file was only rewritten once
+        self.assertEqual(conversions, [result])
+        with open(result, 'r', newline='') as fp:
+            lines = fp.read().splitlines()
+        self.assertEqual(len(lines), 601)
+        self.assertEqual(
+            lines[:4],
+            ['area,year,value', 'area0,2018,0', 'area0,2019,10',
+             'area0,2020,20'],
+        )
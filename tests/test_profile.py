@@ -1,20 +1,34 @@
 from datetime import datetime
 from dateutil.tz import UTC
 import io
+import itertools
+import os
+import numpy
 import pandas
+import pickle
+import prometheus_client
 import random
 import requests
+import shutil
+import sqlite3
+import tempfile
 import unittest
+from unittest import mock
 import textwrap
+import time
 
 import datamart_geo
 from datamart_profiler import process_dataset
+from datamart_profiler import admin_names
 from datamart_profiler.core import expand_attribute_name
+from datamart_profiler.geo_data import GeoData
+from datamart_profiler import numerical
 from datamart_profiler import profile_types
 from datamart_profiler import spatial
 from datamart_profiler.spatial import LATITUDE, LONGITUDE, LatLongColumn, \
     disambiguate_admin_areas
-from datamart_profiler.temporal import get_temporal_resolution, parse_date
+from datamart_profiler.temporal import floor_datetimes, \
+    get_temporal_resolution, parse_date, parse_date_array, to_datetime64
 
 from .utils import DataTestCase, data
 
@@ -126,6 +140,366 @@ class TestIndex(unittest.TestCase):
         )
 
 
+class TestParallel(DataTestCase):
+    def test_workers(self):
+        """Test processing columns in multiple processes"""
+        from datamart_profiler import core
+
+        with data('annotated.csv', 'r') as data_fp:
+            expected = process_dataset(data_fp)
+        with mock.patch.object(core, 'PARALLEL_MIN_VALUES', 1):
+            with data('annotated.csv', 'r') as data_fp:
+                metadata = process_dataset(data_fp, workers=2)
+        self.assertEqual(metadata, expected)
+
+    def test_shared_columns(self):
+        """Test sending columns to the workers through shared memory"""
+        from datamart_profiler import core
+
+        columns = [
+            pandas.Series([1, 2, 3], name='ints'),
+            pandas.Series([1.5, float('nan'), 3.0], name='floats'),
+            pandas.Series(
+                pandas.to_datetime(['2020-01-01', '2020-06-15', None]),
+                name='dates',
+            ),
+            pandas.Series(
+                pandas.to_datetime(['2020-01-01', '2020-06-15']).tz_localize(
+                    'UTC',
+                ),
+                name='tz',
+            ),
+            pandas.Series(['a', '\u00e9t\u00e9', '', 'a', '\udcff'], name=7),
+            pandas.Series([], dtype=object, name='empty'),
+        ]
+        for column in columns:
+            shared = core._share_column(column)
+            loaded = core._load_column(shared)
+            pandas.testing.assert_series_equal(loaded, column)
+        loaded = core._load_column(core._share_column(columns[4]))
+        self.assertIs(loaded[0], loaded[3])
+
+
+class TestSample(unittest.TestCase):
+    DATA = (
+        b'name,description\n'
+        b'one,"first\nrow"\n'
+        b'\n'
+        b'two,"with ""quotes"", and\r\nnewline"\r\n'
+        + b''.join(b'row%d,value\n' % i for i in range(3, 200))
+    )
+
+    def test_sample_records(self):
+        """Test counting and sampling records in a single pass"""
+        from datamart_profiler.records import sample_records
+
+        expected = pandas.read_csv(
+            io.BytesIO(self.DATA),
+            dtype=str, na_filter=False,
+        )
+        self.assertEqual(len(expected), 199)
+
+        for chunk_size in (7, 50, 4096):
+            nb_rows, sample = sample_records(
+                io.BytesIO(self.DATA), 1.0, 1,
+                chunk_size=chunk_size,
+            )
+            self.assertEqual(nb_rows, 199)
+            sample = pandas.read_csv(sample, dtype=str, na_filter=False)
+            self.assertTrue(sample.equals(expected))
+
+        nb_rows, sample = sample_records(io.BytesIO(self.DATA), 0.3, 1)
+        self.assertEqual(nb_rows, 199)
+        sample = pandas.read_csv(sample, dtype=str, na_filter=False)
+        self.assertEqual(list(sample.columns), ['name', 'description'])
+        self.assertTrue(30 < len(sample) < 90)
+        self.assertTrue(set(sample['name']) < set(expected['name']))
+
+    def test_load_sample(self):
+        """Test profiling a file larger than the maximum size"""
+        metadata = process_dataset(
+            io.BytesIO(self.DATA),
+            load_max_size=1000,
+        )
+        self.assertEqual(metadata['nb_rows'], 199)
+        self.assertTrue(metadata['nb_profiled_rows'] < 199)
+        self.assertEqual(
+            metadata['average_row_size'],
+            len(self.DATA) / 199,
+        )
+
+
+class TestLoad(unittest.TestCase):
+    def test_shared_strings(self):
+        """Test that equal values are loaded as a single string object"""
+        from datamart_profiler.core import load_data
+
+        data, _, _, _ = load_data(io.BytesIO(
+            b'a,b\n' + b''.join(b'value%d,x\n' % (i % 3) for i in range(6))
+        ))
+        self.assertIs(data.iloc[0, 0], data.iloc[3, 0])
+        self.assertIs(data.iloc[1, 1], data.iloc[5, 1])
+
+        dataframe = pandas.DataFrame({
+            'num': [1.5, numpy.nan, 3.0, 1.5],
+            'mixed': [1, 'a', None, 1],
+        })
+        data, _, _, _ = load_data(dataframe)
+        self.assertEqual(list(data.columns), ['num', 'mixed'])
+        # Numbers are not converted
+        self.assertTrue(numpy.shares_memory(
+            data['num'].values,
+            dataframe['num'].values,
+        ))
+        self.assertEqual(list(data['mixed']), ['1', 'a', '', '1'])
+        self.assertIs(data.iloc[0, 1], data.iloc[3, 1])
+
+        # Values that are equal in Python but print differently are kept
+        data, _, _, _ = load_data(pandas.DataFrame({
+            'mixed': pandas.Series([1, 1.0, True, 'a', None, 1], dtype=object),
+        }))
+        self.assertEqual(list(data['mixed']), ['1', '1.0', 'True', 'a', '', '1'])
+        self.assertIs(data.iloc[0, 0], data.iloc[5, 0])
+
+    def test_dataframe(self):
+        """Test profiling a DataFrame with typed columns, sampling it"""
+        rand = numpy.random.RandomState(1)
+        dataframe = pandas.DataFrame({
+            'number': rand.randint(0, 100, 20000),
+            'price': rand.uniform(0.0, 10.0, 20000),
+            'when': pandas.date_range('2020-01-01', periods=20000, freq='H'),
+            'name': rand.choice(['one', 'two', 'three'], 20000),
+        })
+        metadata = process_dataset(
+            dataframe,
+            load_max_size=100000,
+            include_sample=True,
+        )
+        self.assertEqual(metadata['nb_rows'], 20000)
+        self.assertTrue(1000 < metadata['nb_profiled_rows'] < 10000)
+        number, price, when, name = metadata['columns']
+        self.assertEqual(
+            number['structural_type'],
+            'http://schema.org/Integer',
+        )
+        self.assertTrue(0 <= number['coverage'][0]['range']['gte'] < 10)
+        self.assertEqual(price['structural_type'], 'http://schema.org/Float')
+        self.assertAlmostEqual(price['mean'], 5.0, delta=0.5)
+        self.assertEqual(
+            when['semantic_types'],
+            ['http://schema.org/DateTime'],
+        )
+        self.assertEqual(
+            metadata['temporal_coverage'][0]['temporal_resolution'],
+            'hour',
+        )
+        self.assertEqual(
+            name['semantic_types'],
+            ['http://schema.org/Enumeration'],
+        )
+        self.assertTrue(
+            metadata['sample'].startswith('number,price,when,name\r\n'),
+        )
+
+
+class TestTimeBudget(DataTestCase):
+    def test_enough_time(self):
+        """Test that nothing is skipped if the time budget is large enough"""
+        with data('annotated.csv', 'r') as data_fp:
+            expected = process_dataset(
+                data_fp,
+                plots=True, include_sample=True,
+            )
+        with data('annotated.csv', 'r') as data_fp:
+            metadata = process_dataset(
+                data_fp,
+                plots=True, include_sample=True,
+                time_budget=600.0,
+            )
+        self.assertEqual(metadata, expected)
+
+    def test_out_of_time(self):
+        """Test that optional stages are skipped if the time is up"""
+        from datamart_profiler import core
+
+        with mock.patch.object(core, 'TIME_BUDGET_MIN_SIZE', 1000):
+            metadata = process_dataset(
+                io.BytesIO(TestSample.DATA),
+                plots=True, include_sample=True,
+                time_budget=1e-6,
+            )
+        self.assertEqual(metadata['nb_rows'], 199)
+        self.assertTrue(metadata['nb_profiled_rows'] < 199)
+        self.assertEqual(metadata['approximated_stages'], ['rows'])
+        self.assertEqual(
+            set(metadata['skipped_stages']),
+            {'coverage', 'plots', 'sample'},
+        )
+        self.assertNotIn('sample', metadata)
+        # Types are still identified
+        self.assertEqual(
+            [col['structural_type'] for col in metadata['columns']],
+            ['http://schema.org/Text', 'http://schema.org/Text'],
+        )
+        self.assertFalse(any('plot' in col for col in metadata['columns']))
+
+
+class TestTimings(DataTestCase):
+    def test_stages(self):
+        """Test recording the time of each stage for each column"""
+        from datamart_profiler import core
+        from datamart_profiler.timings import StageTimings
+
+        with data('annotated.csv', 'r') as data_fp:
+            expected = process_dataset(
+                data_fp,
+                plots=True, include_sample=True,
+            )
+        timings = StageTimings()
+        with data('annotated.csv', 'r') as data_fp:
+            metadata = process_dataset(
+                data_fp,
+                plots=True, include_sample=True,
+                timings=timings,
+            )
+        self.assertEqual(metadata, expected)
+        stages = {
+            (entry['stage'], entry.get('column'))
+            for entry in timings.entries
+        }
+        for column in expected['columns']:
+            self.assertIn(('types', column['name']), stages)
+            if 'plot' in column:
+                self.assertIn(('plots', column['name']), stages)
+            if 'coverage' in column:
+                self.assertIn(('ranges', column['name']), stages)
+        self.assertIn(('load', None), stages)
+        self.assertIn(('spatial_coverage', None), stages)
+        self.assertIn(('sample', None), stages)
+        self.assertTrue(all(entry['seconds'] >= 0.0 for entry in timings.entries))
+        self.assertEqual(len(timings.top(3)), 3)
+
+        # Entries are sent back from worker processes
+        parallel_timings = StageTimings(memory=False)
+        with mock.patch.object(core, 'PARALLEL_MIN_VALUES', 1):
+            with data('annotated.csv', 'r') as data_fp:
+                process_dataset(
+                    data_fp,
+                    plots=True, include_sample=True,
+                    workers=2,
+                    timings=parallel_timings,
+                )
+        self.assertEqual(
+            sorted(
+                (entry['stage'], entry.get('column'))
+                for entry in parallel_timings.entries
+            ),
+            sorted(
+                (entry['stage'], entry.get('column'))
+                for entry in timings.entries
+            ),
+        )
+        self.assertFalse(any(
+            'peak_memory' in entry for entry in parallel_timings.entries
+        ))
+
+    def test_nested(self):
+        """Test that nested stages are not counted twice"""
+        from datamart_profiler.timings import StageTimings
+
+        timings = StageTimings(memory=False)
+        with timings.stage('outer', 'col'):
+            with timings.stage('inner', 'col'):
+                time.sleep(0.05)
+        inner, outer = timings.entries
+        self.assertEqual(inner['stage'], 'inner')
+        self.assertTrue(inner['seconds'] >= 0.05)
+        self.assertTrue(outer['seconds'] < 0.05)
+
+
+class TestSketches(unittest.TestCase):
+    def test_hyperloglog(self):
+        """Test counting distinct values with HyperLogLog"""
+        from datamart_profiler.sketches import HyperLogLog
+
+        hll1 = HyperLogLog()
+        hll1.update(['a', 'b', 'a', 'c'])
+        self.assertEqual(hll1.count(), 3)
+
+        hll1.update(['v%d' % i for i in range(20000)])
+        hll2 = HyperLogLog()
+        hll2.update(['v%d' % i for i in range(10000, 50000)])
+        hll1.merge(hll2)
+        self.assertTrue(50003 * 0.97 < hll1.count() < 50003 * 1.03)
+
+    def test_quantiles(self):
+        """Test approximating quantiles with mergeable sketches"""
+        from datamart_profiler.sketches import QuantileSketch
+
+        rand = numpy.random.RandomState(1)
+        values = rand.normal(size=50000)
+        sketch = QuantileSketch()
+        other = QuantileSketch()
+        for i, chunk in enumerate(numpy.array_split(values, 10)):
+            (sketch if i % 2 else other).update(chunk)
+        sketch.merge(other)
+        self.assertEqual(sketch.count, 50000)
+        self.assertEqual(sketch.min, values.min())
+        self.assertEqual(sketch.max, values.max())
+        for fraction, expected in zip(
+            [0.05, 0.5, 0.95],
+            numpy.quantile(values, [0.05, 0.5, 0.95]),
+        ):
+            self.assertAlmostEqual(
+                sketch.quantiles([fraction])[0], expected,
+                delta=0.05,
+            )
+        counts, _ = sketch.histogram()
+        self.assertEqual(counts.sum(), 50000)
+
+    def test_moments(self):
+        """Test streaming mean and standard deviation"""
+        from datamart_profiler.sketches import Moments
+
+        values = numpy.random.RandomState(1).uniform(size=1000)
+        moments = Moments()
+        for chunk in numpy.array_split(values, 7):
+            moments.update(chunk)
+        self.assertAlmostEqual(moments.mean, values.mean())
+        self.assertAlmostEqual(moments.stddev(), values.std())
+
+    def test_full_scan(self):
+        """Test profiling the full data using sketches"""
+        data = (
+            b'number,category\n' +
+            b''.join(
+                b'%d,%s\n' % (i, [b'a', b'b', b'c', b''][i % 4])
+                for i in range(2000)
+            )
+        )
+        metadata = process_dataset(
+            io.BytesIO(data),
+            load_max_size=2000,
+            plots=True,
+            full_scan=True,
+        )
+        self.assertEqual(metadata['nb_rows'], 2000)
+        self.assertTrue(metadata['nb_profiled_rows'] < 2000)
+        number, category = metadata['columns']
+        self.assertEqual(number['mean'], 999.5)
+        self.assertTrue(1960 < number['num_distinct_values'] < 2040)
+        self.assertEqual(category['num_distinct_values'], 3)
+        self.assertEqual(category['missing_values_ratio'], 0.25)
+        self.assertEqual(
+            category['plot']['data'],
+            [
+                {'bin': 'a', 'count': 500},
+                {'bin': 'b', 'count': 500},
+                {'bin': 'c', 'count': 500},
+            ],
+        )
+
+
 class TestLatlongSelection(DataTestCase):
     def test_normalize_name(self):
         """Test normalizing column names"""
@@ -268,6 +642,47 @@ class TestDates(DataTestCase):
             None,
         )
 
+    def test_parse_array(self):
+        """Test parsing many dates at once, using formats when possible"""
+        values = [
+            '2019-07-02', '2019-02-30', '1500-01-01', '2019-07-02 18:05',
+            '2019-07-02T18:05:31.25', '07/02/2019', '13/02/2019',
+            '20190702', '20191302', '12345', '2019-07', '2019',
+            'Monday July 1, 2019', '18:05', '', 'foo',
+        ]
+        self.assertEqual(
+            list(parse_date_array(values)),
+            [parse_date(v) for v in values],
+        )
+        self.assertEqual(
+            [
+                e is not None
+                for e in parse_date_array(values)
+            ],
+            [
+                True, False, True, True,
+                True, True, True,
+                True, False, False, True, False,
+                True, False, False, False,
+            ],
+        )
+
+        # Gives up if there can't be enough dates
+        self.assertIsNone(
+            parse_date_array(['2019-07-02', '12', '1.5'], min_count=2),
+        )
+        self.assertIsNone(
+            parse_date_array(
+                ['2019-07-02', '2019-13-02', 'foo'],
+                [1, 5, 1],
+                min_count=3,
+            ),
+        )
+        self.assertEqual(
+            len(parse_date_array(['2019-07-02', 'foo'], [3, 1], min_count=3)),
+            2,
+        )
+
     def test_year(self):
         """Test the 'year' special-case"""
         dataframe = pandas.DataFrame({
@@ -348,6 +763,54 @@ class TestTemporalResolutions(unittest.TestCase):
 
         self.do_checks(get_res)
 
+    def test_floor(self):
+        """Test flooring datetimes to a resolution"""
+        values = to_datetime64(pandas.DatetimeIndex([
+            '2020-01-14T21:05:02.5',
+            '2020-05-31T00:00:00',
+            '1969-12-31T23:59:59',
+            'NaT',
+        ]))
+
+        def floor(resolution):
+            return [
+                str(v)
+                for v in floor_datetimes(values, resolution)
+                .astype('datetime64[s]')
+            ]
+
+        self.assertEqual(floor('year'), [
+            '2020-01-01T00:00:00', '2020-01-01T00:00:00',
+            '1969-01-01T00:00:00', 'NaT',
+        ])
+        self.assertEqual(floor('quarter'), [
+            '2020-01-01T00:00:00', '2020-04-01T00:00:00',
+            '1969-10-01T00:00:00', 'NaT',
+        ])
+        self.assertEqual(floor('week'), [
+            '2020-01-13T00:00:00', '2020-05-25T00:00:00',
+            '1969-12-29T00:00:00', 'NaT',
+        ])
+        self.assertEqual(floor('hour'), [
+            '2020-01-14T21:00:00', '2020-05-31T00:00:00',
+            '1969-12-31T23:00:00', 'NaT',
+        ])
+        self.assertEqual(floor('second'), [
+            '2020-01-14T21:05:02', '2020-05-31T00:00:00',
+            '1969-12-31T23:59:59', 'NaT',
+        ])
+
+        # Aware datetimes use their own timezone
+        self.assertEqual(
+            [
+                str(v) for v in floor_datetimes(
+                    to_datetime64([datetime(2020, 3, 1, 2, 30, tzinfo=UTC)]),
+                    'day',
+                )
+            ],
+            ['2020-03-01'],
+        )
+
     def do_checks(self, get_res):
         self.assertEqual(
             get_res([
@@ -564,6 +1027,139 @@ class TestTypes(unittest.TestCase):
             positive, negative,
         )
 
+    def test_count(self):
+        """Test counting the values matching each type over a column"""
+        self.assertEqual(
+            profile_types.regular_exp_count([
+                '12', '', '4.0', '-.4', 'POINT (40.7 -73.9)',
+                'POINT (40.7, -73.9)',
+                "RÉMI'S HOUSE, BROOKLYN, NY (40.729753, -73.997174)",
+                '(40.729753, -73.997174)', 'POLYGON ((1 2 3 4))',
+                'some more words here', 'two\nlines and more words',
+                'Yes', 'n', '0', '', 'word',
+            ]),
+            {
+                'empty': 2, 'int': 3, 'float': 1, 'point': 1,
+                'geo_combined': 2, 'latlong_point': 1, 'polygon': 1,
+                'text': 2, 'bool': 3,
+            },
+        )
+
+    def test_count_long_value(self):
+        """Test counting a long value with few whitespace runs"""
+        # This used to take time cubic in the length of the value
+        long_value = ' '.join(['a' * 100000] * 3)
+        self.assertEqual(
+            profile_types.regular_exp_count([long_value, long_value + ' b']),
+            {'text': 1},
+        )
+
+    def test_count_distinct(self):
+        """Test counting types over distinct values weighted by count"""
+        array = ['12', '', 'a b c', '12', 'yes', '', '12', '4.5']
+        codes, uniques, counts = profile_types.factorize_column(array)
+        self.assertEqual(list(uniques), ['12', '', 'a b c', 'yes', '4.5'])
+        self.assertEqual(list(counts), [3, 2, 1, 1, 1])
+        self.assertEqual(
+            profile_types.regular_exp_count(uniques, counts),
+            profile_types.regular_exp_count(array),
+        )
+        self.assertEqual(
+            profile_types.expand_distinct(
+                [None, None, 'x', 'y', 'z'],
+                codes,
+            ),
+            ['x', 'y', 'z'],
+        )
+
+    def test_parsed_column(self):
+        """Test the parsed representations shared by the profiling steps"""
+        parsed = profile_types.ParsedColumn(['12.5', '', '-3', 'nope', '-3'])
+        numpy.testing.assert_array_equal(
+            parsed.floats,
+            [12.5, numpy.nan, -3.0, numpy.nan, -3.0],
+        )
+        self.assertEqual(list(parsed.counts), [1, 1, 2, 1])
+
+        parsed = profile_types.ParsedColumn(
+            ['2020-01-02', '', '2020-01-02', '2021-03-04'],
+        )
+        structural_type, semantic_types_dict, _ = \
+            profile_types.identify_types(
+                parsed.array, 'date', None, parsed=parsed,
+            )
+        self.assertIn('http://schema.org/DateTime', semantic_types_dict)
+        self.assertEqual(
+            parsed.unique_dates.tolist(),
+            [
+                datetime(2020, 1, 2, tzinfo=UTC),
+                None,
+                datetime(2021, 3, 4, tzinfo=UTC),
+            ],
+        )
+        numpy.testing.assert_array_equal(
+            parsed.unique_timestamps(),
+            [1577923200.0, numpy.nan, 1614816000.0],
+        )
+        self.assertEqual(
+            [str(d) for d in parsed.unique_datetime64()],
+            ['2020-01-02T00:00:00.000000', '2021-03-04T00:00:00.000000'],
+        )
+
+    def test_count_unmatched(self):
+        """Test counting the values that don't match structural types"""
+        values = ['12', '-4.5', '', 'abc', '7\nlines', '3.0', '.5', 'x y']
+        counts = [3, 2, 5, 1, 1, 2, 1, 4]
+        re_count = profile_types.regular_exp_count(values, counts)
+        self.assertEqual(
+            profile_types.count_unmatched(values, counts, ('int',)),
+            sum(counts) - re_count['empty'] - re_count['int'],
+        )
+        self.assertEqual(
+            profile_types.count_unmatched(values, counts, ('int', 'float')),
+            sum(counts) - re_count['empty'] - re_count['int']
+            - re_count['float'],
+        )
+
+    def test_progressive(self):
+        """Test that identifying types from a sample gives the same result"""
+        rand = numpy.random.RandomState(3)
+        columns = {
+            'id': [str(i) for i in range(30000)],
+            'price': ['%.2f' % f for f in rand.uniform(0, 1000, 30000)],
+            'mostly_ints': (
+                [str(i) for i in range(29100)]
+                + ['%d.5' % i for i in range(900)]
+            ),
+            'text': [
+                'word %d and some more' % i if i % 3 else 'w%d' % i
+                for i in range(30000)
+            ],
+            'dates': [
+                '2020-01-01 %02d:%02d:%02d' % (i // 3600, i // 60 % 60, i % 60)
+                for i in range(20000)
+            ] + [''] * 10000,
+        }
+        for name, values in columns.items():
+            rand.shuffle(values)
+            expected = profile_types.identify_types(
+                values, name, None,
+                progressive=False,
+            )
+            with mock.patch.object(profile_types, 'regular_exp_count',
+                                   wraps=profile_types.regular_exp_count) \
+                    as regular_exp_count:
+                result = profile_types.identify_types(values, name, None)
+            self.assertEqual(result[0], expected[0])
+            self.assertEqual(result[1].keys(), expected[1].keys())
+            self.assertEqual(result[2], expected[2])
+            # Only the sample was scanned, except for the ambiguous column
+            self.assertEqual(
+                [len(call[0][0]) <= 2000
+                 for call in regular_exp_count.call_args_list],
+                [True] if name != 'mostly_ints' else [True, False],
+            )
+
 
 class TestTruncate(unittest.TestCase):
     def test_simple(self):
@@ -719,11 +1315,247 @@ class TestNominatim(DataTestCase):
         finally:
             spatial.nominatim_query = old_query
 
+    def test_concurrent_batches(self):
+        """Test sending multiple batches to Nominatim at the same time"""
+        queried = []
+
+        def replacement(url, *, q):
+            queried.extend(q)
+            return [[{'lat': int(qe), 'lon': 0.0}] for qe in q]
+
+        values = [str(i % 50) for i in range(120)]
+        with mock.patch.object(spatial, 'nominatim_query', replacement), \
+                mock.patch.object(spatial, 'NOMINATIM_BATCH_SIZE', 7):
+            res, empty = spatial.nominatim_resolve_all(
+                'http://240.123.45.67:21',
+                values,
+            )
+        self.assertEqual(sorted(queried), sorted(set(values)))
+        self.assertEqual(empty, 120)
+        self.assertEqual(
+            res,
+            [
+                (float(i), 0.0)
+                for i in range(50)
+                for _ in range(3 if i < 20 else 2)
+            ],
+        )
+
+    def test_prefilter(self):
+        """Test rejecting columns that don't look like addresses"""
+        addresses = [
+            "70 Washington Square S, New York, NY 10012",
+            "6 MetroTech, Brooklyn, NY 11201",
+            "1600 Pennsylvania Avenue NW",
+            "London SW1A 1AA",
+            "New York City",
+            "",
+        ]
+        self.assertTrue(spatial.address_prefilter(
+            addresses, [5, 3, 1, 2, 1, 4], 0.2,
+        ))
+        lower_addresses = [
+            "123 main st",
+            "350 fifth avenue, new york, ny",
+            "1600 pennsylvania ave nw, washington dc",
+            "brooklyn, ny 11201",
+        ]
+        for address in lower_addresses:
+            self.assertTrue(spatial.looks_like_address(address))
+        self.assertTrue(spatial.address_prefilter(
+            lower_addresses, [2, 1, 3, 1], 0.2,
+        ))
+        comments = [
+            "the quick brown fox jumps over the lazy dog",
+            "This product is great and I loved it",
+            "Red cotton t-shirt, size 10",
+            "70 Washington Square S, New York, NY 10012",
+        ]
+        self.assertFalse(spatial.address_prefilter(
+            comments, [3, 3, 3, 1], 0.2,
+        ))
+        # Values that are too long can't be resolved
+        self.assertFalse(spatial.address_prefilter(
+            ["%d Mercer St, New York, NY 10012" % i + ", Floor 4" * 10
+             for i in range(10)] + ["251 Mercer St"],
+            [1] * 11, 0.2,
+        ))
+
+        # Nominatim is not queried
+        data = pandas.DataFrame({
+            'comment': [
+                "the quick brown fox jumps over the lazy dog",
+                "we had a great time at the restaurant",
+            ] * 10,
+        })
+        rejected = prometheus_client.REGISTRY.get_sample_value(
+            'profile_address_prefilter_rejected_total',
+        )
+        with mock.patch.object(spatial, 'nominatim_query') as query:
+            metadata = process_dataset(data, nominatim='http://nominatim/')
+        query.assert_not_called()
+        self.assertEqual(
+            metadata['columns'][0]['semantic_types'],
+            ['http://schema.org/Text'],
+        )
+        self.assertEqual(
+            prometheus_client.REGISTRY.get_sample_value(
+                'profile_address_prefilter_rejected_total',
+            ),
+            rejected + 1,
+        )
+
+    def test_session_per_process(self):
+        """Test that forked processes don't reuse the parent's session"""
+        session = spatial._nominatim_session()
+        self.assertIs(spatial._nominatim_session(), session)
+        with mock.patch.object(spatial.os, 'getpid', return_value=-1):
+            child_session = spatial._nominatim_session()
+        self.assertIsNot(child_session, session)
+
+    def test_cache(self):
+        """Test keeping the results of Nominatim queries in a cache"""
+        from datamart_profiler.geocode_cache import SqliteGeocodeCache
+
+        queries = {
+            'a': [{'lat': 11.0, 'lon': 12.0}],
+            'b': [],
+            'c': [{'lat': 31.0, 'lon': 32.0}],
+        }
+        queried = []
+
+        def replacement(url, *, q):
+            queried.extend(q)
+            return [queries[qe] for qe in q]
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(spatial, 'nominatim_query', replacement):
+            cache = SqliteGeocodeCache(os.path.join(tmp, 'geocode.sqlite3'))
+            for _ in range(2):
+                res, empty = spatial.nominatim_resolve_all(
+                    'http://240.123.45.67:21',
+                    ['a', 'b', 'c', 'b'],
+                    cache=cache,
+                )
+                self.assertEqual(res, [(11.0, 12.0), (31.0, 32.0)])
+                self.assertEqual(empty, 4)
+            # Second call was answered from the cache
+            self.assertEqual(queried, ['a', 'b', 'c'])
+            self.assertEqual(
+                cache.get_many(['a', 'b', 'd']),
+                {'a': (11.0, 12.0), 'b': None},
+            )
+            # Can be sent to worker processes
+            self.assertEqual(
+                pickle.loads(pickle.dumps(cache)).get_many(['a', 'b', 'd']),
+                {'a': (11.0, 12.0), 'b': None},
+            )
+
+            # Test expiration
+            cache = SqliteGeocodeCache(
+                os.path.join(tmp, 'expiring.sqlite3'),
+                negative_ttl=-1,
+            )
+            queried[:] = []
+            for _ in range(2):
+                spatial.nominatim_resolve_all(
+                    'http://240.123.45.67:21',
+                    ['a', 'b'],
+                    cache=cache,
+                )
+            self.assertEqual(cache.get_many(['a', 'b']), {'a': (11.0, 12.0)})
+            self.assertEqual(queried, ['a', 'b', 'b'])
+
+
+class TestAdminNames(unittest.TestCase):
+    def test_filter(self):
+        """Test skipping administrative areas resolution using the names"""
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        conn = sqlite3.connect(os.path.join(tmp, 'admins.sqlite3'))
+        conn.execute(
+            'CREATE TABLE admins(id INTEGER PRIMARY KEY, name TEXT, '
+            'level INTEGER, latitude REAL, longitude REAL, bounds TEXT, '
+            'country TEXT, admin1 TEXT, admin2 TEXT, admin3 TEXT, '
+            'admin4 TEXT, admin5 TEXT);',
+        )
+        conn.execute('CREATE TABLE names(id INTEGER, name TEXT);')
+        with conn:
+            for i in range(1000):
+                conn.execute(
+                    'INSERT INTO admins(id, name, level, country) '
+                    'VALUES (?, ?, 2, \'Q30\');',
+                    (i, 'Town %d' % i),
+                )
+                conn.execute(
+                    'INSERT INTO names(id, name) VALUES (?, ?);',
+                    (i, 'town %d' % i),
+                )
+        conn.close()
+        # Filter built for a previous version of the database
+        numpy.save(os.path.join(tmp, 'admin_names.1-2.npy'), numpy.zeros(8))
+
+        geo_data = GeoData(tmp)
+        self.addCleanup(admin_names._filters.pop, geo_data.data_path, None)
+        name_filter = admin_names.load_admin_names(geo_data, tmp)
+        self.assertEqual(len(name_filter.bits), 1250)
+        self.assertEqual(
+            [f for f in os.listdir(tmp) if f.endswith('.npy')],
+            ['admin_names.%s.npy' % admin_names._database_signature(
+                os.path.join(tmp, 'admins.sqlite3'),
+            )],
+        )
+        self.assertEqual(
+            list(name_filter.contains_many(['Town 12', 'TOWN 999', 'City'])),
+            [True, True, False],
+        )
+
+        # Loading again maps the same file
+        admin_names._filters.pop(geo_data.data_path)
+        name_filter = admin_names.load_admin_names(geo_data, tmp)
+        self.assertIsInstance(name_filter.bits, numpy.memmap)
+        self.assertIs(admin_names.get_admin_names(geo_data), name_filter)
+
+        looked_up = []
+        resolve_names_all = geo_data.resolve_names_all
+
+        def resolve(names):
+            looked_up.extend(names)
+            return resolve_names_all(names)
+
+        geo_data.resolve_names_all = resolve
+
+        # Town names get resolved, other values are not looked up
+        values = ['Town %d' % i for i in range(800)]
+        values += ['Person %d' % i for i in range(200)]
+        areas = profile_types.resolve_admin_areas(geo_data, values, 0.7)
+        self.assertEqual(len(areas), 800)
+        self.assertLess(len(looked_up), 820)
+
+        # Values that are not names are skipped from the sample
+        looked_up[:] = []
+        values = ['Person %d' % i for i in range(5000)]
+        self.assertEqual(
+            profile_types.resolve_admin_areas(geo_data, values, 0.7),
+            [],
+        )
+        self.assertEqual(looked_up, [])
+
+        # Manual resolution keeps the values aligned
+        resolved = profile_types.resolve_names(
+            geo_data,
+            ['Person 1', 'Town 3', 'Person 2', 'Town 4'],
+        )
+        self.assertEqual(
+            [[area.name for area in r] for r in resolved],
+            [[], ['Town 3'], [], ['Town 4']],
+        )
+
 
 class TestGeo(DataTestCase):
     @classmethod
     def setUpClass(cls):
-        cls.geo_data = datamart_geo.GeoData.from_local_cache()
+        cls.geo_data = GeoData.from_local_cache()
 
     def test_admin(self):
         """Test profiling administrative areas"""
@@ -968,6 +1800,88 @@ class TestGeo(DataTestCase):
         )
 
 
+class TestNumericalRanges(unittest.TestCase):
+    def test_segments(self):
+        """Test the 1-dimensional segmentation against all possible splits"""
+        rand = numpy.random.RandomState(1)
+        for _ in range(50):
+            values = numpy.unique(rand.normal(0.0, 10.0, 12))
+            weights = rand.randint(1, 5, len(values))
+            costs = numerical._SegmentCosts(values, weights)
+
+            def total_cost(bounds):
+                return sum(
+                    costs(bounds[i], bounds[i + 1])
+                    for i in range(len(bounds) - 1)
+                )
+
+            for nb_segments in (1, 2, 3):
+                segments = numerical.optimal_segments(
+                    values, weights, nb_segments,
+                )
+                self.assertEqual(len(segments), nb_segments)
+                best = min(
+                    total_cost((0,) + splits + (len(values),))
+                    for splits in itertools.combinations(
+                        range(1, len(values)), nb_segments - 1,
+                    )
+                )
+                self.assertAlmostEqual(
+                    total_cost([start for start, _ in segments] +
+                               [len(values)]),
+                    best,
+                )
+
+    def test_ranges(self):
+        """Test computing the numerical ranges"""
+        values = (
+            [float(i) for i in range(100, 120)] * 5 +
+            [float(i) for i in range(200, 240)] * 3 +
+            [float(i) for i in range(500, 520)] * 4 +
+            [1000.0, 1001.0]
+        )
+        random.Random(1).shuffle(values)
+        self.assertEqual(
+            numerical.get_numerical_ranges(values),
+            [
+                {'range': {'gte': 101.0, 'lte': 119.0}},
+                {'range': {'gte': 202.0, 'lte': 238.0}},
+                {'range': {'gte': 501.0, 'lte': 519.0}},
+            ],
+        )
+        self.assertEqual(
+            numerical.get_numerical_ranges([3.0, 3.0, 3.0]),
+            [{'range': {'gte': 3.0, 'lte': 3.0}}],
+        )
+        self.assertEqual(numerical.get_numerical_ranges([]), [])
+
+
+class TestSpatialRanges(unittest.TestCase):
+    def test_sampled(self):
+        """Test computing bounding boxes from a sample of the points"""
+        rnd = numpy.random.RandomState(2)
+        points = numpy.concatenate([
+            rnd.uniform([40.0, -74.0], [41.0, -73.0], (600, 2)),
+            rnd.uniform([34.0, -119.0], [35.0, -118.0], (300, 2)),
+            numpy.array([[48.85, 2.35]] * 100),
+        ])
+        with mock.patch.object(spatial, 'SPATIAL_CLUSTERING_SAMPLE_SIZE', 200):
+            ranges = spatial.get_spatial_ranges(points)
+        self.assertEqual(len(ranges), 3)
+        for rg in ranges:
+            self.assertEqual(rg['range']['type'], 'envelope')
+        coords = [rg['range']['coordinates'] for rg in ranges]
+        self.assertTrue(-119.0 <= coords[0][0][0] < coords[0][1][0] <= -118.0)
+        self.assertTrue(35.0 >= coords[0][0][1] > coords[0][1][1] >= 34.0)
+        self.assertTrue(-74.0 <= coords[1][0][0] < coords[1][1][0] <= -73.0)
+        self.assertTrue(41.0 >= coords[1][0][1] > coords[1][1][1] >= 40.0)
+        # Single point gets a small area
+        numpy.testing.assert_allclose(
+            coords[2],
+            [[2.3499, 48.8501], [2.3501, 48.8499]],
+        )
+
+
 class TestMedianDist(unittest.TestCase):
     def test_median_dist(self):
         """Test determining the median distance of points"""